@@ -0,0 +1,436 @@
+"""
+Defines benchmarks for the data analysis toolbox.
+
+Usage: python -m dant.bench [xlfilepath sheetname] [repeat]
+       python -m dant.bench --sizes 10000,100000 [--repeat N]
+                            [--output results.jsonl] [--compare base.jsonl]
+
+The second form runs the suites against synthetic Orbis-shaped workbooks of
+the given row counts and appends the results as JSON lines to --output so
+that runs can be compared with --compare. Writing .xls workbooks needs
+xlwt; .xlsx workbooks are written without it.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from xlrd import open_workbook
+from .data import XlSheet, _strip_values
+from .db import BatchInserter, DmlRunner
+from .delimited import DelimitedSheet
+from .rows import RowStream
+from .xlsx import XlsxSheet, write_xlsx
+
+
+
+TEST_DATA_DIR = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        '..', 'test-data'
+    )
+)
+
+# data rows per sheet of a synthetic workbook; .xls sheets hold 65536 rows
+SHEET_ROWS = 65535
+
+# columns of an Orbis export; do4mssql_orbis keeps columns 0-31, 46 & 49
+ORBIS_HEADER = [
+    'SN', 'AcctNo', 'Book', 'FirstName', 'MiddleName', 'LastName',
+    'Building#', 'Street', 'Settlement', 'Ward', 'LGA', 'Feeder',
+    'Transformer', 'CustType', '#Rooms', 'MeterNo', 'MeterType', 'Tariff',
+    'Phone1', 'Phone2', 'Mobile', 'Mobile2', 'Email', 'Occupation',
+    'Landmark', 'Remarks', 'Latitude', 'Longitude', 'Pole', 'Status',
+    'CaptureDate', 'Enumerator'
+] + ['Field%s' % i for i in range(32, 46)] + [
+    'BusinessUnit', 'Field47', 'Field48', 'Undertaking'
+]
+
+_FIRST_NAMES = ('Musa', 'Aminu', 'Fatima', 'Hauwa', 'Ibrahim', 'Sani',
+                'ALH. MUSA', 'Musa & Sons', 'OTHERS', '-', '', 'A=B/C')
+_LAST_NAMES = ('Bello', 'Abdullahi', 'Yusuf', 'Garba', 'Lawan', '.', '0')
+_STREETS = ('Gwale Road', 'k/waika;', '"Zoo Road"', 'NO. 12', '12', '--')
+_WARDS = ('Dala', 'Gwale', 'Fagge', 'Nassarawa', 'Tarauni', '=')
+_CUST_TYPES = ('Residential', 'Commercial', 'Industrial', 'Government',
+               'Others', 'residential')
+_ROOMS = ('1', '2', '3', '4', '6', '', '0', ' 3.5 ', 'two')
+_PHONES = ('08031234567', '0803-123-4567', '080312345678', '+2348031234567',
+           '0080312345678', '12345678', '', '-')
+_METERS = ('MTR-12/3', 'AVR', '0000000092', 'A/V', '', '-')
+
+BenchContext = namedtuple('BenchContext', 'size repeat workdir workbook sheets')
+
+
+def orbis_rows(count, seed=2016):
+    """Yields `count` synthetic Orbis-shaped rows, header excluded, mixing
+    clean values with the junk seen in real exports.
+    """
+    rnd = random.Random(seed)
+    choice = rnd.choice
+    for i in range(count):
+        mobiles = choice(_PHONES)
+        if rnd.random() < 0.05:
+            mobiles = '%s, %s' % (mobiles, choice(_PHONES))
+        row = [
+            float(i + 1), '', '32/55/%02d' % (i // 1000 % 100),
+            choice(_FIRST_NAMES), choice(_FIRST_NAMES + ('',) * 6),
+            choice(_LAST_NAMES), str(rnd.randint(1, 999)), choice(_STREETS),
+            choice(_WARDS), choice(_WARDS), 'Dala', 'Feeder %s' % (i % 40),
+            'TX-%s' % (i % 400), choice(_CUST_TYPES), choice(_ROOMS),
+            choice(_METERS), 'Prepaid', '', choice(_PHONES), choice(_PHONES),
+            mobiles, '', '', 'Trader', 'Near the mosque on the main road',
+            'Captured during the Dala renumeration exercise', 12.0, 8.5,
+            'P-%s' % (i % 900), 'Active', '2014-12-01', 'E%s' % (i % 25),
+        ]
+        row += [''] * 14 + ['Dala', '', '', 'Dala %s' % (i % 8)]
+        yield row
+
+
+def write_workbook(path, count, seed=2016):
+    """Writes `count` synthetic Orbis rows to an .xls workbook, in sheets
+    named orbis1, orbis2, ... of up to SHEET_ROWS rows each under a header,
+    and returns the sheet names.
+    """
+    import xlwt
+
+    book, names = xlwt.Workbook(), []
+    sheet = None
+    for i, row in enumerate(orbis_rows(count, seed)):
+        rowx = i % SHEET_ROWS + 1
+        if rowx == 1:
+            names.append('orbis%s' % (len(names) + 1))
+            sheet = book.add_sheet(names[-1])
+            for colx, value in enumerate(ORBIS_HEADER):
+                sheet.write(0, colx, value)
+        for colx, value in enumerate(row):
+            sheet.write(rowx, colx, value)
+        if rowx == SHEET_ROWS:
+            sheet.flush_row_data()
+    book.save(path)
+    return names
+
+
+def get_workbook(workdir, count, seed=2016):
+    """Returns the path and sheet names of the synthetic workbook for `count`
+    rows in workdir, writing it unless written before.
+    """
+    path = os.path.join(workdir, 'orbis-%s-%s.xls' % (count, seed))
+    if not os.path.isfile(path):
+        return path, write_workbook(path, count, seed)
+
+    book = open_workbook(path, on_demand=True)
+    try:
+        return path, book.sheet_names()
+    finally:
+        book.release_resources()
+
+
+def get_xlsx_workbook(workdir, count, seed=2016):
+    """Returns the path of the synthetic .xlsx workbook for `count` rows in
+    workdir, with the rows in a single sheet named orbis, writing it unless
+    written before.
+    """
+    path = os.path.join(workdir, 'orbis-%s-%s.xlsx' % (count, seed))
+    if not os.path.isfile(path):
+        rows = chain([ORBIS_HEADER], orbis_rows(count, seed))
+        write_xlsx(path, [('orbis', rows)])
+    return path
+
+
+def get_csv_file(workdir, count, seed=2016):
+    """Returns the path of the synthetic .csv file for `count` rows in
+    workdir, writing it unless written before.
+    """
+    path = os.path.join(workdir, 'orbis-%s-%s.csv' % (count, seed))
+    if not os.path.isfile(path):
+        # csv writes bytes on python 2; the rows are plain ascii
+        if str is bytes:
+            f = open(path, 'wb')
+        else:
+            f = io.open(path, 'w', encoding='utf-8', newline='')
+        with f:
+            writer = csv.writer(f)
+            writer.writerow(ORBIS_HEADER)
+            writer.writerows(orbis_rows(count, seed))
+    return path
+
+
+def _percell_rows(xlsheet):
+    """Reads rows the way XlSheet.getrows did before the bulk read mode: one
+    `cell_value` call per cell.
+    """
+    sheet = xlsheet._sheet
+    for i in range(xlsheet.nrows):
+        row = []
+        for j in range(xlsheet.ncols):
+            row.append(_strip_values([sheet.cell_value(i, j)])[0])
+        yield row
+
+
+def _consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def bench_xlsheet(workbook, sheet_name, repeat=5):
+    """Times the per-cell path against the bulk row and column reads of the
+    provided sheet and returns a list of (name, best seconds, cells/sec).
+    """
+    # getrows hands out a shared generator, so each run uses a fresh sheet
+    fresh = lambda: XlSheet(workbook, sheet_name)
+    xlsheet = fresh()
+    cells = xlsheet.nrows * xlsheet.ncols
+    cases = (
+        ('percell-rows', lambda: _consume(_percell_rows(fresh()))),
+        ('bulk-rows', lambda: _consume(fresh().getrows())),
+        ('bulk-columns', lambda: fresh().getcolumns()),
+    )
+
+    results = []
+    for name, func in cases:
+        best = min(timeit.repeat(func, repeat=repeat, number=1))
+        results.append((name, best, (cells / best) if best else 0))
+    return results
+
+
+def run_case(name, func, size, items, unit='rows', repeat=3, setup=None):
+    """Times func, after calling setup if any before each run, and returns
+    a result record with the best time and the rate of `items` per second.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+
+    best = min(times)
+    return OrderedDict([
+        ('case', name), ('size', size), ('items', items), ('unit', unit),
+        ('best_seconds', best), ('per_sec', (items / best) if best else 0),
+        ('repeat', repeat), ('python', platform.python_version()),
+        ('when', time.strftime('%Y-%m-%d %H:%M:%S')),
+    ])
+
+
+def suite_xlsheet(ctx):
+    """XlSheet.getrows and getcolumns over the sheets of the workbook."""
+    if not ctx.workbook:
+        return []
+
+    book = open_workbook(ctx.workbook)
+    cells = ctx.size * len(ORBIS_HEADER)
+    def read_rows():
+        for name in ctx.sheets:
+            _consume(XlSheet(book, name).getrows())
+    def read_columns():
+        for name in ctx.sheets:
+            XlSheet(book, name).getcolumns()
+
+    return [
+        run_case('xlsheet.getrows', read_rows, ctx.size, cells, 'cells',
+                 ctx.repeat),
+        run_case('xlsheet.getcolumns', read_columns, ctx.size, cells,
+                 'cells', ctx.repeat),
+    ]
+
+
+def suite_xlsx_sheet(ctx):
+    """XlsxSheet header detection and getrows over a single sheet holding
+    all the rows.
+    """
+    path = get_xlsx_workbook(ctx.workdir, ctx.size)
+    cells = ctx.size * len(ORBIS_HEADER)
+    def find_header():
+        with XlsxSheet(path, 'orbis') as xlsheet:
+            RowStream(ORBIS_HEADER[:3]).find_header(xlsheet.getrows())
+    def read_rows():
+        with XlsxSheet(path, 'orbis') as xlsheet:
+            _consume(xlsheet.getrows())
+
+    return [
+        run_case('xlsx_sheet.find_header', find_header, ctx.size, 1,
+                 'headers', ctx.repeat),
+        run_case('xlsx_sheet.getrows', read_rows, ctx.size, cells, 'cells',
+                 ctx.repeat),
+    ]
+
+
+def suite_delimited(ctx):
+    """DelimitedSheet getrows and decode_rows over a .csv file, parsed in
+    the reading process and by as many workers as cpus.
+    """
+    path = get_csv_file(ctx.workdir, ctx.size)
+    cells = ctx.size * len(ORBIS_HEADER)
+    results = []
+    for processes in sorted(set([1, multiprocessing.cpu_count()])):
+        def read_rows():
+            with DelimitedSheet(path, processes=processes) as sheet:
+                _consume(sheet.getrows())
+        def decode_rows():
+            with DelimitedSheet(path, processes=processes) as sheet:
+                _consume(sheet.decode_rows({0: 'int'}, 1))
+        results += [
+            run_case('delimited.getrows.workers-%s' % processes, read_rows,
+                     ctx.size, cells, 'cells', ctx.repeat),
+            run_case('delimited.decode_rows.workers-%s' % processes,
+                     decode_rows, ctx.size, cells, 'cells', ctx.repeat),
+        ]
+    return results
+
+
+def _dml_connect(path):
+    def connect():
+        conn = sqlite3.connect(path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+    return connect
+
+
+def suite_dml_runner(ctx, workers=(1, 4)):
+    """DmlRunner updating a SQLite stand-in table one statement at a time,
+    with one worker as dml_runner does and with several.
+    """
+    path = os.path.join(ctx.workdir, 'dml-bench.sqlite3')
+    statements = [
+        (i, "UPDATE t SET v = 'n%s' WHERE id = %s" % (i, i))
+        for i in range(ctx.size)
+    ]
+    def setup():
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)')
+        with BatchInserter(conn, 'INSERT INTO t VALUES (?, ?)') as ins:
+            for i in range(ctx.size):
+                ins.add((i, ''))
+        conn.close()
+
+    return [
+        run_case('dml_runner.workers-%s' % n,
+                 lambda n=n: DmlRunner(_dml_connect(path), n).run(statements),
+                 ctx.size, ctx.size, 'statements', ctx.repeat, setup)
+        for n in workers
+    ]
+
+
+SUITES = (suite_xlsheet, suite_xlsx_sheet, suite_delimited, suite_dml_runner)
+
+
+def write_results(records, fileobj):
+    for record in records:
+        fileobj.write(json.dumps(record) + '\n')
+
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(baseline, current):
+    """Returns (case, size, baseline per_sec, current per_sec, ratio) for the
+    cases found in both lists of records, using the latest record of each.
+    """
+    base = dict(((r['case'], r['size']), r) for r in baseline)
+    rows = []
+    for record in current:
+        found = base.get((record['case'], record['size']))
+        if found:
+            ratio = ((record['per_sec'] / found['per_sec'])
+                     if found['per_sec'] else 0)
+            rows.append((record['case'], record['size'], found['per_sec'],
+                         record['per_sec'], ratio))
+    return rows
+
+
+def format_results(records):
+    return '\n'.join(
+        '%-32s %9s %10.4fs %14.0f %s/s' % (
+            r['case'], r['size'], r['best_seconds'], r['per_sec'], r['unit']
+        ) for r in records
+    )
+
+
+def run_suites(suites, argv):
+    """Runs the suites for each size given on the command line; a suite is a
+    function taking a BenchContext and returning result records.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000',
+                        help='comma separated row counts, e.g. 10000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', help='keeps generated workbooks')
+    parser.add_argument('--output', help='file results are appended to')
+    parser.add_argument('--compare', help='results file to compare with')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    records = []
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            try:
+                workbook, sheets = get_workbook(workdir, size)
+            except ImportError:
+                print('xlwt not installed; workbook suites skipped')
+                workbook, sheets = None, []
+
+            ctx = BenchContext(size, args.repeat, workdir, workbook, sheets)
+            for suite in suites:
+                found = suite(ctx)
+                print(format_results(found))
+                records.extend(found)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            write_results(records, f)
+
+    if args.compare:
+        print('\n%-32s %9s %14s %14s %7s' % (
+            'case', 'size', 'baseline/s', 'current/s', 'ratio'
+        ))
+        for row in compare_results(read_results(args.compare), records):
+            print('%-32s %9s %14.0f %14.0f %6.2fx' % row)
+    return records
+
+
+def main(argv):
+    if argv and argv[0].startswith('--'):
+        return run_suites(SUITES, argv)
+
+    if len(argv) >= 2:
+        xlfilepath, sheet_name = argv[:2]
+    else:
+        xlfilepath = os.path.join(TEST_DATA_DIR, 'sample-cust.xls')
+        sheet_name = 'active'
+    repeat = int(argv[2]) if len(argv) > 2 else 5
+
+    workbook = open_workbook(xlfilepath)
+    print('%s [%s]' % (xlfilepath, sheet_name))
+    for name, best, rate in bench_xlsheet(workbook, sheet_name, repeat):
+        print('%-14s %10.4fs %14.0f cells/s' % (name, best, rate))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,546 @@
+"""
+Defines caches for memoizing data cleansing functions and for keeping parsed
+worksheets on disk.
+"""
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import sys
+import xlrd
+
+from array import array
+from collections import OrderedDict
+from .data import EMPTY_CELL_TYPES, NUMERIC_CELL_TYPES, _schema_items
+from .data import _SharedRows, _released_after, decode_column, decode_rows
+
+
+
+class MemoCache(object):
+    """Memoizes functions of hashable arguments in a bounded in-process LRU
+    and, once a store is opened, in a SQLite file which persists results
+    across runs.
+
+    Each function is memoized under a name and a rules version; stored
+    results of a function are discarded once its version changes, leaving
+    those of other functions in place.
+
+    :: maxsize: maximum number of results held in memory.
+    :: path: optional path to the SQLite store; see `open`.
+    :: flush_every: number of new results held before writing to the store.
+    """
+
+    DB_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS memo_versions (
+        name          VARCHAR(50) PRIMARY KEY,
+        version       VARCHAR(20)
+    );
+    CREATE TABLE IF NOT EXISTS memo_entries (
+        name          VARCHAR(50),
+        key           TEXT,
+        value         TEXT,
+        PRIMARY KEY (name, key)
+    );
+    """
+
+    def __init__(self, maxsize=100000, path=None, flush_every=1000):
+        self.maxsize = maxsize
+        self.flush_every = flush_every
+        self._lru = OrderedDict()
+        self._versions = {}
+        self._counters = {}
+        self._pending = []
+        self._conn = None
+        if path:
+            self.open(path)
+
+    def memoize(self, name, version, func):
+        """Returns a memoized version of func."""
+        self._versions[name] = str(version)
+        self._counters[name] = dict(hits=0, disk_hits=0, misses=0)
+        if self._conn is not None:
+            self._sync_version(name)
+
+        def memoized(*args):
+            return self._get(name, func, args)
+        memoized.__name__ = getattr(func, '__name__', name)
+        memoized.__doc__ = func.__doc__
+        return memoized
+
+    def clear(self):
+        """Drops the results held in memory; stored results are kept."""
+        self._lru.clear()
+
+    def stats(self):
+        """Returns the hit, disk hit and miss counts per function."""
+        return dict((name, dict(c)) for name, c in self._counters.items())
+
+    def _get(self, name, func, args):
+        key = (name, args)
+        lru = self._lru
+        try:
+            value = lru.pop(key)
+            lru[key] = value
+            self._counters[name]['hits'] += 1
+            return value
+        except KeyError:
+            pass
+
+        found = self._load(name, args) if self._conn is not None else None
+        if found is not None:
+            value = found[0]
+            self._counters[name]['disk_hits'] += 1
+        else:
+            value = func(*args)
+            self._counters[name]['misses'] += 1
+            if self._conn is not None:
+                self._save(name, args, value)
+
+        lru[key] = value
+        if len(lru) > self.maxsize:
+            lru.popitem(last=False)
+        return value
+
+    def open(self, path):
+        """Opens the SQLite store at path, discarding stored results of the
+        memoized functions whose version has changed.
+        """
+        self.close()
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(self.DB_SCRIPT)
+        for name in self._versions:
+            self._sync_version(name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.flush()
+        self._conn.close()
+        self._conn = None
+
+    def flush(self):
+        """Writes the new results held to the store."""
+        if self._conn is None or not self._pending:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO memo_entries VALUES (?, ?, ?)",
+                self._pending
+            )
+        self._pending = []
+
+    def _sync_version(self, name):
+        version = self._versions[name]
+        found = self._conn.execute(
+            "SELECT version FROM memo_versions WHERE name = ?", (name,)
+        ).fetchone()
+        if found and found[0] == version:
+            return
+
+        self._pending = [p for p in self._pending if p[0] != name]
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM memo_entries WHERE name = ?", (name,)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO memo_versions VALUES (?, ?)",
+                (name, version)
+            )
+
+    def _load(self, name, args):
+        found = self._conn.execute(
+            "SELECT value FROM memo_entries WHERE name = ? AND key = ?",
+            (name, json.dumps(args))
+        ).fetchone()
+        return (json.loads(found[0]),) if found else None
+
+    def _save(self, name, args, value):
+        self._pending.append((name, json.dumps(args), json.dumps(value)))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+
+# separates the cells of a text segment unless a cell contains it, in which
+# case the segment comes with an offsets segment
+_SEP = u'\x00'
+
+_TEXT_TYPES = (xlrd.XL_CELL_TEXT,) + EMPTY_CELL_TYPES
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """Returns the sha1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _array_bytes(data):
+    # array.tobytes is array.tostring on python 2
+    return data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+
+
+def _view(buf, offset, count, typecode):
+    # zero-copy typed view over a buffer where memoryview.cast is available
+    stop = offset + count * array(typecode).itemsize
+    if hasattr(memoryview, 'cast'):
+        return memoryview(buf)[offset:stop].cast(typecode)
+    # python 2 can't take a memoryview of a mmap; its slices are copies
+    return array(typecode, buf[offset:stop])
+
+
+class SheetCache(object):
+    """Keeps worksheets parsed by xlrd in a columnar file per sheet, keyed by
+    the digest of the workbook content and the sheet name, so that later
+    opens of the same export skip xlrd altogether.
+
+    The digest of a workbook is kept along with its size and modification
+    time, and the workbook is only hashed again once either changes.
+
+    Each column is kept as a segment of numbers (float64) and a segment of
+    UTF-8 text, with the xlrd cell type per row (uint8) for columns not made
+    of numbers or text only. Cached files are memory-mapped on open and
+    number segments are read without copying.
+
+    :: cache_dir: directory holding the cached sheets.
+    """
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, cache_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, digest, sheet_name):
+        name = '%s-%s' % (digest, hashlib.sha1(
+            sheet_name.encode('utf-8')).hexdigest()[:12])
+        base = os.path.join(self.cache_dir, name)
+        return base + '.cols', base + '.json'
+
+    def _digest(self, xlfilepath):
+        # the digest kept for the workbook unless its size or modification
+        # time changed since, in which case it is hashed again
+        st = os.stat(xlfilepath)
+        stamp = dict(size=st.st_size, mtime=st.st_mtime)
+        stamp_path = os.path.join(self.cache_dir, '%s.stamp' % (
+            hashlib.sha1(os.path.abspath(xlfilepath).encode('utf-8'))
+            .hexdigest()[:16],))
+        if os.path.isfile(stamp_path):
+            with open(stamp_path) as f:
+                found = json.load(f)
+            if found.get('size') == stamp['size'] and found.get(
+                    'mtime') == stamp['mtime'] and found.get('digest'):
+                return found['digest']
+
+        stamp['digest'] = file_digest(xlfilepath)
+        with open(stamp_path, 'w') as f:
+            json.dump(stamp, f)
+        return stamp['digest']
+
+    def _read_meta(self, meta_path, sheet_name):
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta.get('version') != self.FORMAT_VERSION or
+                meta.get('byteorder') != sys.byteorder or
+                meta.get('sheet_name') != sheet_name):
+            return None
+        return meta
+
+    def open(self, xlfilepath, sheet_name, instrument=None, on_demand=False):
+        """Returns a CachedSheet for a sheet of a workbook, parsing the sheet
+        with xlrd and caching it first if it is not cached yet.
+        """
+        if not os.path.isfile(xlfilepath):
+            raise IOError('File not found: %s' % (xlfilepath,))
+
+        data_path, meta_path = self._paths(self._digest(xlfilepath),
+                                           sheet_name)
+        meta = self._read_meta(meta_path, sheet_name)
+        if meta is None or not os.path.isfile(data_path):
+            self.misses += 1
+            meta = self._write(xlfilepath, sheet_name, data_path, meta_path)
+        else:
+            self.hits += 1
+        return CachedSheet(data_path, meta, instrument, on_demand)
+
+    def _write(self, xlfilepath, sheet_name, data_path, meta_path):
+        book = xlrd.open_workbook(xlfilepath, on_demand=True)
+        try:
+            if sheet_name not in book.sheet_names():
+                raise ValueError('Sheet not found: %s' % (book.sheet_names()))
+            sheet = book.sheet_by_name(sheet_name)
+            meta = dict(version=self.FORMAT_VERSION,
+                        byteorder=sys.byteorder, sheet_name=sheet_name,
+                        datemode=book.datemode, nrows=sheet.nrows,
+                        ncols=sheet.ncols, columns=[])
+
+            # written under a temporary name, renamed once complete
+            tmp_path = '%s.%s.tmp' % (data_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                for colx in range(sheet.ncols):
+                    meta['columns'].append(self._write_column(
+                        f, sheet.col_values(colx), sheet.col_types(colx)
+                    ))
+        finally:
+            book.release_resources()
+
+        if os.path.exists(data_path):
+            os.remove(data_path)
+        os.rename(tmp_path, data_path)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def _write_column(self, f, values, types):
+        ctypes = array('B', types)
+        found = set(ctypes)
+        column = dict(kind=(
+            'float' if found <= set([xlrd.XL_CELL_NUMBER]) else
+            'text' if found <= set(_TEXT_TYPES) else 'mixed'
+        ))
+        if column['kind'] != 'text':
+            column['numbers'] = self._write_segment(f, array('d', [
+                0.0 if t in _TEXT_TYPES else v for t, v in zip(types, values)
+            ]))
+        if column['kind'] == 'float':
+            return column
+
+        texts = [v.strip() if t in _TEXT_TYPES else u''
+                 for t, v in zip(types, values)]
+        if any(_SEP in t for t in texts):
+            offsets, total = array('I', [0]), 0
+            for text in texts:
+                total += len(text)
+                offsets.append(total)
+            column['offsets'] = self._write_segment(f, offsets)
+            blob = u''.join(texts)
+        else:
+            blob = _SEP.join(texts)
+        column['text'] = self._write_segment(f, blob.encode('utf-8'))
+        if column['kind'] == 'mixed':
+            column['ctypes'] = self._write_segment(f, ctypes)
+        return column
+
+    def _write_segment(self, f, data):
+        # segments start on 8 byte boundaries so views over them are aligned
+        pad = -f.tell() % 8
+        if pad:
+            f.write(b'\0' * pad)
+        offset = f.tell()
+        f.write(_array_bytes(data) if isinstance(data, array) else data)
+        return [offset, len(data)]
+
+
+class CachedSheet(object):
+    """Reads a worksheet cached by SheetCache; presents the same reading
+    methods as dant.data.XlSheet.
+
+    `getcolumns` returns columns of numbers only as views over the cached
+    file where memoryview.cast is available, and as lists otherwise.
+
+    :: on_demand: when True, the cached file is unmapped once the rows
+           generator or a decode_rows generator is used up.
+    """
+
+    # number of rows materialized at a time by getrows
+    CHUNK_ROWS = 4096
+
+    def __init__(self, data_path, meta, instrument=None, on_demand=False):
+        self.sheet_name = meta['sheet_name']
+        self.datemode = meta['datemode']
+        self.instrument = instrument
+        self.on_demand = on_demand
+        self._nrows, self._ncols = meta['nrows'], meta['ncols']
+        self._columns = meta['columns']
+        self._texts = {}
+        self._rows_gen = None
+        with open(data_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        if size else b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def nrows(self):
+        return self._nrows
+
+    @property
+    def ncols(self):
+        return self._ncols
+
+    @property
+    def released(self):
+        return self._mm is None
+
+    def release(self):
+        """Unmaps the cached file; views handed out keep it mapped until
+        they are dropped.
+        """
+        if self._mm is None:
+            return
+
+        mm, self._mm = self._mm, None
+        self._texts = {}
+        try:
+            mm.close()
+        except (AttributeError, BufferError):
+            pass
+
+    def _get_mm(self):
+        if self._mm is None:
+            raise ValueError('Sheet already released: %s' % (self.sheet_name,))
+        return self._mm
+
+    def _segment(self, colx, name, typecode):
+        offset, count = self._columns[colx][name]
+        return _view(self._get_mm(), offset, count, typecode)
+
+    def _text(self, colx):
+        # the text of every row of a column, split once and kept
+        texts = self._texts.get(colx)
+        if texts is None:
+            column = self._columns[colx]
+            offset, size = column['text']
+            blob = self._get_mm()[offset:offset + size].decode('utf-8')
+            if 'offsets' in column:
+                o = self._segment(colx, 'offsets', 'I')
+                texts = [blob[o[i]:o[i + 1]] for i in range(self.nrows)]
+            else:
+                texts = blob.split(_SEP) if self.nrows else []
+            self._texts[colx] = texts
+        return texts
+
+    def _getcolumn(self, colx, start_row, end_row, as_list=False):
+        kind = self._columns[colx]['kind']
+        if kind == 'text':
+            return self._text(colx)[start_row:end_row]
+
+        numbers = self._segment(colx, 'numbers', 'd')[start_row:end_row]
+        if kind == 'float':
+            return (numbers.tolist() if as_list or isinstance(numbers, array)
+                    else numbers)
+
+        ctypes = self._segment(colx, 'ctypes', 'B')[start_row:end_row]
+        texts = self._text(colx)[start_row:end_row]
+        return [t if c in _TEXT_TYPES else
+                (n if c in NUMERIC_CELL_TYPES else int(n))
+                for c, n, t in zip(ctypes, numbers, texts)]
+
+    def getcells(self, colx, start_row=0, end_row=None):
+        """Returns the values and xlrd cell types of a column; empty cells
+        and cells of blanks come as empty cells.
+        """
+        end_row = self.nrows if end_row is None else min(end_row, self.nrows)
+        values = self._getcolumn(colx, start_row, end_row, True)
+        kind = self._columns[colx]['kind']
+        if kind == 'float':
+            ctypes = [xlrd.XL_CELL_NUMBER] * len(values)
+        elif kind == 'text':
+            ctypes = [xlrd.XL_CELL_TEXT if v else xlrd.XL_CELL_EMPTY
+                      for v in values]
+        else:
+            ctypes = [xlrd.XL_CELL_EMPTY if c in _TEXT_TYPES and not v else c
+                      for c, v in zip(self._segment(colx, 'ctypes', 'B')[
+                          start_row:end_row], values)]
+        return values, ctypes
+
+    def decode_columns(self, schema, start_row=0, end_row=None, errors=None):
+        """Same as XlSheet.decode_columns."""
+        columns = []
+        for colx, kind in _schema_items(schema):
+            values, ctypes = self.getcells(colx, start_row, end_row)
+            columns.append(decode_column(values, ctypes, kind, self.datemode,
+                                         colx, start_row, errors))
+        return columns
+
+    def decode_rows(self, schema, start_row=0, end_row=None, errors=None):
+        """Same as XlSheet.decode_rows."""
+        self._get_mm()
+        return self._iterate(_released_after(
+            self, decode_rows(self, schema, start_row, end_row, errors)
+        ))
+
+    def getcolumns(self, columns=None, start_row=0, end_row=None):
+        """Returns the content of the sheet as a list of columns."""
+        if columns is None:
+            columns = range(self.ncols)
+        end_row = self.nrows if end_row is None else min(end_row, self.nrows)
+        return [self._getcolumn(j, start_row, end_row) for j in columns]
+
+    def _rows(self, start, stop, step, columns):
+        colxs = range(self.ncols) if columns is None else columns
+        chunk_rows = self.CHUNK_ROWS * step
+        for first in range(start, stop, chunk_rows):
+            last = min(first + chunk_rows, stop)
+            chunk = [self._getcolumn(j, first, last, True)[::step]
+                     for j in colxs]
+            for values in zip(*chunk):
+                yield list(values)
+
+    def _iterate(self, rows):
+        if self.instrument:
+            return self.instrument.iterate('read', rows, cells=True)
+        return rows
+
+    def __len__(self):
+        return self.nrows
+
+    def __iter__(self):
+        return self.iter_window()
+
+    def __getitem__(self, index):
+        self._get_mm()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.nrows)
+            if step < 0:
+                return [self[i] for i in range(start, stop, step)]
+            return list(self._rows(start, stop, step, None))
+
+        rowx = index + self.nrows if index < 0 else index
+        if not 0 <= rowx < self.nrows:
+            raise IndexError('Row index out of range: %s' % (index,))
+        return [self._getcolumn(j, rowx, rowx + 1, True)[0]
+                for j in range(self.ncols)]
+
+    def iter_window(self, start=0, stop=None, step=1, columns=None):
+        """Returns a generator over every step-th row from start up to stop,
+        independent of any other generator over the sheet.
+        """
+        if step < 1:
+            raise ValueError('step must be positive')
+        if start < 0:
+            raise ValueError('start must not be negative')
+
+        self._get_mm()
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+        return self._iterate(self._rows(start, stop, step, columns))
+
+    def getrows(self, start_row=0, columns=None):
+        """Returns a generator over the rows of the sheet; rows are built a
+        chunk of rows at a time from the cached columns. Without start_row or
+        columns, the generator is the one shared with `getrow`.
+        """
+        self._get_mm()
+        rows = self._iterate(_released_after(
+            self, self._rows(start_row, self.nrows, 1, columns)
+        ))
+        if start_row > 0 or columns is not None:
+            return rows
+        if self._rows_gen is None:
+            self._rows_gen = _SharedRows(rows)
+        return self._rows_gen
+
+    def getrow(self):
+        return next(self.getrows())
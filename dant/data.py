@@ -4,23 +4,224 @@ Defines data structures to help with data analysis.
 import os
 import xlrd
 
+from array import array
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# cell types whose values xlrd reports as floats
+NUMERIC_CELL_TYPES = (xlrd.XL_CELL_NUMBER, xlrd.XL_CELL_DATE)
+EMPTY_CELL_TYPES = (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK)
+
+# formats tried in turn on text cells decoded as dates
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d-%b-%Y',
+                '%Y-%m-%d %H:%M:%S')
+
+# number of rows decoded at a time by decode_rows
+DECODE_CHUNK_ROWS = 4096
+
+# workbooks streamed by dant.xlsx.XlsxSheet rather than read by xlrd
+XLSX_EXTENSIONS = ('.xlsx', '.xlsm')
+
+# text files read by dant.delimited.DelimitedSheet
+DELIMITED_EXTENSIONS = ('.csv', '.tsv', '.tab')
+
+CellError = namedtuple('CellError', 'row col value reason')
+
+
+def _strip_values(values):
+    return [v.strip() if isinstance(v, string_types) else v for v in values]
+
+
+def _check_cell(value, ctype):
+    if ctype == xlrd.XL_CELL_ERROR:
+        raise ValueError('cell error %s' % (
+            xlrd.error_text_from_code.get(value, value),))
+
+
+def _to_float(value, ctype, datemode):
+    _check_cell(value, ctype)
+    if ctype == xlrd.XL_CELL_TEXT:
+        return float(value.strip().replace(',', ''))
+    return float(value)
+
+
+def _to_int(value, ctype, datemode):
+    number = _to_float(value, ctype, datemode)
+    if not number.is_integer():
+        raise ValueError('not a whole number: %s' % (value,))
+    return int(number)
+
+
+def _to_decimal(value, ctype, datemode):
+    _check_cell(value, ctype)
+    if ctype == xlrd.XL_CELL_TEXT:
+        return Decimal(value.strip().replace(',', ''))
+    return Decimal(repr(float(value)))
+
+
+def _to_str(value, ctype, datemode):
+    _check_cell(value, ctype)
+    if ctype == xlrd.XL_CELL_TEXT:
+        return value.strip()
+    if ctype == xlrd.XL_CELL_DATE:
+        return _to_date(value, ctype, datemode).isoformat()
+    if ctype == xlrd.XL_CELL_BOOLEAN:
+        return u'TRUE' if value else u'FALSE'
+    # numeric account, meter & phone numbers come without the trailing .0
+    return u'%d' % value if float(value).is_integer() else repr(value)
+
+
+def _to_date(value, ctype, datemode):
+    _check_cell(value, ctype)
+    if ctype != xlrd.XL_CELL_TEXT:
+        return datetime(*xlrd.xldate_as_tuple(value, datemode))
+
+    text = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError('not a date: %s' % (value,))
+
+
+# decoders by column type; each raises ValueError for cells it can't decode
+DECODERS = {
+    'int': _to_int, 'float': _to_float, 'decimal': _to_decimal,
+    'str': _to_str, 'date': _to_date,
+}
+
+
+def _schema_items(schema):
+    # (column index, column type) pairs of a dict or list of column types
+    items = sorted(schema.items()) if isinstance(schema, dict) else [
+        (colx, kind) for colx, kind in enumerate(schema) if kind is not None
+    ]
+    for colx, kind in items:
+        if kind not in DECODERS:
+            raise ValueError('Unknown column type: %s' % (kind,))
+    return items
+
+
+def decode_column(values, ctypes, kind, datemode=0, colx=0, start_row=0,
+                  errors=None):
+    """Decodes the values of a column to a column type using the xlrd cell
+    types of the values. Empty cells decode to None, or '' for 'str'
+    columns, and so do bad cells, which are appended to errors as CellError
+    objects when a list is provided.
+    """
+    if all(t == xlrd.XL_CELL_NUMBER for t in ctypes):
+        if kind == 'float':
+            return list(values)
+        if kind == 'int' and all(v.is_integer() for v in values):
+            return [int(v) for v in values]
+
+    decode, empty = DECODERS[kind], (u'' if kind == 'str' else None)
+    result = []
+    for i, (value, ctype) in enumerate(zip(values, ctypes)):
+        if ctype in EMPTY_CELL_TYPES or (
+                ctype == xlrd.XL_CELL_TEXT and not value.strip()):
+            result.append(empty)
+            continue
+        try:
+            result.append(decode(value, ctype, datemode))
+        except (ValueError, ArithmeticError) as ex:
+            result.append(empty)
+            if errors is not None:
+                errors.append(CellError(start_row + i, colx, value, str(ex)))
+    return result
+
+
+def _decode_chunk(cells, kinds, colxs, datemode, first, errors):
+    # decodes the (values, cell types) pairs of a chunk of columns; columns
+    # without a column type are only stripped
+    return [
+        decode_column(values, ctypes, kind, datemode, colx, first, errors)
+        if kind else _strip_values(values)
+        for (values, ctypes), kind, colx in zip(cells, kinds, colxs)
+    ]
+
+
+def decode_rows(xlsheet, schema, start_row=0, end_row=None, errors=None):
+    """Yields the rows of a sheet with the columns in the schema decoded, a
+    chunk of rows at a time; other columns are read as `getrows` reads them.
+    See XlSheet.decode_rows.
+    """
+    kinds = dict(_schema_items(schema))
+    kinds = [kinds.get(colx) for colx in range(xlsheet.ncols)]
+    end_row = xlsheet.nrows if end_row is None else min(end_row,
+                                                         xlsheet.nrows)
+    for first in range(start_row, end_row, DECODE_CHUNK_ROWS):
+        last = min(first + DECODE_CHUNK_ROWS, end_row)
+        cells = [xlsheet.getcells(colx, first, last)
+                 for colx in range(xlsheet.ncols)]
+        columns = _decode_chunk(cells, kinds, range(xlsheet.ncols),
+                                xlsheet.datemode, first, errors)
+        for values in zip(*columns):
+            yield list(values)
+
+
+
+def _released_after(xlsheet, rows):
+    # releases an on demand sheet once the rows are used up
+    for row in rows:
+        yield row
+    if xlsheet.on_demand:
+        xlsheet.release()
+
+
+class _SharedRows(object):
+    # the rows generator shared by XlSheet.getrows & getrow; keeps the
+    # python 2 style `next` method of generators on python 3 as well
+    
+    def __init__(self, rows):
+        self._rows = rows
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self._rows)
+    
+    next = __next__
+    
+    def close(self):
+        self._rows.close()
 
 
 class XlSheet(object):
     """Represents a thin wrapper over the xlrd.sheet.Sheet object.
     
     It's especially useful for iterating over the content of a worksheet where
-    rows are presented as lists
+    rows are presented as lists. Rows can also be read by index or slice, as
+    in `xlsheet[5]` or `xlsheet[10:20]`, and over windows with `iter_window`
     
     :: source: this can either be a xlrd.Book object or path to an .xls file.
+    :: on_demand: when True, a workbook opened from a path is opened with only
+           the requested sheet loaded, and the sheet is unloaded once the rows
+           generator is used up or `release` is called.
+    :: use_mmap: when True, a workbook opened from a path is memory-mapped
+           instead of being read into memory.
+    :: instrument: optional dant.instrument.Instrument recording the rows and
+           cells read by `getrows` under the 'read' stage.
     """
     
-    def __init__(self, source, sheet_name):
+    def __init__(self, source, sheet_name, on_demand=False, use_mmap=True,
+                 instrument=None):
         workbook = source if type(source) is xlrd.book.Book else None
         if not workbook and type(source) is str:
             if not os.path.isfile(source):
                 raise IOError('File not found: %s' % (source,))
-            workbook = xlrd.open_workbook(source)
+            workbook = xlrd.open_workbook(
+                source, on_demand=on_demand, use_mmap=use_mmap
+            )
         
         if not workbook:
             raise ValueError(
@@ -29,32 +230,386 @@ class XlSheet(object):
             )
         
         if not sheet_name in workbook.sheet_names():
+            if workbook is not source:
+                workbook.release_resources()
             raise ValueError("Sheet not found: %s" % (workbook.sheet_names()))
         self._sheet = workbook.sheet_by_name(sheet_name)
+        self._book = workbook
+        self._datemode = workbook.datemode
+        self._owns_book = workbook is not source
+        self._nrows, self._ncols = self._sheet.nrows, self._sheet.ncols
         self.sheet_name = sheet_name
+        self.on_demand = on_demand
+        self.instrument = instrument
         self.__rows_gen = None
     
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+    
     @property
     def nrows(self):
-        return self._sheet.nrows
+        return self._nrows
     
     @property
     def ncols(self):
-        return self._sheet.ncols
+        return self._ncols
+    
+    @property
+    def released(self):
+        return self._sheet is None
+    
+    def release(self):
+        """Unloads the sheet and, for a workbook opened by this object, frees
+        the resources held by the workbook. The sheet can't be read afterwards.
+        """
+        if self._sheet is None:
+            return
+        
+        self._sheet = None
+        if self._book.on_demand:
+            self._book.unload_sheet(self.sheet_name)
+        if self._owns_book:
+            self._book.release_resources()
+        self._book = None
+    
+    def _get_sheet(self):
+        if self._sheet is None:
+            raise ValueError('Sheet already released: %s' % (self.sheet_name,))
+        return self._sheet
+    
+    def __len__(self):
+        return self.nrows
     
-    def getrows(self, start_row=0):
+    def __iter__(self):
+        return self.iter_window()
+    
+    def __getitem__(self, index):
+        """Returns a row by index or a list of rows by slice; only the rows
+        asked for are read.
+        """
+        sheet = self._get_sheet()
+        if isinstance(index, slice):
+            return [_strip_values(sheet.row_values(i))
+                    for i in range(*index.indices(self.nrows))]
+        
+        rowx = index + self.nrows if index < 0 else index
+        if not 0 <= rowx < self.nrows:
+            raise IndexError('Row index out of range: %s' % (index,))
+        return _strip_values(sheet.row_values(rowx))
+    
+    def _iterate(self, rows):
+        if self.instrument:
+            return self.instrument.iterate('read', rows, cells=True)
+        return rows
+    
+    def iter_window(self, start=0, stop=None, step=1, columns=None):
+        """Returns a generator over every step-th row from start up to stop,
+        independent of any other generator over the sheet, such as for
+        handing out row ranges to workers.
+        
+        :: columns: optional list of column indexes to project each row onto.
+        """
+        if step < 1:
+            raise ValueError('step must be positive')
+        if start < 0:
+            raise ValueError('start must not be negative')
+        
+        sheet = self._get_sheet()
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+        def window_gen():
+            for i in range(start, stop, step):
+                values = sheet.row_values(i)
+                if columns is not None:
+                    values = [values[j] for j in columns]
+                yield _strip_values(values)
+        return self._iterate(window_gen())
+    
+    def getrows(self, start_row=0, columns=None):
+        """Returns a generator over the rows of the sheet.
+        
+        Rows are read a whole row at a time rather than one cell at a time.
+        Without start_row or columns, the generator is the one shared with
+        `getrow`; otherwise a generator of its own is returned.
+        
+        :: start_row: index of the first row to read.
+        :: columns: optional list of column indexes to project each row onto.
+        """
+        sheet = self._get_sheet()
         def rows_gen():
             for i in range(start_row, self.nrows):
-                row = []
-                for j in range(self.ncols):
-                    value = self._sheet.cell_value(i, j)
-                    row.append(value.strip() if type(value) is str else value)
-                yield row
-                
+                values = sheet.row_values(i)
+                if columns is not None:
+                    values = [values[j] for j in columns]
+                yield _strip_values(values)
+            
+            if self.on_demand:
+                self.release()
         
-        if self.__rows_gen is None or start_row > 0:
-            self.__rows_gen = rows_gen()
+        if start_row > 0 or columns is not None:
+            return self._iterate(rows_gen())
+        if self.__rows_gen is None:
+            self.__rows_gen = _SharedRows(self._iterate(rows_gen()))
         return self.__rows_gen
      
     def getrow(self):
-        return self.getrows().next()
+        return next(self.getrows())
+    
+    @property
+    def datemode(self):
+        return self._datemode
+    
+    def getcells(self, colx, start_row=0, end_row=None):
+        """Returns the values and xlrd cell types of a column."""
+        sheet = self._get_sheet()
+        return (sheet.col_values(colx, start_row, end_row),
+                sheet.col_types(colx, start_row, end_row))
+    
+    def decode_columns(self, schema, start_row=0, end_row=None, errors=None):
+        """Returns the columns in the schema decoded to their column types,
+        in the order of their indexes.
+        
+        :: schema: dict of column index to column type or a list of column
+               types by index, None for columns not decoded; column types are
+               'int', 'float', 'decimal', 'str' and 'date'.
+        :: errors: optional list bad cells are appended to as CellError
+               objects; bad cells decode to None ('' for 'str' columns).
+        """
+        columns = []
+        for colx, kind in _schema_items(schema):
+            values, ctypes = self.getcells(colx, start_row, end_row)
+            columns.append(decode_column(values, ctypes, kind, self.datemode,
+                                         colx, start_row, errors))
+        return columns
+    
+    def decode_rows(self, schema, start_row=0, end_row=None, errors=None):
+        """Returns a generator over rows with the columns in the schema
+        decoded; columns are decoded in bulk a chunk of rows at a time. See
+        `decode_columns` for the schema and errors.
+        """
+        self._get_sheet()
+        return self._iterate(_released_after(
+            self, decode_rows(self, schema, start_row, end_row, errors)
+        ))
+    
+    def getcolumns(self, columns=None, start_row=0, end_row=None):
+        """Returns the content of the sheet as a list of column arrays.
+        
+        Columns holding only numeric cells are returned as array('d') objects
+        while other columns are returned as lists with strings stripped.
+        
+        :: columns: optional list of column indexes to read; defaults to all.
+        :: start_row: index of the first row to read.
+        :: end_row: index of the row to stop at (exclusive); defaults to nrows.
+        """
+        if columns is None:
+            columns = range(self.ncols)
+        return [self._getcolumn(j, start_row, end_row) for j in columns]
+    
+    def _getcolumn(self, colx, start_row, end_row):
+        sheet = self._get_sheet()
+        values = sheet.col_values(colx, start_row, end_row)
+        types = sheet.col_types(colx, start_row, end_row)
+        if values and all(t in NUMERIC_CELL_TYPES for t in types):
+            return array('d', values)
+        return _strip_values(values)
+
+
+class _StreamedSheet(object):
+    # the reading methods of XlSheet for sheets parsed as they are read,
+    # each read a pass from the top; subclasses provide `_cells(start,
+    # stop)` yielding (values, xlrd cell types) per row, where rows may be
+    # shorter than ncols, along with `_check_open`, `release`, nrows, ncols
+    # and datemode
+    
+    def __init__(self, on_demand=False, instrument=None):
+        self.on_demand = on_demand
+        self.instrument = instrument
+        self.__rows_gen = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+    
+    def __len__(self):
+        return self.nrows
+    
+    def __iter__(self):
+        return self.iter_window()
+    
+    def _close_rows(self):
+        # closes the shared rows generator, which keeps the file it reads
+        # open when left part way through; called by release
+        if self.__rows_gen is not None:
+            self.__rows_gen.close()
+            self.__rows_gen = None
+    
+    def __getitem__(self, index):
+        """Returns a row by index or a list of rows by slice; a pass over the
+        sheet up to the last row asked for.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.nrows)
+            if step > 0:
+                return list(self.iter_window(start, stop, step))
+            
+            # read forwards from the last row asked for, then reversed
+            rowxs = range(start, stop, step)
+            if not rowxs:
+                return []
+            return list(self.iter_window(rowxs[-1], start + 1, -step))[::-1]
+        
+        rowx = index + self.nrows if index < 0 else index
+        if not 0 <= rowx < self.nrows:
+            raise IndexError('Row index out of range: %s' % (index,))
+        return next(self.iter_window(rowx, rowx + 1))
+    
+    def _iterate(self, rows):
+        if self.instrument:
+            return self.instrument.iterate('read', rows, cells=True)
+        return rows
+    
+    def _row(self, values):
+        # a row as read; sources parsing rows stripped return them as is
+        return _strip_values(values)
+    
+    def iter_window(self, start=0, stop=None, step=1, columns=None):
+        """Same as XlSheet.iter_window."""
+        if step < 1:
+            raise ValueError('step must be positive')
+        if start < 0:
+            raise ValueError('start must not be negative')
+        
+        self._check_open()
+        def window_gen():
+            for i, (values, _) in enumerate(self._cells(start, stop)):
+                if not i % step:
+                    yield self._row(_project(values, columns))
+        return self._iterate(window_gen())
+    
+    def getrows(self, start_row=0, columns=None):
+        """Same as XlSheet.getrows."""
+        self._check_open()
+        def rows_gen():
+            for values, _ in self._cells(start_row):
+                yield self._row(_project(values, columns))
+            
+            if self.on_demand:
+                self.release()
+        
+        if start_row > 0 or columns is not None:
+            return self._iterate(rows_gen())
+        if self.__rows_gen is None:
+            self.__rows_gen = _SharedRows(self._iterate(rows_gen()))
+        return self.__rows_gen
+    
+    def getrow(self):
+        return next(self.getrows())
+    
+    def getcells(self, colx, start_row=0, end_row=None):
+        """Same as XlSheet.getcells; a pass over the sheet per call."""
+        values, ctypes = [], []
+        for row_values, row_ctypes in self._cells(start_row, end_row):
+            if colx < len(row_values):
+                values.append(row_values[colx])
+                ctypes.append(row_ctypes[colx])
+            else:
+                values.append(u'')
+                ctypes.append(xlrd.XL_CELL_EMPTY)
+        return values, ctypes
+    
+    def decode_columns(self, schema, start_row=0, end_row=None, errors=None):
+        """Same as XlSheet.decode_columns; the columns are read in one pass
+        over the sheet.
+        """
+        kinds = _schema_items(schema)
+        rows = list(self._cells(start_row, end_row))
+        return _decode_chunk(
+            [_column_cells(rows, colx) for colx, _ in kinds],
+            [kind for _, kind in kinds], [colx for colx, _ in kinds],
+            self.datemode, start_row, errors
+        )
+    
+    def decode_rows(self, schema, start_row=0, end_row=None, errors=None):
+        """Same as XlSheet.decode_rows, decoding a chunk of rows at a time as
+        the rows are parsed.
+        """
+        kinds = dict(_schema_items(schema))
+        self._check_open()
+        def decode_gen():
+            chunk, first = [], start_row
+            for cells in self._cells(start_row, end_row):
+                chunk.append(cells)
+                if len(chunk) == DECODE_CHUNK_ROWS:
+                    for row in self._decode(chunk, kinds, first, errors):
+                        yield row
+                    first += len(chunk)
+                    chunk = []
+            for row in self._decode(chunk, kinds, first, errors):
+                yield row
+        return self._iterate(_released_after(self, decode_gen()))
+    
+    def _decode(self, chunk, kinds, first, errors):
+        # only the columns decoded are taken out of the rows; short rows are
+        # padded to the last column decoded
+        width = max(kinds) + 1 if kinds else 0
+        rows = [self._row(values) + [u''] * (width - len(values))
+                for values, _ in chunk]
+        for colx, kind in kinds.items():
+            values, ctypes = _column_cells(chunk, colx)
+            decoded = decode_column(values, ctypes, kind, self.datemode, colx,
+                                    first, errors)
+            for row, value in zip(rows, decoded):
+                row[colx] = value
+        return rows
+    
+    def getcolumns(self, columns=None, start_row=0, end_row=None):
+        """Same as XlSheet.getcolumns; the columns are read in one pass over
+        the sheet.
+        """
+        rows = list(self._cells(start_row, end_row))
+        if columns is None:
+            columns = range(self.ncols)
+        found = [_column_cells(rows, colx) for colx in columns]
+        del rows
+        return [
+            array('d', values) if values and all(
+                t in NUMERIC_CELL_TYPES for t in ctypes
+            ) else _strip_values(values)
+            for values, ctypes in found
+        ]
+
+
+def _project(values, columns):
+    # the values of a row at the column indexes, '' past the end of the row
+    if columns is None:
+        return values
+    return [values[j] if j < len(values) else u'' for j in columns]
+
+
+def _column_cells(rows, colx):
+    # the (values, cell types) of a column of (values, cell types) rows
+    return ([r[0][colx] if colx < len(r[0]) else u'' for r in rows],
+            [r[1][colx] if colx < len(r[1]) else xlrd.XL_CELL_EMPTY
+             for r in rows])
+
+
+def open_sheet(source, sheet_name, on_demand=False, instrument=None):
+    """Returns a dant.xlsx.XlsxSheet streaming the sheet for .xlsx paths, a
+    dant.delimited.DelimitedSheet for .csv and .tsv paths, whose sheet name
+    is ignored, and an XlSheet otherwise; all read sheets the same way.
+    """
+    ext = (os.path.splitext(source)[1].lower()
+           if isinstance(source, string_types) else None)
+    if ext in XLSX_EXTENSIONS:
+        from .xlsx import XlsxSheet
+        return XlsxSheet(source, sheet_name, on_demand, instrument)
+    if ext in DELIMITED_EXTENSIONS:
+        from .delimited import DelimitedSheet
+        return DelimitedSheet(source, on_demand=on_demand,
+                              instrument=instrument)
+    return XlSheet(source, sheet_name, on_demand, instrument=instrument)
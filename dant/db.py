@@ -0,0 +1,618 @@
+"""
+Defines helpers for moving data into and out of a database.
+"""
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+
+class BatchInserter(object):
+    """Collects rows and sends them to the database in batches with a single
+    `executemany` call per batch rather than one `execute` call per row.
+
+    pyodbc's `fast_executemany` is turned on for cursors supporting it and the
+    connection is committed every `commit_every` batches so a failure only
+    loses the rows sent since the last commit.
+
+    :: conn: a DB-API connection object.
+    :: text: the parameterized insert statement.
+    :: batch_size: number of rows sent per `executemany` call.
+    :: commit_every: number of batches sent between commits.
+    :: on_commit: optional function called after each commit with the mark
+           of the last committed row; see `add`.
+    :: instrument: optional dant.instrument.Instrument recording the round
+           trips under the 'insert' stage and the commits under 'commit'.
+    """
+
+    def __init__(self, conn, text, batch_size=1000, commit_every=10,
+                 on_commit=None, instrument=None):
+        if batch_size < 1 or commit_every < 1:
+            raise ValueError('batch_size and commit_every must be positive')
+
+        self.conn = conn
+        self.text = text
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.on_commit = on_commit
+        self.instrument = instrument
+        self.rows_sent = 0
+        self.rows_committed = 0
+        self.batches_sent = 0
+        self._rows = []
+        self._mark = self._sent_mark = None
+        self._cursor = conn.cursor()
+        if hasattr(self._cursor, 'fast_executemany'):
+            self._cursor.fast_executemany = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._cursor.close()
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    def add(self, row, mark=None):
+        """Collects a row, sending the batch once full. The mark, such as the
+        index of the source row, is handed to `on_commit` once committed.
+        """
+        self._rows.append(row)
+        if mark is not None:
+            self._mark = mark
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Sends the collected rows and commits if a commit is due."""
+        if not self._rows:
+            return
+
+        rows, self._rows = self._rows, []
+        if self.instrument:
+            with self.instrument.timer('insert'):
+                self._cursor.executemany(self.text, rows)
+            self.instrument.count('insert', 'round_trips')
+            self.instrument.count('insert', 'rows', len(rows))
+        else:
+            self._cursor.executemany(self.text, rows)
+        self.rows_sent += len(rows)
+        self._sent_mark = self._mark
+        self.batches_sent += 1
+        if self.batches_sent % self.commit_every == 0:
+            self.commit()
+
+    def commit(self):
+        if self.instrument:
+            with self.instrument.timer('commit'):
+                self.conn.commit()
+            self.instrument.count('commit', 'commits')
+        else:
+            self.conn.commit()
+        self.rows_committed = self.rows_sent
+        if self.on_commit and self._sent_mark is not None:
+            self.on_commit(self._sent_mark)
+
+    def close(self):
+        """Sends the rows left, commits and closes the cursor."""
+        self.flush()
+        self.commit()
+        self._cursor.close()
+
+
+# pragmas set by sqlite_fast_load: the rollback journal kept in memory, so
+# that a failed load can still be rolled back, and no syncing to disk,
+# which leaves a database rebuilt from scratch on a crash anyway
+SQLITE_FAST_LOAD_PRAGMAS = (
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', -262144),    # 256MB
+    ('temp_store', 'MEMORY'),
+)
+
+
+@contextmanager
+def sqlite_fast_load(conn, pragmas=SQLITE_FAST_LOAD_PRAGMAS):
+    """Sets pragmas suited to bulk loading a SQLite database for the duration
+    of the block and restores the previous settings on leaving it. Pending
+    work is committed on entering, and on leaving unless the block raises,
+    in which case work not committed by the block is rolled back.
+    """
+    conn.commit()
+    saved = [(name, conn.execute('PRAGMA %s' % name).fetchone()[0])
+             for name, _ in pragmas]
+    for name, value in pragmas:
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        for name, value in saved:
+            conn.execute('PRAGMA %s = %s' % (name, value))
+
+
+class CheckpointStore(object):
+    """Records the last committed source row per (file, sheet, target) in a
+    SQLite sidecar file so that an interrupted load can be resumed.
+
+    A checkpoint is ignored once the size or modification time of the source
+    file changes.
+    """
+
+    DB_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        source        VARCHAR(250),
+        sheet         VARCHAR(100),
+        target        VARCHAR(100),
+        signature     VARCHAR(50),
+        row           INT,
+        updated       VARCHAR(20),
+        PRIMARY KEY (source, sheet, target)
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(self.DB_SCRIPT)
+
+    def close(self):
+        self._conn.close()
+
+    def _key(self, source, sheet, target):
+        return (os.path.abspath(source), sheet, target)
+
+    def _signature(self, source):
+        if not os.path.isfile(source):
+            return ''
+        stat = os.stat(source)
+        return '%s:%s' % (stat.st_size, int(stat.st_mtime))
+
+    def get(self, source, sheet, target):
+        """Returns the index of the last committed row or None."""
+        found = self._conn.execute(
+            "SELECT row, signature FROM checkpoints "
+            "WHERE source = ? AND sheet = ? AND target = ?",
+            self._key(source, sheet, target)
+        ).fetchone()
+        if found and found[1] == self._signature(source):
+            return found[0]
+        return None
+
+    def set(self, source, sheet, target, row):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)",
+                self._key(source, sheet, target) + (
+                    self._signature(source), row,
+                    time.strftime('%Y-%m-%d %H:%M:%S')
+                )
+            )
+
+    def clear(self, source, sheet, target):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM checkpoints "
+                "WHERE source = ? AND sheet = ? AND target = ?",
+                self._key(source, sheet, target)
+            )
+
+
+class ChangeTracker(object):
+    """Keeps a content hash per record in a SQLite file so that a rerun only
+    handles the records which are new or have changed since the last run.
+
+    Hashes of the records passed on are held until `save` is called, which
+    should be once they have been written successfully.
+
+    :: path: path to the SQLite file holding the hashes.
+    :: scope: name under which the hashes are kept, e.g. the target table.
+    :: version: version of the rules applied to the records; hashes stored
+           under another version are treated as changed.
+    """
+
+    DB_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS record_hashes (
+        scope         VARCHAR(100),
+        key           VARCHAR(100),
+        digest        VARCHAR(40),
+        PRIMARY KEY (scope, key)
+    );
+    """
+
+    def __init__(self, path, scope, version=1):
+        self.path = path
+        self.scope = '%s@%s' % (scope, version)
+        self.changed = 0
+        self.skipped = 0
+        self._pending = []
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(self.DB_SCRIPT)
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def digest(values):
+        return hashlib.sha1(repr(tuple(values)).encode('utf-8')).hexdigest()
+
+    def filter(self, records, key, values):
+        """Yields the records which are new or have changed.
+
+        :: key: function returning the key of a record.
+        :: values: function returning the values of a record to hash.
+        """
+        stored = dict(self._conn.execute(
+            "SELECT key, digest FROM record_hashes WHERE scope = ?",
+            (self.scope,)
+        ).fetchall())
+
+        for record in records:
+            rkey = str(key(record))
+            digest = self.digest(values(record))
+            if stored.get(rkey) == digest:
+                self.skipped += 1
+                continue
+
+            self.changed += 1
+            self._pending.append((self.scope, rkey, digest))
+            yield record
+
+    def save(self):
+        """Records the hashes of the records passed on."""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO record_hashes VALUES (?, ?, ?)",
+                self._pending
+            )
+        self._pending = []
+
+
+class ConnectionPool(object):
+    """Hands out DB-API connections, opening them lazily up to `size` and
+    taking them back for reuse once released.
+
+    :: connect: a function returning a new connection.
+    :: size: maximum number of connections opened at a time.
+    :: health_check: optional statement run on an idle connection before it
+           is handed out again; connections failing it are discarded.
+    :: timeout: seconds to wait for a connection when all are in use; None
+           waits indefinitely.
+    """
+
+    def __init__(self, connect, size=4, health_check=None, timeout=None):
+        if size < 1:
+            raise ValueError('size must be positive')
+
+        self.connect = connect
+        self.size = size
+        self.health_check = health_check
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = []
+        self._cond = threading.Condition()
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def acquire(self):
+        """Returns an idle connection which passes the health check or a new
+        connection if there is room in the pool.
+        """
+        while True:
+            conn = self._take()
+            if conn is None:
+                break
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self.opened -= 1
+                self._cond.notify()
+            raise
+
+    def _take(self):
+        # returns an idle connection or None after reserving room for a new
+        # connection; waits while all connections are in use
+        deadline = (None if self.timeout is None else
+                    time.time() + self.timeout)
+        with self._cond:
+            while not self._idle and self.opened >= self.size:
+                remaining = (None if deadline is None else
+                             deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError(
+                        'No connection available after %ss' % self.timeout
+                    )
+                self._cond.wait(remaining)
+
+            if self._idle:
+                return self._idle.pop()
+            self.opened += 1
+            return None
+
+    def _is_healthy(self, conn):
+        if not self.health_check:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute(self.health_check)
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.opened -= 1
+            self._cond.notify()
+
+    def release(self, conn):
+        """Takes back a connection, rolling back any uncommitted work."""
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self.opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+DmlError = namedtuple('DmlError', 'worker key statement error')
+
+DmlResult = namedtuple('DmlResult', 'passed failed errors')
+
+
+class DmlRunner(object):
+    """Runs DML statements from several worker threads, each having its own
+    connection. Statements are partitioned among the workers by key so that
+    all the statements for a key, such as a customer id, run in order on the
+    same connection and never collide with each other.
+
+    :: connect: a function returning a new DB-API connection.
+    :: workers: number of worker threads (and connections).
+    :: commit_every: maximum number of statements run by a worker between
+           commits; a worker also commits whenever it runs out of work.
+    :: queue_size: maximum number of statements waiting per worker.
+    :: max_errors: maximum number of DmlError objects kept; failures beyond
+           it are only counted.
+    :: on_progress: optional function called with the number of statements
+           run by a worker after each of its commits.
+    """
+
+    def __init__(self, connect, workers=4, commit_every=1000, queue_size=1000,
+                 max_errors=100, on_progress=None):
+        if workers < 1 or commit_every < 1:
+            raise ValueError('workers and commit_every must be positive')
+
+        self.connect = connect
+        self.workers = workers
+        self.commit_every = commit_every
+        self.queue_size = queue_size
+        self.max_errors = max_errors
+        self.on_progress = on_progress
+
+    def run(self, statements):
+        """Runs the statements and returns a DmlResult object.
+
+        :: statements: iterable of (key, statement) pairs, the statement
+               being the text of a query or a (text, params) pair.
+        """
+        self._lock = threading.Lock()
+        self._passed = self._failed = 0
+        self._errors = []
+
+        queues = [Queue(self.queue_size) for _ in range(self.workers)]
+        threads = [
+            threading.Thread(target=self._work, args=(index, queue))
+            for index, queue in enumerate(queues)
+        ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            for key, statement in statements:
+                queues[hash(key) % self.workers].put((key, statement))
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for t in threads:
+                t.join()
+        return DmlResult(self._passed, self._failed, self._errors)
+
+    def _work(self, index, queue):
+        try:
+            conn = self.connect()
+        except Exception as ex:
+            self._fail(DmlError(index, None, None, ex), 0)
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                self._fail(None, 1)
+
+        try:
+            cur = conn.cursor()
+            run = uncommitted = 0
+            while True:
+                # commit before waiting so that locks held by this worker
+                # never stall the other workers and, through them, the feed
+                if uncommitted and queue.empty():
+                    uncommitted = self._commit(index, conn, uncommitted, run)
+                item = queue.get()
+                if item is None:
+                    break
+
+                key, statement = item
+                try:
+                    if isinstance(statement, tuple):
+                        cur.execute(*statement)
+                    else:
+                        cur.execute(statement)
+                    uncommitted += 1
+                except Exception as ex:
+                    self._fail(DmlError(index, key, statement, ex), 1)
+
+                run += 1
+                if run % self.commit_every == 0:
+                    uncommitted = self._commit(index, conn, uncommitted, run)
+            self._commit(index, conn, uncommitted, run)
+        finally:
+            conn.close()
+
+    def _commit(self, index, conn, uncommitted, run):
+        # statements run since the last commit fail with the commit
+        try:
+            conn.commit()
+        except Exception as ex:
+            self._fail(DmlError(index, None, 'COMMIT', ex), uncommitted)
+        else:
+            with self._lock:
+                self._passed += uncommitted
+        if self.on_progress:
+            self.on_progress(run)
+        return 0
+
+    def _fail(self, error, count):
+        with self._lock:
+            self._failed += count
+            if error is not None and len(self._errors) < self.max_errors:
+                self._errors.append(error)
+
+
+class Row(object):
+    """A lightweight view over the values of a fetched row. Fields are read
+    by name, as with a dict, through a name to position map shared by all the
+    rows of a query. Fields not in the query can be added to a row.
+    """
+    __slots__ = ('_index', '_values', '_extra')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        pos = self._index.get(key)
+        if pos is not None:
+            return self._values[pos]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        pos = self._index.get(key)
+        if pos is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+
+        if not isinstance(self._values, list):
+            self._values = list(self._values)
+        self._values[pos] = value
+
+    def __contains__(self, key):
+        return key in self._index or bool(self._extra and key in self._extra)
+
+    def __len__(self):
+        return len(self._index) + len(self._extra or ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return '<Row %r>' % (self.asdict(),)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = sorted(self._index, key=self._index.get)
+        return keys + list(self._extra or ())
+
+    def asdict(self):
+        return dict((k, self[k]) for k in self.keys())
+
+
+def fetch_rows(cursor, arraysize=1000, count=None, instrument=None):
+    """Yields the rows of an executed query as Row objects, fetching them
+    from the server `arraysize` rows at a time.
+
+    :: count: optional maximum number of rows to fetch.
+    :: instrument: optional dant.instrument.Instrument recording the round
+           trips and rows fetched under the 'fetch' stage.
+    """
+    index = dict((d[0], i) for i, d in enumerate(cursor.description))
+    remaining = count
+    while remaining is None or remaining > 0:
+        size = arraysize if remaining is None else min(arraysize, remaining)
+        if instrument:
+            with instrument.timer('fetch'):
+                records = cursor.fetchmany(size)
+            instrument.count('fetch', 'round_trips')
+            instrument.count('fetch', 'rows', len(records))
+        else:
+            records = cursor.fetchmany(size)
+        if not records:
+            break
+
+        if remaining is not None:
+            remaining -= len(records)
+        for record in records:
+            yield Row(index, record)
@@ -0,0 +1,255 @@
+"""
+Defines a finder of likely duplicate records which compares records only
+within blocks of records sharing a blocking key.
+"""
+from __future__ import division
+
+from array import array
+from collections import namedtuple
+from .records import RecordStore
+
+
+
+Field = namedtuple('Field', 'name weight exact')
+
+Cluster = namedtuple('Cluster', 'ids score pairs')
+
+# blocks of more records than this are compared within a sliding window
+MAX_BLOCK_SIZE = 100
+
+# number of following records each record of such blocks is compared to
+BLOCK_WINDOW = 10
+
+# blocking keys are hashed to this many bits, which fit in any array('l')
+_HASH_MASK = 0x7FFFFFFF
+
+
+def bigrams(text):
+    """Returns the set of pairs of adjacent characters of a text, padded with
+    a space at each end.
+    """
+    text = ' %s ' % (text,)
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def _dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def similarity(a, b):
+    """Returns the similarity of two texts between 0 and 1, as the Dice
+    coefficient of their bigrams.
+    """
+    if a == b:
+        return 1.0
+    return _dice(bigrams(a), bigrams(b))
+
+
+class DuplicateFinder(object):
+    """Finds clusters of likely duplicate records.
+
+    Records are added with their blocking keys, one for each kind of key,
+    such as a phone number or a name, and records are only compared to the
+    records sharing one of their keys. Records sharing keys of several kinds
+    are compared once. Blocks of more than max_block_size records, as of
+    common names, are sorted on the first field and each record is compared
+    to the next window records only.
+
+    The score of a pair is the weighted mean of the scores of the fields
+    having values in both records: fuzzy fields score the similarity of
+    their values and exact fields 1 where equal, else 0. Pairs scoring
+    threshold or more are linked and linked records make up a cluster.
+
+    :: fields: Field tuples of the name, weight and exactness of the fields
+           records are compared on.
+    :: keys: number of kinds of blocking keys.
+    :: threshold: lowest score of pairs taken as duplicates.
+    """
+
+    def __init__(self, fields, keys, threshold=0.85,
+                 max_block_size=MAX_BLOCK_SIZE, window=BLOCK_WINDOW):
+        self.fields = tuple(fields)
+        self.keys = keys
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.window = window
+        self.compared = 0
+
+        self._specs = [(f.weight, f.exact) for f in self.fields]
+        self._ids = []
+        self._store = RecordStore([f.name for f in self.fields])
+        # hashed keys of each record in turn, 0 for none
+        self._hashes = array('l')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, recid, values, keys):
+        """Adds a record.
+
+        :: recid: id the record is reported by.
+        :: values: mapping of field names to values, cleansed for comparison.
+        :: keys: blocking keys, one for each kind, None where there's none.
+        """
+        if len(keys) != self.keys:
+            raise ValueError('Expected %s keys, got %s' % (
+                self.keys, len(keys)))
+
+        self._ids.append(recid)
+        self._store.append(values)
+        for kind, key in enumerate(keys):
+            self._hashes.append(
+                0 if key is None else (hash((kind, key)) & _HASH_MASK or 1)
+            )
+
+    def _blocks(self):
+        # returns the blocks, as lists of record positions along with the
+        # kind of their key, and the hashes of the blocks too large to be
+        # compared in full
+        hashes, keys = self._hashes, self.keys
+        entries = sorted((e for e in range(len(hashes)) if hashes[e]),
+                         key=hashes.__getitem__)
+
+        blocks, oversized, start = [], set(), 0
+        for stop in range(1, len(entries) + 1):
+            if (stop < len(entries) and
+                    hashes[entries[stop]] == hashes[entries[start]]):
+                continue
+            if stop - start > 1:
+                block = [e // keys for e in entries[start:stop]]
+                blocks.append((entries[start] % keys, block))
+                if len(block) > self.max_block_size:
+                    oversized.add(hashes[entries[start]])
+            start = stop
+        return blocks, oversized
+
+    def _pairs(self, block):
+        # yields the pairs of positions to compare in a block
+        if len(block) <= self.max_block_size:
+            for i, a in enumerate(block):
+                for b in block[i + 1:]:
+                    yield a, b
+            return
+
+        first = self._store._data[0]
+        block = sorted(block, key=lambda pos: first[pos] or '')
+        for i, a in enumerate(block):
+            for b in block[i + 1:i + 1 + self.window]:
+                yield a, b
+
+    def _features(self, pos, grams):
+        # the values of a record along with the bigrams of fuzzy values,
+        # shared through grams by the records of a block
+        features = []
+        for (_, exact), value in zip(self._specs, self._store.values(pos)):
+            if exact or not value:
+                features.append((value, None))
+                continue
+            if value not in grams:
+                grams[value] = bigrams(value)
+            features.append((value, grams[value]))
+        return features
+
+    def _score(self, a, b):
+        # returns 0 for pairs which can't score the threshold, leaving out
+        # the similarity of fuzzy fields once those can't make up for it
+        total = weight = remaining = 0
+        fuzzy = []
+        for (w, exact), (x, x_grams), (y, y_grams) in zip(self._specs, a, b):
+            if not x or not y:
+                continue
+            weight += w
+            if x == y:
+                total += w
+            elif not exact:
+                fuzzy.append((w, x_grams, y_grams))
+                remaining += w
+        if not weight:
+            return 0.0
+
+        needed = self.threshold * weight
+        for w, x_grams, y_grams in fuzzy:
+            remaining -= w
+            # the similarity is at most that of the shorter text within
+            # the longer one
+            x_len, y_len = len(x_grams), len(y_grams)
+            if total + remaining + w * 2 * min(x_len, y_len) / (
+                    x_len + y_len) < needed:
+                return 0.0
+            total += w * _dice(x_grams, y_grams)
+        return total / weight
+
+    def _matches(self):
+        # yields the (pos, pos, score) of the pairs scoring threshold or more
+        hashes, keys = self._hashes, self.keys
+        blocks, oversized = self._blocks()
+
+        def compared_before(a, b, kind):
+            # whether the pair shares a key of an earlier kind, whose block
+            # compared it in full
+            for k in range(kind):
+                h = hashes[a * keys + k]
+                if h and h == hashes[b * keys + k] and h not in oversized:
+                    return True
+            return False
+
+        matched = set()
+        for kind, block in blocks:
+            features, grams = {}, {}
+            for a, b in self._pairs(block):
+                if a > b:
+                    a, b = b, a
+                if kind and compared_before(a, b, kind):
+                    continue
+
+                for pos in (a, b):
+                    if pos not in features:
+                        features[pos] = self._features(pos, grams)
+                self.compared += 1
+                score = self._score(features[a], features[b])
+                if score >= self.threshold and (a, b) not in matched:
+                    matched.add((a, b))
+                    yield a, b, score
+
+    def pairs(self):
+        """Yields the (recid, recid, score) of the pairs of records scoring
+        threshold or more.
+        """
+        ids = self._ids
+        for a, b, score in self._matches():
+            yield ids[a], ids[b], score
+
+    def find(self):
+        """Returns the clusters of likely duplicate records, as Cluster tuples
+        of the ids of the records, the lowest score of the pairs linking them
+        and the (recid, recid, score) of those pairs.
+        """
+        parents, matches = {}, list(self._matches())
+
+        def root(pos):
+            path = []
+            while parents.get(pos, pos) != pos:
+                path.append(pos)
+                pos = parents[pos]
+            for p in path:
+                parents[p] = pos
+            return pos
+
+        for a, b, _ in matches:
+            ra, rb = root(a), root(b)
+            if ra != rb:
+                parents[max(ra, rb)] = min(ra, rb)
+
+        clusters = {}
+        for a, b, score in matches:
+            clusters.setdefault(root(a), []).append((a, b, score))
+
+        ids, result = self._ids, []
+        for pairs in clusters.values():
+            members = sorted(set(p for a, b, _ in pairs for p in (a, b)))
+            result.append(Cluster(
+                [ids[p] for p in members], min(s for _, _, s in pairs),
+                [(ids[a], ids[b], s) for a, b, s in pairs]
+            ))
+        result.sort(key=lambda c: (-c.score, len(c.ids)))
+        return result
@@ -0,0 +1,274 @@
+"""
+Defines a reader for delimited text files, such as CSV and TSV dumps, which
+parses chunks of a file in parallel worker processes.
+"""
+import codecs
+import csv
+import gc
+import io
+import marshal
+import mmap
+import multiprocessing
+import os
+import xlrd
+
+from collections import deque
+from contextlib import contextmanager
+from .data import _StreamedSheet
+
+
+
+# bytes of a file parsed per chunk by a worker
+CHUNK_BYTES = 1 << 22
+
+# delimiters by file extension
+DELIMITERS = {'.csv': ',', '.tsv': '\t', '.tab': '\t'}
+
+# bytes counted for quotes at a time while splitting a file
+_SCAN_BYTES = 1 << 20
+
+
+def _count(buf, sub, start, end):
+    count = 0
+    for pos in range(start, end, _SCAN_BYTES):
+        count += buf[pos:min(pos + _SCAN_BYTES, end)].count(sub)
+    return count
+
+
+def split_ranges(buf, chunk_bytes=CHUNK_BYTES, start=0, quotechar=b'"'):
+    """Returns the (start, stop) byte ranges splitting a buffer of delimited
+    text, such as an mmap, into chunks of about chunk_bytes made of whole
+    records.
+
+    A line break only ends a record outside quotes, that is where the count
+    of quote characters ahead of it is even, as quotes within quoted values
+    are doubled.
+    """
+    size = len(buf)
+    ranges, counted, quotes = [], start, 0
+    while start < size:
+        if start + chunk_bytes >= size:
+            ranges.append((start, size))
+            break
+
+        stop = buf.find(b'\n', start + chunk_bytes)
+        while stop >= 0 and quotechar:
+            quotes += _count(buf, quotechar, counted, stop)
+            counted = stop
+            if not quotes % 2:
+                break
+            stop = buf.find(b'\n', stop + 1)
+        if stop < 0:
+            ranges.append((start, size))
+            break
+        ranges.append((start, stop + 1))
+        start = stop + 1
+    return ranges
+
+
+@contextmanager
+def _gc_paused():
+    # the cyclic garbage collector finds nothing in rows of strings but
+    # slows down building them severalfold
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _parse_range(args):
+    # returns the rows in a byte range of a file, stripped
+    path, start, stop, delimiter, quotechar, encoding = args
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = buf[start:stop]
+        finally:
+            buf.close()
+
+    with _gc_paused():
+        if str is bytes:    # csv reads bytes on python 2
+            reader = csv.reader(io.BytesIO(data), delimiter=delimiter,
+                                quotechar=quotechar)
+            return [[v.decode(encoding).strip() for v in row]
+                    for row in reader]
+        reader = csv.reader(io.StringIO(data.decode(encoding), newline=''),
+                            delimiter=delimiter, quotechar=quotechar)
+        return [[v.strip() for v in row] for row in reader]
+
+
+def _parse_range_packed(args):
+    # runs in a worker process; the rows go back marshalled, which costs
+    # both processes far less than pickling them
+    return marshal.dumps(_parse_range(args))
+
+
+def _unpack(data):
+    with _gc_paused():
+        return marshal.loads(data)
+
+
+def _count_range(args):
+    # returns the number of rows and the number
+    # of values of the longest row in a byte range
+    rows = _parse_range(args)
+    return len(rows), max([len(r) for r in rows] or [0])
+
+
+class _TextCellTypes(object):
+    # the xlrd cell types of a row of text values, worked out as asked for
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, colx):
+        return xlrd.XL_CELL_TEXT if self.values[colx] else xlrd.XL_CELL_EMPTY
+
+
+class DelimitedSheet(_StreamedSheet):
+    """Reads a delimited text file as a sheet; presents the same reading
+    methods as dant.data.XlSheet, with all values read as stripped text.
+
+    The file is memory-mapped and split into chunks of whole records which
+    are parsed in a pool of worker processes, a few chunks ahead of the
+    reader, and read back in file order. Rows keep the number of values of
+    their record, so they can be shorter than ncols; nrows and ncols take a
+    pass over the file the first time they are asked for.
+
+    :: source: path to the file.
+    :: delimiter: defaults to the one for the file extension, else ','.
+    :: encoding: encoding of the file; a UTF-8 byte order mark is skipped.
+    :: processes: number of worker processes; defaults to the cpu count.
+           Files of a single chunk are parsed without workers.
+    :: chunk_bytes: bytes of the file parsed per chunk.
+    :: on_demand, instrument: same as for XlSheet.
+    """
+
+    def __init__(self, source, delimiter=None, quotechar='"',
+                 encoding='utf-8', processes=None, chunk_bytes=CHUNK_BYTES,
+                 on_demand=False, instrument=None):
+        if not os.path.isfile(source):
+            raise IOError('File not found: %s' % (source,))
+
+        super(DelimitedSheet, self).__init__(on_demand, instrument)
+        self.source = source
+        self.sheet_name = os.path.basename(source)
+        self.delimiter = delimiter or DELIMITERS.get(
+            os.path.splitext(source)[1].lower(), ',')
+        self.quotechar = quotechar
+        self.encoding = encoding
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+        self._size = None
+
+        with open(source, 'rb') as f:
+            # an empty file can't be memory-mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                self._ranges = []
+            else:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    start = (len(codecs.BOM_UTF8)
+                             if buf[:3] == codecs.BOM_UTF8 else 0)
+                    self._ranges = split_ranges(
+                        buf, chunk_bytes, start,
+                        quotechar.encode('ascii') if quotechar else None
+                    )
+                finally:
+                    buf.close()
+        self._released = False
+
+    @property
+    def nrows(self):
+        return self._get_size()[0]
+
+    @property
+    def ncols(self):
+        return self._get_size()[1]
+
+    @property
+    def datemode(self):
+        return 0
+
+    @property
+    def released(self):
+        return self._released
+
+    def release(self):
+        """Stops the worker processes. The file can't be read afterwards."""
+        self._released = True
+        self._close_rows()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _row(self, values):
+        # stripped by the workers
+        return values
+
+    def _check_open(self):
+        if self._released:
+            raise ValueError('Sheet already released: %s' %
+                             (self.sheet_name,))
+
+    def _args(self):
+        return [(self.source, start, stop, self.delimiter, self.quotechar,
+                 self.encoding) for start, stop in self._ranges]
+
+    def _get_pool(self):
+        self._check_open()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def _get_size(self):
+        if self._size is None:
+            if len(self._ranges) > 1 and self.processes > 1:
+                counts = self._get_pool().map(_count_range, self._args())
+            else:
+                counts = [_count_range(args) for args in self._args()]
+            self._size = (sum(n for n, _ in counts),
+                          max([w for _, w in counts] or [0]))
+        return self._size
+
+    def _chunks(self):
+        # yields the rows of each chunk in file order, with chunks parsed
+        # by the workers at most twice as many chunks ahead as workers
+        args = self._args()
+        if len(args) < 2 or self.processes < 2:
+            for item in args:
+                yield _parse_range(item)
+            return
+
+        pool, pending = self._get_pool(), deque()
+        args.reverse()
+        while args or pending:
+            while args and len(pending) < self.processes * 2:
+                pending.append(pool.apply_async(_parse_range_packed,
+                                                (args.pop(),)))
+            yield _unpack(pending.popleft().get())
+
+    def _cells(self, start=0, stop=None):
+        self._check_open()
+        rowx = 0
+        for rows in self._chunks():
+            if rowx + len(rows) <= start:
+                rowx += len(rows)
+                continue
+
+            skip = max(start - rowx, 0)
+            rowx += skip
+            for values in rows[skip:] if skip else rows:
+                if stop is not None and rowx >= stop:
+                    return
+                yield values, _TextCellTypes(values)
+                rowx += 1
@@ -0,0 +1,229 @@
+"""
+Defines a loader for ingesting several workbooks into a database in parallel.
+"""
+from __future__ import division
+
+import multiprocessing
+import threading
+import time
+
+from collections import namedtuple
+from .db import BatchInserter
+
+
+
+Job = namedtuple('Job', 'xlfilepath sheetname header_cols target columns')
+Job.__new__.__defaults__ = (None,)
+
+JobStats = namedtuple('JobStats',
+                      'job rows parse_seconds load_seconds error bad_cells')
+
+
+def _parse_worker(read_job, job_queue, rows_queue, chunk_size):
+    """Runs in a worker process; reads the rows of each job taken off the job
+    queue and puts them on the rows queue in chunks.
+    """
+    while True:
+        item = job_queue.get()
+        if item is None:
+            break
+
+        index, job = item
+        chunk, count = [], [0]
+        def emit(row):
+            chunk.append(row)
+            count[0] += 1
+            if len(chunk) >= chunk_size:
+                rows_queue.put(('rows', index, list(chunk)))
+                del chunk[:]
+
+        error, bad_cells, started = None, 0, time.time()
+        try:
+            bad_cells = len(read_job(job, emit) or ())
+            if chunk:
+                rows_queue.put(('rows', index, list(chunk)))
+        except Exception as ex:
+            error = repr(ex)
+        rows_queue.put(
+            ('done', index, count[0], time.time() - started, error, bad_cells)
+        )
+
+
+class ParallelLoader(object):
+    """Loads the rows of several jobs into a database, parsing the workbooks
+    in a pool of worker processes and writing the rows from one or more
+    writer threads, each having its own connection. Rows travel from the
+    workers to the writers in chunks through a bounded queue.
+
+    :: read_job: a module level function called as `read_job(job, emit)` in a
+           worker process; it reads the rows of the job and passes each row
+           to be loaded to `emit`, and may return a list of the bad cells
+           found, which are counted in the stats.
+    :: connect: a function returning a new DB-API connection.
+    :: processes: number of worker processes; defaults to the cpu count.
+    :: writers: number of writer threads (and connections).
+    :: queue_size: maximum number of chunks waiting to be written.
+    :: chunk_size: number of rows sent from a worker per chunk.
+
+    Jobs are (xlfilepath, sheetname, header_cols, target[, columns]) entries;
+    the rows of a job are inserted into the columns named by columns, or
+    into all the columns of the target table in order without.
+    """
+
+    def __init__(self, read_job, connect, processes=None, writers=1,
+                 queue_size=64, chunk_size=500, batch_size=1000,
+                 commit_every=10):
+        self.read_job = read_job
+        self.connect = connect
+        self.processes = processes or multiprocessing.cpu_count()
+        self.writers = writers
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+
+    def run(self, jobs):
+        """Loads the rows of the jobs and returns a list of JobStats objects
+        in the order of the jobs.
+        """
+        jobs = [Job(*job) for job in jobs]
+        job_queue = multiprocessing.Queue()
+        rows_queue = multiprocessing.Queue(maxsize=self.queue_size)
+        for item in enumerate(jobs):
+            job_queue.put(item)
+
+        nprocs = min(self.processes, len(jobs)) or 1
+        for _ in range(nprocs):
+            job_queue.put(None)
+
+        self._jobs = jobs
+        self._lock = threading.Lock()
+        self._seen = {}
+        self._parsed = {}
+        self._errors = {}
+        self._bad_cells = {}
+
+        workers = [
+            multiprocessing.Process(
+                target=_parse_worker,
+                args=(self.read_job, job_queue, rows_queue, self.chunk_size)
+            ) for _ in range(nprocs)
+        ]
+        writers = [
+            threading.Thread(target=self._write, args=(rows_queue,))
+            for _ in range(self.writers)
+        ]
+        for w in workers + writers:
+            w.daemon = True
+            w.start()
+
+        for w in workers:
+            w.join()
+        for _ in writers:
+            rows_queue.put(None)
+        for w in writers:
+            w.join()
+        return self._get_stats()
+
+    def _write(self, rows_queue):
+        # a writer failing to connect or to write keeps taking chunks off the
+        # queue, so that workers blocked on a full queue don't hang the run,
+        # and records the error against the job of the chunk
+        conn, inserters, conn_error = None, {}, None
+        try:
+            conn = self.connect()
+        except Exception as ex:
+            conn_error = repr(ex)
+
+        try:
+            while True:
+                message = rows_queue.get()
+                if message is None:
+                    break
+
+                kind, index = message[:2]
+                if kind == 'done':
+                    with self._lock:
+                        self._parsed[index] = message[2:4]
+                        self._bad_cells[index] = message[5]
+                        if message[4]:
+                            self._errors[index] = message[4]
+                    self._touch(index)
+                    continue
+
+                if index in self._errors:
+                    continue    # drain rows of a failed job
+                if conn is None:
+                    self._fail(index, conn_error)
+                    continue
+                try:
+                    inserter = self._get_inserter(
+                        conn, inserters, index, message[2]
+                    )
+                    for row in message[2]:
+                        inserter.add(row)
+                except Exception as ex:
+                    self._fail(index, repr(ex))
+                self._touch(index)
+
+            for index, inserter in inserters.items():
+                if index in self._errors:
+                    continue
+                try:
+                    inserter.close()
+                except Exception as ex:
+                    self._fail(index, repr(ex))
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _fail(self, index, error):
+        with self._lock:
+            self._errors.setdefault(index, error)
+
+    def _get_inserter(self, conn, inserters, index, rows):
+        # an inserter per job, so that a failed batch is put down to its job
+        inserter = inserters.get(index)
+        if inserter is None:
+            job = self._jobs[index]
+            text = 'INSERT INTO %s%s VALUES (%s)' % (
+                job.target,
+                ' (%s)' % ', '.join(job.columns) if job.columns else '',
+                ', '.join('?' * len(job.columns or rows[0]))
+            )
+            inserter = BatchInserter(
+                conn, text, self.batch_size, self.commit_every
+            )
+            inserters[index] = inserter
+        return inserter
+
+    def _touch(self, index):
+        now = time.time()
+        with self._lock:
+            first, _ = self._seen.get(index, (now, now))
+            self._seen[index] = (first, now)
+
+    def _get_stats(self):
+        stats = []
+        for index, job in enumerate(self._jobs):
+            rows, parse_seconds = self._parsed.get(index, (0, 0.0))
+            first, last = self._seen.get(index, (0.0, 0.0))
+            stats.append(JobStats(
+                job, rows, parse_seconds, last - first,
+                self._errors.get(index), self._bad_cells.get(index, 0)
+            ))
+        return stats
+
+
+def format_stats(stats):
+    """Returns a per-file throughput report for a list of JobStats objects."""
+    lines = []
+    for s in stats:
+        seconds = max(s.parse_seconds, s.load_seconds)
+        lines.append('%s [%s] -> %s: %s rows in %.2fs (%.0f rows/s)%s%s' % (
+            s.job.xlfilepath, s.job.sheetname, s.job.target, s.rows, seconds,
+            (s.rows / seconds) if seconds else 0,
+            (', %s bad cells' % s.bad_cells) if s.bad_cells else '',
+            (' ERROR: %s' % s.error) if s.error else ''
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,187 @@
+"""
+Defines counters and timers for finding where the time of a run is spent.
+"""
+from __future__ import division
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:     # not available on windows
+    resource = None
+
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def peak_memory_kb():
+    """Returns the peak resident memory of the process in KB or None where
+    it can't be found.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Instrument(object):
+    """Records counters and timings per stage of a run, e.g. 'read' for
+    xlrd, 'normalize' for cleansing and 'insert' and 'commit' for the
+    database.
+
+    Stages timed within another stage are not counted in the time of the
+    outer stage, so the seconds of a stage are the time spent in the stage
+    itself.
+
+    :: name: name of the run.
+    :: profile_path: optional path the cProfile stats of the run are dumped
+           to; profiling runs between `start` and `stop`.
+    """
+
+    def __init__(self, name='run', profile_path=None):
+        self.name = name
+        self.profile_path = profile_path
+        self.started = self.stopped = None
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.started = clock()
+        if self.profile_path:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        self.stopped = clock()
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+
+    def _stage(self, stage):
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = self._stages[stage] = dict(seconds=0.0,
+                                               counts=OrderedDict())
+        return entry
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def count(self, stage, name, n=1):
+        with self._lock:
+            counts = self._stage(stage)['counts']
+            counts[name] = counts.get(name, 0) + n
+
+    def timer(self, stage):
+        """Returns a context manager timing the block under the stage."""
+        return _Timer(self, stage)
+
+    def _add_time(self, stage, seconds):
+        with self._lock:
+            self._stage(stage)['seconds'] += seconds
+
+    def iterate(self, stage, iterable, counter='rows', cells=False):
+        """Yields the items of an iterable, timing the production of each
+        item under the stage and counting items; with cells set the length
+        of each item is counted as cells too.
+        """
+        items = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            self.count(stage, counter)
+            if cells:
+                self.count(stage, 'cells', len(item))
+            yield item
+
+    def records(self):
+        """Returns a record per stage followed by a record for the run."""
+        records = []
+        with self._lock:
+            for stage, entry in self._stages.items():
+                seconds = entry['seconds']
+                rates = OrderedDict(
+                    ('%s_per_sec' % k, (v / seconds) if seconds else 0)
+                    for k, v in entry['counts'].items()
+                )
+                records.append(OrderedDict([
+                    ('stage', stage), ('seconds', seconds),
+                    ('counts', entry['counts'].copy()), ('rates', rates)
+                ]))
+
+        end = self.stopped if self.stopped is not None else clock()
+        records.append(OrderedDict([
+            ('run', self.name),
+            ('seconds', (end - self.started) if self.started else None),
+            ('peak_memory_kb', peak_memory_kb()),
+        ]))
+        return records
+
+    def write(self, fileobj):
+        """Writes the records as JSON lines to an open file."""
+        for record in self.records():
+            fileobj.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        """Returns the records as a table."""
+        records = self.records()
+        lines = ['%-12s %10s  %s' % ('stage', 'seconds', 'counts')]
+        for r in records[:-1]:
+            counts = ', '.join(
+                '%s=%s (%.0f/s)' % (k, v, r['rates']['%s_per_sec' % k])
+                for k, v in r['counts'].items()
+            )
+            lines.append('%-12s %10.4f  %s' % (r['stage'], r['seconds'],
+                                               counts))
+
+        run = records[-1]
+        lines.append('%-12s %10s  peak memory: %s KB' % (
+            run['run'], '-' if run['seconds'] is None else
+            '%.4f' % run['seconds'], run['peak_memory_kb']
+        ))
+        return '\n'.join(lines)
+
+
+class _Timer(object):
+    # keeps the time of nested timers on a per-thread stack so that it can
+    # be taken off the time of the enclosing timer
+
+    __slots__ = ('instrument', 'stage', 'started')
+
+    def __init__(self, instrument, stage):
+        self.instrument = instrument
+        self.stage = stage
+
+    def __enter__(self):
+        self.instrument._stack().append(0.0)
+        self.started = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = clock() - self.started
+        stack = self.instrument._stack()
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        self.instrument._add_time(self.stage, elapsed - nested)
@@ -0,0 +1,261 @@
+"""
+Defines a compact in-memory store of records read and written by column
+name, for holding large tables in memory.
+"""
+from array import array
+
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+# byte strings packed by TextColumn: those of python 2, which are its str
+_packed_bytes = (bytes,) if str is bytes else ()
+
+
+class EncodedColumn(object):
+    """A dictionary-encoded column for values which repeat a lot, such as
+    codes and categories: each distinct value is kept once and rows hold its
+    code in an array.
+    """
+    __slots__ = ('values', 'codes', '_codes_by_value')
+
+    def __init__(self):
+        self.values = []
+        self.codes = array('H')
+        self._codes_by_value = {}
+
+    def _encode(self, value):
+        code = self._codes_by_value.get(value)
+        if code is None:
+            code = self._codes_by_value[value] = len(self.values)
+            self.values.append(value)
+            # codes are widened once there are more values than fit
+            if code > 0xFFFF and self.codes.typecode == 'H':
+                self.codes = array('L', self.codes)
+        return code
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, pos):
+        return self.values[self.codes[pos]]
+
+    def __setitem__(self, pos, value):
+        code = self._encode(value)
+        self.codes[pos] = code
+
+    def append(self, value):
+        # encoded ahead of the lookup as encoding may widen the codes
+        code = self._encode(value)
+        self.codes.append(code)
+
+
+class IntColumn(object):
+    """A column of integers kept in an array; other values, such as None,
+    are kept as they are.
+    """
+    __slots__ = ('_numbers', '_others')
+
+    def __init__(self):
+        self._numbers = array('l')
+        self._others = {}
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __getitem__(self, pos):
+        if pos in self._others:
+            return self._others[pos]
+        return self._numbers[pos]
+
+    def __setitem__(self, pos, value):
+        self._others.pop(pos, None)
+        if not self._put(pos, value):
+            self._others[pos] = value
+
+    def _put(self, pos, value):
+        if type(value) is bool:
+            return False
+        try:
+            self._numbers[pos] = value
+        except (TypeError, OverflowError):
+            return False
+        return True
+
+    def append(self, value):
+        self._numbers.append(0)
+        pos = len(self._numbers) - 1
+        if not self._put(pos, value):
+            self._others[pos] = value
+
+
+class TextColumn(object):
+    """A column of text kept UTF-8 encoded end to end in a single buffer;
+    other values, such as None, and values set after being appended are
+    kept as they are. On python 2, str values of UTF-8 text are packed too
+    and read back as unicode.
+    """
+    __slots__ = ('_data', '_ends', '_others')
+
+    def __init__(self):
+        self._data = bytearray()
+        self._ends = array('L')
+        self._others = {}
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, pos):
+        if pos in self._others:
+            return self._others[pos]
+        start = self._ends[pos - 1] if pos else 0
+        return self._data[start:self._ends[pos]].decode('utf-8')
+
+    def __setitem__(self, pos, value):
+        self._ends[pos]     # raises IndexError for rows not appended
+        self._others[pos] = value
+
+    def append(self, value):
+        if isinstance(value, text_type):
+            self._data += value.encode('utf-8')
+        elif isinstance(value, _packed_bytes) and _is_utf8(value):
+            self._data += value
+        else:
+            self._others[len(self._ends)] = value
+        self._ends.append(len(self._data))
+
+
+def _is_utf8(data):
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class RecordStore(object):
+    """Holds records column by column: text is packed in a buffer per column,
+    integers in arrays and columns of few distinct values are
+    dictionary-encoded. Records are handed out as Record views read and
+    written by column name as dicts are, so code written for dict rows or
+    dant.db.Row objects works on them unchanged.
+
+    :: columns: names of the columns.
+    :: encoded: names of the columns to dictionary-encode, such as customer
+           types, wards and tariff codes.
+    :: ints: names of the integer columns, such as ids.
+    """
+
+    def __init__(self, columns, encoded=(), ints=()):
+        self.columns = tuple(columns)
+        unknown = (set(encoded) | set(ints)) - set(self.columns)
+        if unknown:
+            raise ValueError('Unknown columns: %s' % (sorted(unknown),))
+
+        self._positions = dict((c, i) for i, c in enumerate(self.columns))
+        self._data = [
+            EncodedColumn() if c in encoded else
+            IntColumn() if c in ints else TextColumn()
+            for c in self.columns
+        ]
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += self._count
+        if not 0 <= pos < self._count:
+            raise IndexError('Record index out of range: %s' % (pos,))
+        return Record(self, pos)
+
+    def __iter__(self):
+        for pos in range(self._count):
+            yield Record(self, pos)
+
+    def append(self, record):
+        """Appends a record given as a sequence of values in column order or
+        as a mapping of column names to values, such as a dict or a
+        dant.db.Row, where columns left out are None.
+        """
+        if hasattr(record, 'keys'):
+            values = [record.get(c) for c in self.columns]
+        else:
+            values = record
+            if len(values) != len(self.columns):
+                raise ValueError('Expected %s values, got %s' % (
+                    len(self.columns), len(values)))
+
+        for column, value in zip(self._data, values):
+            column.append(value)
+        self._count += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def values(self, pos):
+        """Returns the values of a record as a list in column order."""
+        return [column[pos] for column in self._data]
+
+    def column(self, name):
+        """Returns the values of a column as a list."""
+        column = self._data[self._positions[name]]
+        return [column[pos] for pos in range(self._count)]
+
+    def distinct(self, name):
+        """Returns the distinct values of a dictionary-encoded column."""
+        column = self._data[self._positions[name]]
+        if not isinstance(column, EncodedColumn):
+            raise ValueError('Column not encoded: %s' % (name,))
+        return list(column.values)
+
+
+class Record(object):
+    """A view over a record of a RecordStore, read and written by column name
+    as a dict is; only the columns of the store can be written.
+    """
+    __slots__ = ('_store', '_pos')
+
+    def __init__(self, store, pos):
+        self._store = store
+        self._pos = pos
+
+    def _column(self, key):
+        pos = self._store._positions.get(key)
+        if pos is None:
+            raise KeyError(key)
+        return self._store._data[pos]
+
+    def __getitem__(self, key):
+        return self._column(key)[self._pos]
+
+    def __setitem__(self, key, value):
+        self._column(key)[self._pos] = value
+
+    def __contains__(self, key):
+        return key in self._store._positions
+
+    def __len__(self):
+        return len(self._store.columns)
+
+    def __iter__(self):
+        return iter(self._store.columns)
+
+    def __repr__(self):
+        return '<Record %r>' % (self.asdict(),)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._store.columns)
+
+    def asdict(self):
+        return dict((k, self[k]) for k in self._store.columns)
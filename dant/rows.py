@@ -0,0 +1,117 @@
+"""
+Defines a streaming stage for locating the header of a sheet and normalizing
+the rows that follow it.
+"""
+from .data import string_types
+
+
+
+def _text(value):
+    return value if isinstance(value, string_types) else str(value)
+
+
+def header_matcher(header_cols):
+    """Returns a function which tests whether a row starts with the provided
+    header columns. Cells are compared as text, case-insensitively.
+    """
+    expected = [_text(h).lower() for h in header_cols]
+    first, count = expected[0], len(expected)
+
+    def is_header(row):
+        if len(row) < count or _text(row[0]).lower() != first:
+            return False
+        return [_text(r).lower() for r in row[:count]] == expected
+    return is_header
+
+
+def is_blank_key(row):
+    """Matches rows whose first cell is empty, or None as decoded."""
+    return not row or row[0] == '' or row[0] is None
+
+
+def is_total_row(row):
+    """Matches the 'Total' rows which follow groups of rows in exports."""
+    return (len(row) > 1 and isinstance(row[1], string_types) and
+            row[1].startswith('Total'))
+
+
+def is_blank_row(row):
+    """Matches rows with all cells empty."""
+    return all(r == '' for r in row)
+
+
+def startswith_matcher(text, column=0):
+    """Returns a function matching rows where the cell at `column` is a text
+    starting with `text`; useful for trailer rows such as 'Printed on'.
+    """
+    def startswith(row):
+        return (len(row) > column and
+                isinstance(row[column], string_types) and
+                row[column].startswith(text))
+    return startswith
+
+
+class RowStream(object):
+    """Locates the header of a stream of rows and yields the normalized rows
+    after it, sending junk rows to a side channel.
+
+    :: header_cols: the leading cells of the header row.
+    :: skip: functions matching rows to be rejected and skipped.
+    :: stop: optional function matching the trailer row at which the data
+           ends; the trailer and rows after it are not read.
+    :: normalize: optional function applied to each accepted row; rows for
+           which it raises ValueError are rejected.
+    :: rejects: optional function called as `rejects(reason, row)` for each
+           rejected row.
+    """
+
+    def __init__(self, header_cols, skip=(is_blank_key, is_total_row),
+                 stop=None, normalize=None, rejects=None):
+        self.is_header = header_matcher(header_cols)
+        self.skip = tuple(skip)
+        self.stop = stop
+        self.normalize = normalize
+        self.rejects = rejects
+        self.accepted = 0
+        self.rejected = 0
+
+    def __call__(self, rows):
+        rows = iter(rows)
+        self.find_header(rows)
+        return self.filter(rows)
+
+    def find_header(self, rows):
+        """Consumes rows up to and including the header row and returns the
+        index of the header row.
+        """
+        for index, row in enumerate(rows):
+            if self.is_header(row):
+                return index
+        raise ValueError('Header not found')
+
+    def filter(self, rows):
+        return (row for _, row in self.ifilter(rows))
+
+    def ifilter(self, rows, start=0):
+        """Same as `filter` but yields (index, row) pairs where index is the
+        position of the row in the input, counting from `start`.
+        """
+        skip, stop, normalize = self.skip, self.stop, self.normalize
+        for index, row in enumerate(rows, start):
+            if stop and stop(row):
+                break
+
+            reason = next((f.__name__ for f in skip if f(row)), None)
+            if reason is None and normalize:
+                try:
+                    row = normalize(row)
+                except ValueError as ex:
+                    reason = 'invalid: %s' % ex
+
+            if reason is None:
+                self.accepted += 1
+                yield index, row
+            else:
+                self.rejected += 1
+                if self.rejects:
+                    self.rejects(reason, row)
@@ -2,11 +2,34 @@
 Defines unit tests for the data analysis toolbox.
 """
 import os
+import csv
+import io
+import json
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
-from xlrd import open_workbook
-from .data import XlSheet
+from array import array
+from datetime import datetime
+from decimal import Decimal
+from xlrd import XL_CELL_DATE, XL_CELL_EMPTY, XL_CELL_ERROR, XL_CELL_NUMBER
+from xlrd import XL_CELL_TEXT, open_workbook
+from .cache import MemoCache, SheetCache
+from .data import XlSheet, decode_column, open_sheet
+from .db import BatchInserter, ChangeTracker, CheckpointStore
+from .db import ConnectionPool, DmlRunner, Row
+from .db import fetch_rows, sqlite_fast_load
+from .dedupe import DuplicateFinder, Field, similarity
+from .delimited import DelimitedSheet, split_ranges
+from .instrument import Instrument
+from .records import RecordStore
+from .ingest import Job, ParallelLoader, format_stats
+from .rows import RowStream, header_matcher, startswith_matcher
+from .xlsx import XlsxSheet, write_xlsx
 
 
 
@@ -94,6 +117,1291 @@ class XlSheetTest(unittest.TestCase):
         
         row = xlsheet.getrows().next()
         self.assertEqual(row[0], 'DALA BUSINESS UNIT')
+    
+    def test_getrows_from_start_row_leaves_shared_generator(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        xlsheet.getrow()
+        self.assertEqual(next(xlsheet.getrows(start_row=5))[0], 'S/N')
+        self.assertEqual(xlsheet.getrow()[0], 'DALA BUSINESS UNIT')
+    
+    def test_rows_can_be_read_by_index_and_slice(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        rows = list(XlSheet(self._workbook, 'active').getrows())
+        self.assertEqual(len(xlsheet), 11)
+        self.assertEqual(xlsheet[6], rows[6])
+        self.assertEqual(xlsheet[-1], rows[-1])
+        self.assertEqual(xlsheet[2:9:3], rows[2:9:3])
+        with self.assertRaises(IndexError):
+            xlsheet[11]
+    
+    def test_windows_are_independent(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        rows = list(XlSheet(self._workbook, 'active').getrows())
+        first, second = xlsheet.iter_window(6), xlsheet.iter_window(6, 10, 2)
+        self.assertEqual(next(first), rows[6])
+        self.assertEqual(list(second), [rows[6], rows[8]])
+        self.assertEqual(list(first), rows[7:])
+        self.assertEqual(list(xlsheet), rows)
+        self.assertEqual(list(xlsheet.iter_window(columns=[1]))[6],
+                         [rows[6][1]])
+    
+    def test_windows_cannot_start_before_the_first_row(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        self.assertRaises(ValueError, xlsheet.iter_window, -1)
+    
+    def test_getrows_strips_text_values(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        row = list(xlsheet.getrows())[6]
+        self.assertEqual(row[2], 'USMAN MUHAMMAD FALGORE')
+    
+    def test_getrows_can_project_columns(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        row = list(xlsheet.getrows(columns=[0, 4, 1]))[5]
+        self.assertEqual(row, ['S/N', 'Meter No', 'Account No'])
+    
+    def test_getcolumns_returns_column_slices(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        columns = xlsheet.getcolumns([0, 1], start_row=6, end_row=8)
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(list(columns[0]), [1.0, 2.0])
+        self.assertEqual(columns[1], ['32/62/40/0629-01', '32/60/60/0032-01'])
+    
+    def test_getcolumns_returns_typed_array_for_numeric_columns(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        sn_col, name_col = xlsheet.getcolumns([0, 2], start_row=6)
+        self.assertIsInstance(sn_col, array)
+        self.assertEqual(sn_col.typecode, 'd')
+        self.assertIsInstance(name_col, list)
+    
+    def test_getcolumns_defaults_to_all_columns(self):
+        xlsheet = XlSheet(self._workbook, 'active')
+        columns = xlsheet.getcolumns()
+        self.assertEqual(len(columns), xlsheet.ncols)
+        self.assertEqual(len(columns[0]), xlsheet.nrows)
+    
+    def test_on_demand_sheet_is_released_when_rows_are_used_up(self):
+        xlsheet = XlSheet(self._filepath, 'active', on_demand=True)
+        self.assertFalse(xlsheet.released)
+        self.assertEqual(len(list(xlsheet.getrows())), 11)
+        self.assertTrue(xlsheet.released)
+        self.assertEqual(xlsheet.nrows, 11)
+    
+    def test_on_demand_sheet_is_released_when_decoded_rows_are_used_up(self):
+        xlsheet = XlSheet(self._filepath, 'active', on_demand=True)
+        self.assertEqual(len(list(xlsheet.decode_rows({0: 'int'}, 6))), 5)
+        self.assertTrue(xlsheet.released)
+    
+    def test_released_sheet_cannot_be_read(self):
+        xlsheet = XlSheet(self._filepath, 'active', on_demand=True)
+        xlsheet.release()
+        with self.assertRaises(ValueError):
+            xlsheet.getrows(start_row=1)
+        with self.assertRaises(ValueError):
+            xlsheet.getcolumns()
+    
+    def test_sheet_is_released_on_leaving_context(self):
+        with XlSheet(self._filepath, 'active', use_mmap=False) as xlsheet:
+            self.assertEqual(xlsheet.getrow()[0],
+                             'KANO ELECTRICITY DISTRIBUTION COMPANY')
+        self.assertTrue(xlsheet.released)
+    
+    def test_release_leaves_callers_workbook_readable(self):
+        XlSheet(self._workbook, 'active').release()
+        xlsheet = XlSheet(self._workbook, 'active')
+        self.assertEqual(xlsheet.getrow()[0],
+                         'KANO ELECTRICITY DISTRIBUTION COMPANY')
+
+
+class DecodeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.xlsheet = XlSheet(
+            open_workbook(os.path.join(TEST_DATA_DIR, 'sample-cust.xls')),
+            'active'
+        )
+    
+    def test_decode_columns_converts_declared_columns(self):
+        sn, meterno = self.xlsheet.decode_columns({0: 'int', 4: 'str'},
+                                                  start_row=6)
+        self.assertEqual(sn, [1, 2, 3, 4, 5])
+        self.assertEqual(meterno[:2], ['0000000092', '0000000095'])
+    
+    def test_bad_cells_are_collected(self):
+        errors = []
+        sn, = self.xlsheet.decode_columns(['int'], start_row=5, end_row=8,
+                                          errors=errors)
+        self.assertEqual(sn, [None, 1, 2])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][:3], (5, 0, 'S/N'))
+    
+    def test_decode_rows_keeps_other_columns_as_read(self):
+        rows = list(self.xlsheet.decode_rows({0: 'decimal'}, start_row=6))
+        self.assertEqual(rows[0][0], Decimal('1'))
+        self.assertEqual(rows[0][1:], self.xlsheet[6][1:])
+        self.assertEqual(len(rows), 5)
+    
+    def test_decode_column_by_cell_type(self):
+        ctypes = [XL_CELL_NUMBER, XL_CELL_TEXT, XL_CELL_EMPTY, XL_CELL_DATE,
+                  XL_CELL_ERROR]
+        values = [12345.0, ' 1,234 ', '', 42005.0, 0x07]
+        errors = []
+        self.assertEqual(decode_column(values, ctypes, 'str', errors=errors),
+                         ['12345', '1,234', '', '2015-01-01T00:00:00', ''])
+        self.assertEqual(decode_column(values, ctypes, 'float'),
+                         [12345.0, 1234.0, None, 42005.0, None])
+        self.assertEqual(decode_column(values[3:4], ctypes[3:4], 'date'),
+                         [datetime(2015, 1, 1)])
+        self.assertEqual(decode_column(['01/02/2015'], [XL_CELL_TEXT],
+                                       'date'), [datetime(2015, 2, 1)])
+        self.assertEqual([e.row for e in errors], [4])
+    
+    def test_raises_error_for_unknown_column_type(self):
+        with self.assertRaises(ValueError):
+            self.xlsheet.decode_columns({0: 'money'})
+
+
+class XlsxSheetTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        super(XlsxSheetTest, cls).setUpClass()
+        cls._tempdir = tempfile.mkdtemp()
+        cls._xlsheet = XlSheet(
+            open_workbook(os.path.join(TEST_DATA_DIR, 'sample-cust.xls')),
+            'active'
+        )
+        cls._filepath = os.path.join(cls._tempdir, 'sample-cust.xlsx')
+        write_xlsx(cls._filepath, [('active', list(cls._xlsheet))])
+    
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._tempdir)
+        super(XlsxSheetTest, cls).tearDownClass()
+    
+    def test_reads_rows_as_xlsheet_does(self):
+        with XlsxSheet(self._filepath, 'active') as xlsheet:
+            self.assertEqual((xlsheet.nrows, xlsheet.ncols),
+                             (self._xlsheet.nrows, self._xlsheet.ncols))
+            self.assertEqual(xlsheet.getrow(), self._xlsheet[0])
+            self.assertEqual(list(xlsheet.getrows()), list(self._xlsheet)[1:])
+            self.assertEqual(xlsheet[6], self._xlsheet[6])
+            self.assertEqual(xlsheet[-1], self._xlsheet[-1])
+            self.assertEqual(xlsheet[2:8:2], self._xlsheet[2:8:2])
+            self.assertEqual(list(xlsheet.getrows(start_row=6, columns=[4])),
+                             list(self._xlsheet.getrows(6, [4])))
+        self.assertTrue(xlsheet.released)
+    
+    def test_slices_and_windows_match_xlsheet(self):
+        with XlsxSheet(self._filepath, 'active') as xlsheet:
+            for index in (slice(8, 2, -2), slice(None, None, -1),
+                          slice(-2, None, -4), slice(2, 8, -1)):
+                self.assertEqual(xlsheet[index], self._xlsheet[index])
+            self.assertRaises(ValueError, xlsheet.iter_window, -1)
+    
+    def test_release_closes_rows_left_part_read(self):
+        xlsheet = XlsxSheet(self._filepath, 'active', on_demand=True)
+        rows = xlsheet.getrows()
+        self.assertEqual(next(rows), self._xlsheet[0])
+        xlsheet.release()
+        self.assertRaises(StopIteration, next, rows)
+    
+    def test_on_demand_sheet_is_released_when_decoded_rows_are_used_up(self):
+        xlsheet = XlsxSheet(self._filepath, 'active', on_demand=True)
+        self.assertEqual(len(list(xlsheet.decode_rows({0: 'int'}, 6))), 5)
+        self.assertTrue(xlsheet.released)
+    
+    def test_decodes_rows_as_xlsheet_does(self):
+        xlsheet = XlsxSheet(self._filepath, 'active')
+        schema = {0: 'int', 4: 'str'}
+        errors, expected = [], []
+        self.assertEqual(
+            list(xlsheet.decode_rows(schema, start_row=5, errors=errors)),
+            list(self._xlsheet.decode_rows(schema, start_row=5,
+                                           errors=expected))
+        )
+        self.assertEqual(errors, expected)
+        self.assertEqual(xlsheet.decode_columns(schema, start_row=6),
+                         self._xlsheet.decode_columns(schema, start_row=6))
+    
+    def test_reads_cell_types_of_sheet_xml(self):
+        path = os.path.join(self._tempdir, 'types.xlsx')
+        ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+        rel = ('http://schemas.openxmlformats.org/officeDocument/2006/'
+               'relationships')
+        with zipfile.ZipFile(path, 'w') as book:
+            book.writestr('xl/workbook.xml', (
+                '<workbook xmlns="%s" xmlns:r="%s"><sheets><sheet name="s" '
+                'sheetId="1" r:id="rId1"/></sheets></workbook>' % (ns, rel)))
+            book.writestr('xl/_rels/workbook.xml.rels', (
+                '<Relationships xmlns="http://schemas.openxmlformats.org/'
+                'package/2006/relationships"><Relationship Id="rId1" '
+                'Type="%s/worksheet" Target="/xl/worksheets/s.xml"/>'
+                '</Relationships>' % rel))
+            book.writestr('xl/styles.xml', (
+                '<styleSheet xmlns="%s"><numFmts><numFmt numFmtId="164" '
+                'formatCode="dd/mm/yyyy"/></numFmts><cellXfs><xf numFmtId="0"/>'
+                '<xf numFmtId="164"/><xf numFmtId="14"/></cellXfs>'
+                '</styleSheet>' % ns))
+            # prefixed, without a dimension, with a row and cells left out
+            book.writestr('xl/worksheets/s.xml', (
+                '<x:worksheet xmlns:x="%s"><x:sheetData>'
+                '<x:row r="1"><x:c r="A1" t="inlineStr"><x:is><x:t>SN</x:t>'
+                '</x:is></x:c><x:c r="C1" t="b"><x:v>1</x:v></x:c></x:row>'
+                '<x:row r="3"><x:c r="A3" s="1"><x:v>42005</x:v></x:c>'
+                '<x:c r="B3" s="2"><x:v>1.5</x:v></x:c>'
+                '<x:c r="C3" t="e"><x:v>#DIV/0!</x:v></x:c>'
+                '<x:c r="D3" t="str"><x:f>A1</x:f><x:v>SN</x:v></x:c></x:row>'
+                '</x:sheetData></x:worksheet>' % ns))
+        
+        xlsheet = XlsxSheet(path, 's')
+        self.assertEqual((xlsheet.nrows, xlsheet.ncols), (3, 4))
+        self.assertEqual(list(xlsheet), [
+            ['SN', '', 1, ''], ['', '', '', ''], [42005.0, 1.5, 0x07, 'SN']
+        ])
+        self.assertEqual(xlsheet.getcells(0), (
+            ['SN', '', 42005.0], [XL_CELL_TEXT, XL_CELL_EMPTY, XL_CELL_DATE]
+        ))
+        self.assertEqual(xlsheet.getcells(2, 2)[1], [XL_CELL_ERROR])
+        self.assertEqual(xlsheet.decode_columns({0: 'date'}, 2),
+                         [[datetime(2015, 1, 1)]])
+        xlsheet.release()
+    
+    def _with_dimension(self, ref):
+        # a copy of a 4 row workbook whose sheet XML gives ref as dimension
+        rows = [['SN', 'Name'], [1.0, 'a'], [2.0, 'b'], [3.0, 'c', 'x']]
+        path = os.path.join(self._tempdir, 'dim.xlsx')
+        write_xlsx(path, [('s', rows)])
+        with zipfile.ZipFile(path) as book:
+            parts = [(info, book.read(info)) for info in book.infolist()]
+        with zipfile.ZipFile(path, 'w') as book:
+            for info, data in parts:
+                if info.filename.startswith('xl/worksheets/'):
+                    data = data.replace(b'ref="A1:C4"',
+                                        b'ref="' + ref + b'"')
+                book.writestr(info, data)
+        return path, rows
+    
+    def test_reads_rows_past_a_lone_cell_dimension(self):
+        path, rows = self._with_dimension(b'A1')
+        with XlsxSheet(path, 's') as xlsheet:
+            self.assertEqual((xlsheet.nrows, xlsheet.ncols), (4, 3))
+            self.assertEqual(list(xlsheet),
+                             [r + [''] * (3 - len(r)) for r in rows])
+    
+    def test_reads_rows_past_a_short_dimension(self):
+        path, rows = self._with_dimension(b'A1:B2')
+        with XlsxSheet(path, 's') as xlsheet:
+            self.assertEqual(list(xlsheet.getrows(columns=[0])),
+                             [[r[0]] for r in rows])
+            self.assertEqual((xlsheet.nrows, xlsheet.ncols), (4, 3))
+            self.assertEqual(xlsheet.decode_columns({0: 'int'}, 1),
+                             [[1, 2, 3]])
+    
+    def test_open_sheet_streams_xlsx_workbooks(self):
+        self.assertIsInstance(open_sheet(self._filepath, 'active'), XlsxSheet)
+        self.assertIsInstance(
+            open_sheet(os.path.join(TEST_DATA_DIR, 'sample-cust.xls'),
+                       'active'), XlSheet
+        )
+    
+    def test_raises_error_for_missing_sheet(self):
+        with self.assertRaises(ValueError):
+            XlsxSheet(self._filepath, 'inactive')
+
+
+class DelimitedSheetTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rows = [['Title', '', ''], ['SN', 'Name', 'MeterNo']] + [
+            [str(i), 'Name %s' % i, '00%s' % i] for i in range(1, 201)
+        ]
+        self.rows[10][1] = 'Musa "Sons"\nDala'
+        self.path = self._write('cust.csv', self.rows)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _write(self, name, rows, delimiter=',', prefix=b''):
+        path = os.path.join(self.tempdir, name)
+        if str is bytes:    # csv writes bytes on python 2
+            data = io.BytesIO()
+            csv.writer(data, delimiter=delimiter).writerows(
+                [[v if isinstance(v, bytes) else v.encode('utf-8')
+                  for v in row] for row in rows])
+            data = data.getvalue()
+        else:
+            text = io.StringIO()
+            csv.writer(text, delimiter=delimiter).writerows(rows)
+            data = text.getvalue().encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(prefix + data)
+        return path
+    
+    def test_split_ranges_keep_quoted_line_breaks(self):
+        data = b'a,"b\nc"\n"d""\n",e\nf,g\n'
+        ranges = split_ranges(data, 1)
+        self.assertEqual(ranges, [(0, 8), (8, 17), (17, 21)])
+        self.assertEqual(split_ranges(data, 1, quotechar=None)[:2],
+                         [(0, 5), (5, 8)])
+    
+    def test_reads_rows_in_file_order_with_workers(self):
+        with DelimitedSheet(self.path, processes=2,
+                            chunk_bytes=256) as sheet:
+            self.assertTrue(len(sheet._ranges) > 2)
+            self.assertEqual(list(sheet.getrows()), self.rows)
+            self.assertEqual((sheet.nrows, sheet.ncols), (202, 3))
+            self.assertEqual(sheet[10], self.rows[10])
+            self.assertEqual(list(sheet.getrows(start_row=150, columns=[2])),
+                             [r[2:] for r in self.rows[150:]])
+        self.assertTrue(sheet.released)
+    
+    def test_header_detection_and_decoding(self):
+        sheet = DelimitedSheet(self.path, processes=1, chunk_bytes=256)
+        first_row = RowStream(['SN', 'Name']).find_header(sheet.getrows()) + 1
+        rows = list(sheet.decode_rows({0: 'int', 2: 'str'}, first_row))
+        self.assertEqual(first_row, 2)
+        self.assertEqual(rows[0], [1, 'Name 1', '001'])
+        self.assertEqual(len(rows), 200)
+    
+    def test_on_demand_sheet_stops_workers_when_decoded_rows_are_used_up(self):
+        sheet = DelimitedSheet(self.path, processes=2, chunk_bytes=256,
+                               on_demand=True)
+        self.assertEqual(len(list(sheet.decode_rows({0: 'int'}, 2))), 200)
+        self.assertTrue(sheet.released)
+        self.assertIsNone(sheet._pool)
+    
+    def test_tab_delimited_file_with_byte_order_mark(self):
+        path = self._write('cust.tsv', self.rows[1:4], '\t', b'\xef\xbb\xbf')
+        sheet = open_sheet(path, None)
+        self.assertIsInstance(sheet, DelimitedSheet)
+        self.assertEqual(list(sheet.getrows()), self.rows[1:4])
+
+
+class BatchInserterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE t (a INT, b VARCHAR(10))')
+        self.text = 'INSERT INTO t VALUES (?, ?)'
+    
+    def tearDown(self):
+        self.conn.close()
+    
+    def _count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM t').fetchone()[0]
+    
+    def test_rows_are_held_until_batch_is_full(self):
+        inserter = BatchInserter(self.conn, self.text, batch_size=3)
+        inserter.add((1, 'a'))
+        inserter.add((2, 'b'))
+        self.assertEqual(inserter.pending, 2)
+        self.assertEqual(self._count(), 0)
+        
+        inserter.add((3, 'c'))
+        self.assertEqual(inserter.pending, 0)
+        self.assertEqual(inserter.rows_sent, 3)
+        self.assertEqual(self._count(), 3)
+    
+    def test_commits_every_n_batches(self):
+        inserter = BatchInserter(self.conn, self.text, batch_size=2,
+                                 commit_every=2)
+        for i in range(5):
+            inserter.add((i, 'x'))
+        self.assertEqual(inserter.batches_sent, 2)
+        self.assertEqual(inserter.rows_committed, 4)
+        
+        inserter.close()
+        self.assertEqual(inserter.rows_committed, 5)
+        self.assertEqual(self._count(), 5)
+    
+    def test_context_flushes_remaining_rows(self):
+        with BatchInserter(self.conn, self.text, batch_size=10) as inserter:
+            inserter.add((1, 'a'))
+        self.assertEqual(self._count(), 1)
+    
+    def test_on_commit_receives_mark_of_last_committed_row(self):
+        marks = []
+        inserter = BatchInserter(self.conn, self.text, batch_size=2,
+                                 commit_every=2, on_commit=marks.append)
+        for i in range(5):
+            inserter.add((i, 'x'), mark=i + 10)
+        self.assertEqual(marks, [13])
+        
+        inserter.close()
+        self.assertEqual(marks, [13, 14])
+    
+    def test_raises_error_for_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            BatchInserter(self.conn, self.text, batch_size=0)
+
+
+class SqliteFastLoadTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.conn = sqlite3.connect(os.path.join(self.tempdir, 'load.db'))
+    
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tempdir)
+    
+    def _pragma(self, name):
+        return self.conn.execute('PRAGMA %s' % name).fetchone()[0]
+    
+    def test_sets_load_pragmas_and_restores_previous(self):
+        before = [self._pragma(n) for n in ('journal_mode', 'synchronous')]
+        with sqlite_fast_load(self.conn):
+            self.assertEqual(self._pragma('journal_mode'), 'memory')
+            self.assertEqual(self._pragma('synchronous'), 0)
+            self.conn.execute('CREATE TABLE t (a INT)')
+            self.conn.executemany('INSERT INTO t VALUES (?)',
+                                  [(i,) for i in range(10)])
+        self.assertEqual(
+            [self._pragma(n) for n in ('journal_mode', 'synchronous')],
+            before
+        )
+        self.assertEqual(
+            self.conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 10
+        )
+    
+    def test_rolls_back_uncommitted_work_on_error(self):
+        synchronous = self._pragma('synchronous')
+        self.conn.execute('CREATE TABLE t (a INT)')
+        with self.assertRaises(ValueError):
+            with sqlite_fast_load(self.conn):
+                self.conn.execute('INSERT INTO t VALUES (1)')
+                self.conn.commit()
+                self.conn.execute('INSERT INTO t VALUES (2)')
+                raise ValueError('bad row')
+        self.assertEqual(self.conn.execute('SELECT a FROM t').fetchall(),
+                         [(1,)])
+        self.assertEqual(self._pragma('synchronous'), synchronous)
+
+
+class CheckpointStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, 'source.xls')
+        with open(self.source, 'w') as f:
+            f.write('data')
+        self.store = CheckpointStore(os.path.join(self.tempdir, 'cp.sqlite3'))
+    
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempdir)
+    
+    def test_returns_none_without_checkpoint(self):
+        self.assertIsNone(self.store.get(self.source, 'active', 't'))
+    
+    def test_records_last_row_per_file_sheet_and_target(self):
+        self.store.set(self.source, 'active', 't1', 10)
+        self.store.set(self.source, 'active', 't1', 20)
+        self.store.set(self.source, 'active', 't2', 5)
+        self.assertEqual(self.store.get(self.source, 'active', 't1'), 20)
+        self.assertEqual(self.store.get(self.source, 'active', 't2'), 5)
+        self.assertIsNone(self.store.get(self.source, 'other', 't1'))
+    
+    def test_checkpoint_is_ignored_once_source_changes(self):
+        self.store.set(self.source, 'active', 't', 10)
+        with open(self.source, 'a') as f:
+            f.write('more data')
+        self.assertIsNone(self.store.get(self.source, 'active', 't'))
+    
+    def test_clear_removes_checkpoint(self):
+        self.store.set(self.source, 'active', 't', 10)
+        self.store.clear(self.source, 'active', 't')
+        self.assertIsNone(self.store.get(self.source, 'active', 't'))
+
+
+class ChangeTrackerTest(unittest.TestCase):
+    
+    RECORDS = [dict(id=1, name='a'), dict(id=2, name='b')]
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'hashes.sqlite3')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _run(self, records, version=1, save=True):
+        tracker = ChangeTracker(self.path, 'customers', version)
+        passed = list(tracker.filter(
+            records, lambda r: r['id'], lambda r: (r['name'],)
+        ))
+        if save:
+            tracker.save()
+        tracker.close()
+        return [r['id'] for r in passed], tracker.skipped
+    
+    def test_passes_all_records_on_first_run(self):
+        self.assertEqual(self._run(self.RECORDS), ([1, 2], 0))
+    
+    def test_passes_only_new_or_changed_records(self):
+        self._run(self.RECORDS)
+        records = [dict(id=1, name='a'), dict(id=2, name='c'),
+                   dict(id=3, name='d')]
+        self.assertEqual(self._run(records), ([2, 3], 1))
+    
+    def test_unsaved_hashes_are_not_kept(self):
+        self._run(self.RECORDS, save=False)
+        self.assertEqual(self._run(self.RECORDS), ([1, 2], 0))
+    
+    def test_version_change_passes_all_records(self):
+        self._run(self.RECORDS)
+        self.assertEqual(self._run(self.RECORDS, version=2), ([1, 2], 0))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.connects = 0
+    
+    def _connect(self):
+        self.connects += 1
+        return sqlite3.connect(':memory:')
+    
+    def test_connections_are_opened_lazily(self):
+        pool = ConnectionPool(self._connect, size=2)
+        self.assertEqual(self.connects, 0)
+        pool.acquire()
+        self.assertEqual(self.connects, 1)
+        self.assertEqual(pool.opened, 1)
+    
+    def test_released_connections_are_reused(self):
+        pool = ConnectionPool(self._connect, size=2, health_check='SELECT 1')
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertEqual(pool.idle, 1)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(self.connects, 1)
+    
+    def test_unhealthy_connections_are_replaced(self):
+        pool = ConnectionPool(self._connect, size=1, health_check='SELECT 1')
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.close()
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(self.connects, 2)
+        self.assertEqual(pool.opened, 1)
+    
+    def test_raises_error_when_pool_is_exhausted(self):
+        pool = ConnectionPool(self._connect, size=1, timeout=0.01)
+        pool.acquire()
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+    
+    def test_connection_context_rolls_back_and_returns_connection(self):
+        pool = ConnectionPool(self._connect, size=1)
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (a INT)')
+            conn.commit()
+            conn.execute('INSERT INTO t VALUES (1)')
+        self.assertEqual(pool.idle, 1)
+        with pool.connection() as conn:
+            self.assertEqual(
+                conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 0
+            )
+
+
+class DmlRunnerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'dml.sqlite3')
+        with sqlite3.connect(self.dbpath) as conn:
+            conn.execute('CREATE TABLE t (id INT PRIMARY KEY, v VARCHAR(10))')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _connect(self):
+        return sqlite3.connect(self.dbpath, timeout=30)
+    
+    def _rows(self):
+        with sqlite3.connect(self.dbpath) as conn:
+            return conn.execute('SELECT id, v FROM t ORDER BY id').fetchall()
+    
+    def test_runs_and_commits_all_statements(self):
+        runner = DmlRunner(self._connect, workers=3, commit_every=4)
+        result = runner.run(
+            (i, ('INSERT INTO t VALUES (?, ?)', (i, 'a'))) for i in range(20)
+        )
+        self.assertEqual((result.passed, result.failed), (20, 0))
+        self.assertEqual(self._rows(), [(i, 'a') for i in range(20)])
+    
+    def test_statements_for_a_key_run_in_order(self):
+        statements = [(i, "INSERT INTO t VALUES (%s, '')" % i)
+                      for i in range(6)]
+        for c in 'abc':
+            statements += [(i, "UPDATE t SET v = v || '%s' WHERE id = %s" % (
+                c, i)) for i in range(6)]
+        DmlRunner(self._connect, workers=4, commit_every=2).run(statements)
+        self.assertEqual(self._rows(), [(i, 'abc') for i in range(6)])
+    
+    def test_errors_are_gathered_up_to_max_errors(self):
+        statements = [(i, "INSERT INTO t VALUES (%s, 'a')" % (i % 5))
+                      for i in range(10)]
+        runner = DmlRunner(self._connect, workers=2, max_errors=3)
+        result = runner.run(statements)
+        self.assertEqual((result.passed, result.failed), (5, 5))
+        self.assertEqual(len(result.errors), 3)
+        for error in result.errors:
+            self.assertIsInstance(error.error, sqlite3.IntegrityError)
+            self.assertEqual(statements[error.key][1], error.statement)
+    
+    def test_idle_workers_commit_so_locks_never_stall_others(self):
+        # sqlite allows a single writer, so a worker waiting for work with
+        # uncommitted statements would block the others for good
+        runner = DmlRunner(self._connect, workers=4, commit_every=10000,
+                           queue_size=2)
+        result = runner.run(
+            (i, ('INSERT INTO t VALUES (?, ?)', (i, 'a'))) for i in range(200)
+        )
+        self.assertEqual((result.passed, result.failed), (200, 0))
+    
+    def test_idle_worker_commit_unblocks_feed(self):
+        # worker 0 runs a statement holding the lock, worker 1 waits on that
+        # lock and the feed on worker 1's full queue: only worker 0
+        # committing on running out of work lets any of them go on
+        lock, locked = threading.Lock(), threading.Event()
+
+        class LockingConnection(object):
+            held = False
+
+            def cursor(self):
+                return self
+
+            def execute(self, statement):
+                deadline = time.time() + 2
+                while not self.held:
+                    self.held = lock.acquire(False)
+                    if not self.held:
+                        if time.time() > deadline:
+                            raise RuntimeError('lock timeout')
+                        time.sleep(0.01)
+                locked.set()
+
+            def commit(self):
+                if self.held:
+                    self.held = False
+                    lock.release()
+
+            def close(self):
+                self.commit()
+
+        def statements():
+            yield 0, 'a'
+            locked.wait()
+            for _ in range(4):
+                yield 1, 'b'
+
+        runner = DmlRunner(LockingConnection, workers=2, commit_every=100,
+                           queue_size=1)
+        result = runner.run(statements())
+        self.assertEqual((result.passed, result.failed), (5, 0))
+    
+    def test_raises_error_for_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            DmlRunner(self._connect, workers=0)
+
+
+class FetchRowsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE t (id INT, name VARCHAR(10))')
+        self.conn.executemany('INSERT INTO t VALUES (?, ?)',
+                              [(i, 'n%s' % i) for i in range(7)])
+    
+    def tearDown(self):
+        self.conn.close()
+    
+    def _rows(self, **kwargs):
+        cur = self.conn.execute('SELECT id, name FROM t ORDER BY id')
+        return list(fetch_rows(cur, **kwargs))
+    
+    def test_fetches_all_rows_in_pages(self):
+        rows = self._rows(arraysize=3)
+        self.assertEqual([r['id'] for r in rows], list(range(7)))
+    
+    def test_fetches_up_to_count_rows(self):
+        rows = self._rows(arraysize=3, count=4)
+        self.assertEqual([r['id'] for r in rows], [0, 1, 2, 3])
+    
+    def test_rows_share_index_map(self):
+        rows = self._rows()
+        self.assertIs(rows[0]._index, rows[1]._index)
+    
+    def test_row_reads_like_a_dict(self):
+        row = Row({'id': 0, 'name': 1}, (5, 'x'))
+        self.assertEqual(row['name'], 'x')
+        self.assertEqual(row.keys(), ['id', 'name'])
+        self.assertEqual(row.get('missing', 1), 1)
+        self.assertTrue('id' in row)
+        with self.assertRaises(KeyError):
+            row['missing']
+    
+    def test_row_accepts_new_and_updated_fields(self):
+        row = Row({'id': 0, 'name': 1}, (5, 'x'))
+        row['name'] = 'y'
+        row['AcctNo'] = '32/55/42/0741-01'
+        self.assertEqual(row['name'], 'y')
+        self.assertEqual(row.asdict(), {
+            'id': 5, 'name': 'y', 'AcctNo': '32/55/42/0741-01'
+        })
+        self.assertEqual(len(row), 3)
+
+
+class RecordStoreTest(unittest.TestCase):
+    
+    COLUMNS = ('Id', 'Name', 'Ward', 'AcctNo')
+    
+    def _store(self):
+        store = RecordStore(self.COLUMNS, encoded=('Ward',), ints=('Id',))
+        store.append((1, u'Musa Bello', u'GWALE', None))
+        store.append({'Id': 2, 'Name': u'caf\xe9', 'Ward': u'GWALE'})
+        store.append(Row({'Id': 0, 'Name': 1, 'Ward': 2},
+                         (3, 1234, u'DALA')))
+        return store
+    
+    def test_records_read_like_rows(self):
+        store = self._store()
+        self.assertEqual(len(store), 3)
+        self.assertEqual([r.asdict() for r in store], [
+            {'Id': 1, 'Name': u'Musa Bello', 'Ward': u'GWALE', 'AcctNo': None},
+            {'Id': 2, 'Name': u'caf\xe9', 'Ward': u'GWALE', 'AcctNo': None},
+            {'Id': 3, 'Name': 1234, 'Ward': u'DALA', 'AcctNo': None},
+        ])
+        record = store[-1]
+        self.assertEqual(record.keys(), list(self.COLUMNS))
+        self.assertEqual(record.get('missing', 1), 1)
+        self.assertTrue('Ward' in record)
+        with self.assertRaises(KeyError):
+            record['missing']
+        with self.assertRaises(IndexError):
+            store[3]
+    
+    def test_records_write_to_store(self):
+        store = self._store()
+        store[0]['AcctNo'] = u'32/55/42/0741-01'
+        store[1]['Ward'] = u'DALA'
+        store[2]['Id'] = None
+        self.assertEqual(store.column('AcctNo'),
+                         [u'32/55/42/0741-01', None, None])
+        self.assertEqual(store.column('Ward'), [u'GWALE', u'DALA', u'DALA'])
+        self.assertEqual(store.column('Id'), [1, 2, None])
+        with self.assertRaises(KeyError):
+            store[0]['missing'] = 1
+    
+    def test_packs_native_strings(self):
+        store = RecordStore(['name'])
+        store.extend([['Musa'], [u'caf\xe9'], [None], [b'\xff']])
+        column = store._data[0]
+        self.assertEqual(bytes(column._data), u'Musacaf\xe9'.encode('utf-8'))
+        self.assertEqual(sorted(column._others), [2, 3])
+        self.assertEqual(store.column('name'),
+                         ['Musa', u'caf\xe9', None, b'\xff'])
+    
+    def test_encodes_each_distinct_value_once(self):
+        store = RecordStore(('Ward',), encoded=('Ward',))
+        store.extend((u'W%s' % (i % 70000),) for i in range(140000))
+        self.assertEqual(len(store.distinct('Ward')), 70000)
+        self.assertEqual(store[139999]['Ward'], u'W69999')
+        with self.assertRaises(ValueError):
+            self._store().distinct('Name')
+    
+    def test_rejects_unknown_columns_and_bad_records(self):
+        with self.assertRaises(ValueError):
+            RecordStore(self.COLUMNS, encoded=('Tariff',))
+        with self.assertRaises(ValueError):
+            self._store().append((1, u'x'))
+
+
+class InstrumentTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _stages(self, instrument):
+        return dict((r['stage'], r) for r in instrument.records()[:-1])
+    
+    def test_nested_stage_time_is_not_counted_in_outer_stage(self):
+        instrument = Instrument()
+        with instrument.timer('outer'):
+            with instrument.timer('inner'):
+                time.sleep(0.05)
+        stages = self._stages(instrument)
+        self.assertGreaterEqual(stages['inner']['seconds'], 0.05)
+        self.assertLess(stages['outer']['seconds'], 0.05)
+    
+    def test_iterate_counts_rows_and_cells(self):
+        instrument = Instrument()
+        rows = [[1, 2, 3], [4, 5, 6]]
+        self.assertEqual(list(instrument.iterate('read', rows, cells=True)),
+                         rows)
+        counts = self._stages(instrument)['read']['counts']
+        self.assertEqual((counts['rows'], counts['cells']), (2, 6))
+    
+    def test_xlsheet_records_rows_read(self):
+        instrument = Instrument()
+        xlsheet = XlSheet(os.path.join(TEST_DATA_DIR, 'sample-cust.xls'),
+                          'active', instrument=instrument)
+        list(xlsheet.getrows())
+        counts = self._stages(instrument)['read']['counts']
+        self.assertEqual((counts['rows'], counts['cells']), (11, 88))
+    
+    def test_batch_inserter_records_round_trips_and_commits(self):
+        instrument = Instrument()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (a INT)')
+        with BatchInserter(conn, 'INSERT INTO t VALUES (?)', batch_size=2,
+                           instrument=instrument) as inserter:
+            for i in range(5):
+                inserter.add((i,))
+        stages = self._stages(instrument)
+        self.assertEqual(stages['insert']['counts']['round_trips'], 3)
+        self.assertEqual(stages['insert']['counts']['rows'], 5)
+        self.assertEqual(stages['commit']['counts']['commits'], 1)
+    
+    def test_writes_json_lines_and_profile(self):
+        profile_path = os.path.join(self.tempdir, 'run.prof')
+        with Instrument('load', profile_path=profile_path) as instrument:
+            instrument.count('read', 'rows', 3)
+        stats_path = os.path.join(self.tempdir, 'run.jsonl')
+        with open(stats_path, 'w') as f:
+            instrument.write(f)
+        with open(stats_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]['counts'], {'rows': 3})
+        self.assertEqual(records[-1]['run'], 'load')
+        self.assertTrue(os.path.isfile(profile_path))
+        self.assertIn('read', instrument.summary())
+
+
+def _read_sample_job(job, emit):
+    # used by ParallelLoaderTest; must be module level to reach the workers
+    xlsheet = XlSheet(job.xlfilepath, job.sheetname)
+    rows = xlsheet.getrows()
+    for row in rows:
+        if row[:len(job.header_cols)] == job.header_cols:
+            break
+    for row in rows:
+        emit([int(row[0]), row[1]])
+
+
+def _read_sample_job_as_ints(job, emit):
+    # used by ParallelLoaderTest; account numbers make bad 'int' cells
+    xlsheet, errors = XlSheet(job.xlfilepath, job.sheetname), []
+    for row in xlsheet.decode_rows({0: 'int', 1: 'int'}, 6, errors=errors):
+        emit(row[:2])
+    return errors
+
+
+class ParallelLoaderTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'test.sqlite3')
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute('CREATE TABLE t1 (sn INT, acctno VARCHAR(20))')
+        conn.execute('CREATE TABLE t2 (sn INT, acctno VARCHAR(20))')
+        conn.close()
+        self.filepath = os.path.join(TEST_DATA_DIR, 'sample-cust.xls')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _count(self, table):
+        conn = sqlite3.connect(self.dbpath)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+        finally:
+            conn.close()
+    
+    def test_loads_rows_of_all_jobs(self):
+        loader = ParallelLoader(
+            _read_sample_job, lambda: sqlite3.connect(self.dbpath),
+            processes=2, chunk_size=2, batch_size=3
+        )
+        stats = loader.run([
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1'),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't2'),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't2'),
+        ])
+        self.assertEqual(self._count('t1'), 5)
+        self.assertEqual(self._count('t2'), 10)
+        self.assertEqual([s.rows for s in stats], [5, 5, 5])
+        self.assertTrue(all(s.error is None for s in stats))
+        self.assertIsInstance(stats[0].job, Job)
+    
+    def test_reports_errors_per_job(self):
+        loader = ParallelLoader(
+            _read_sample_job, lambda: sqlite3.connect(self.dbpath),
+            processes=1
+        )
+        stats = loader.run([
+            (self.filepath, 'no-such-sheet', ['S/N'], 't1'),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1'),
+        ])
+        self.assertIn('ValueError', stats[0].error)
+        self.assertIsNone(stats[1].error)
+        self.assertEqual(self._count('t1'), 5)
+        self.assertIn('ERROR', format_stats(stats))
+    
+    def test_counts_bad_cells_per_job(self):
+        loader = ParallelLoader(
+            _read_sample_job_as_ints, lambda: sqlite3.connect(self.dbpath),
+            processes=1
+        )
+        stats = loader.run([
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1'),
+        ])
+        self.assertEqual(stats[0].bad_cells, stats[0].rows)
+        self.assertIn('%s bad cells' % stats[0].rows, format_stats(stats))
+        
+        stats = ParallelLoader(
+            _read_sample_job, lambda: sqlite3.connect(self.dbpath),
+            processes=1
+        ).run([(self.filepath, 'active', ['S/N', 'Account No'], 't1')])
+        self.assertEqual(stats[0].bad_cells, 0)
+    
+    def test_puts_failed_batches_down_to_their_job(self):
+        loader = ParallelLoader(
+            _read_sample_job, lambda: sqlite3.connect(self.dbpath),
+            processes=1
+        )
+        stats = loader.run([
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1'),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1',
+             ('sn', 'no_such_column')),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't2',
+             ('acctno', 'sn')),
+        ])
+        self.assertIsNone(stats[0].error)
+        self.assertIn('no_such_column', stats[1].error)
+        self.assertIsNone(stats[2].error)
+        self.assertEqual(self._count('t1'), 5)
+        self.assertEqual(self._count('t2'), 5)
+    
+    def test_drains_rows_when_writer_cannot_connect(self):
+        def connect():
+            raise sqlite3.OperationalError('unable to open database')
+        
+        loader = ParallelLoader(_read_sample_job, connect, processes=2,
+                                queue_size=1, chunk_size=1)
+        stats = loader.run([
+            (self.filepath, 'active', ['S/N', 'Account No'], 't1'),
+            (self.filepath, 'active', ['S/N', 'Account No'], 't2'),
+        ])
+        self.assertEqual([s.rows for s in stats], [5, 5])
+        self.assertTrue(all('unable to open' in s.error for s in stats))
+
+
+class RowStreamTest(unittest.TestCase):
+    
+    ROWS = [
+        ['DALA BUSINESS UNIT', '', ''],
+        ['S/N', 'Account No', 'Surname'],
+        [1.0, '32/62/40/0629-01', 'USMAN'],
+        ['', '', ''],
+        ['', 'Total', ''],
+        [2.0, 'Total Customers', ''],
+        ['x', '32/60/60/0032-01', 'INUWA'],
+        [3.0, '32/17/03/4040-01', 'MOHD'],
+        ['Printed on', '', ''],
+        [4.0, '32/10/38/0398-01', 'AHMED'],
+    ]
+    
+    def _normalize(self, row):
+        return [int(float(row[0]))] + row[1:]
+    
+    def test_header_matcher_ignores_case_and_extra_cells(self):
+        is_header = header_matcher(['s/n', 'ACCOUNT NO'])
+        self.assertTrue(is_header(['S/N', 'Account No', 'Surname']))
+        self.assertFalse(is_header(['S/N']))
+        self.assertFalse(is_header([1.0, 'Account No']))
+    
+    def test_yields_normalized_rows_after_header(self):
+        stream = RowStream(['S/N', 'Account No'], normalize=self._normalize)
+        rows = list(stream(self.ROWS))
+        self.assertEqual([r[0] for r in rows], [1, 3, 4])
+        self.assertEqual(stream.accepted, 3)
+        self.assertEqual(stream.rejected, 5)
+    
+    def test_sends_rejected_rows_to_side_channel(self):
+        rejected = []
+        stream = RowStream(['S/N'], normalize=self._normalize,
+                           rejects=lambda reason, row: rejected.append(reason))
+        list(stream(self.ROWS))
+        self.assertEqual(rejected[:3],
+                         ['is_blank_key', 'is_blank_key', 'is_total_row'])
+        self.assertTrue(rejected[3].startswith('invalid'))
+    
+    def test_stops_at_trailer_row(self):
+        stream = RowStream(['S/N'], normalize=self._normalize,
+                           stop=startswith_matcher('Printed'))
+        rows = list(stream(self.ROWS))
+        self.assertEqual([r[0] for r in rows], [1, 3])
+    
+    def test_find_header_returns_header_index(self):
+        stream = RowStream(['S/N'])
+        self.assertEqual(stream.find_header(self.ROWS), 1)
+    
+    def test_ifilter_yields_row_positions(self):
+        stream = RowStream(['S/N'], normalize=self._normalize)
+        pairs = list(stream.ifilter(self.ROWS[2:], 2))
+        self.assertEqual([i for i, _ in pairs], [2, 7, 9])
+    
+    def test_raises_error_when_header_not_found(self):
+        stream = RowStream(['Meter No'])
+        with self.assertRaises(ValueError):
+            list(stream(self.ROWS))
+
+
+class DuplicateFinderTest(unittest.TestCase):
+    
+    FIELDS = (Field('name', 2, False), Field('phone', 1, True))
+    
+    def _finder(self, records, **kwargs):
+        finder = DuplicateFinder(self.FIELDS, 2, **kwargs)
+        for recid, name, phone in records:
+            finder.add(recid, {'name': name, 'phone': phone},
+                       (phone or None, name.split()[-1]))
+        return finder
+    
+    def test_similarity_of_texts(self):
+        self.assertEqual(similarity('musa bello', 'musa bello'), 1.0)
+        self.assertEqual(similarity('abc', 'xyz'), 0.0)
+        self.assertTrue(similarity('musa bello', 'musa belo') > 0.8)
+    
+    def test_finds_clusters_of_duplicates(self):
+        finder = self._finder([
+            (1, 'musa bello', '8031234567'),
+            (2, 'musa belo', ''),
+            (3, 'aminu bello', '8031234567'),
+            (4, 'musa bello', '8031234567'),
+            (5, 'sani kano', '8039999999'),
+        ])
+        clusters = finder.find()
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0].ids, [1, 4])
+        self.assertEqual(clusters[0].score, 1.0)
+        self.assertEqual(clusters[0].pairs, [(1, 4, 1.0)])
+        
+        finder = self._finder([
+            (1, 'musa bello', '8031234567'),
+            (2, 'musa bello', ''),
+            (3, 'musa belo', '8031234567'),
+        ], threshold=0.8)
+        cluster, = finder.find()
+        self.assertEqual(cluster.ids, [1, 2, 3])
+        self.assertTrue(0.8 <= cluster.score < 1.0)
+    
+    def test_compares_pairs_sharing_keys_once(self):
+        finder = self._finder([
+            (1, 'musa bello', '8031234567'),
+            (2, 'musa bello', '8031234567'),
+            (3, 'sani kano', ''),
+        ])
+        self.assertEqual(len(list(finder.pairs())), 1)
+        self.assertEqual(finder.compared, 1)
+    
+    def test_compares_oversized_blocks_within_window(self):
+        records = [(i, 'n%s bello' % i, '') for i in range(6)]
+        finder = self._finder(records, max_block_size=3, window=2)
+        list(finder.pairs())
+        self.assertEqual(finder.compared, 5 * 2 - 1)
+        
+        finder = self._finder(records)
+        list(finder.pairs())
+        self.assertEqual(finder.compared, 15)
+    
+    def test_rejects_records_with_wrong_number_of_keys(self):
+        finder = DuplicateFinder(self.FIELDS, 2)
+        with self.assertRaises(ValueError):
+            finder.add(1, {'name': 'musa'}, ('musa',))
+
+
+class MemoCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'memo.sqlite3')
+        self.calls = []
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def _upper(self, value):
+        self.calls.append(value)
+        return value.upper()
+    
+    def test_memoizes_results_and_counts_hits(self):
+        cache = MemoCache()
+        upper = cache.memoize('upper', 1, self._upper)
+        self.assertEqual([upper('a'), upper('b'), upper('a')], ['A', 'B', 'A'])
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertEqual(cache.stats()['upper'],
+                         dict(hits=1, disk_hits=0, misses=2))
+    
+    def test_evicts_least_recently_used_results(self):
+        cache = MemoCache(maxsize=2)
+        upper = cache.memoize('upper', 1, self._upper)
+        for value in ('a', 'b', 'a', 'c', 'a', 'b'):
+            upper(value)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+    
+    def test_clear_drops_results_held(self):
+        cache = MemoCache()
+        upper = cache.memoize('upper', 1, self._upper)
+        upper('a')
+        cache.clear()
+        upper('a')
+        self.assertEqual(self.calls, ['a', 'a'])
+    
+    def test_store_persists_results_across_runs(self):
+        cache = MemoCache(path=self.path)
+        upper = cache.memoize('upper', 1, self._upper)
+        upper('a')
+        cache.close()
+        
+        cache = MemoCache(path=self.path)
+        upper = cache.memoize('upper', 1, self._upper)
+        self.assertEqual(upper('a'), 'A')
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(cache.stats()['upper']['disk_hits'], 1)
+        cache.close()
+    
+    def test_version_change_discards_only_that_functions_results(self):
+        cache = MemoCache(path=self.path)
+        cache.memoize('upper', 1, self._upper)('a')
+        cache.memoize('lower', 1, self._upper)('b')
+        cache.close()
+        
+        cache = MemoCache()
+        upper = cache.memoize('upper', 2, self._upper)
+        lower = cache.memoize('lower', 1, self._upper)
+        cache.open(self.path)
+        upper('a')
+        lower('b')
+        self.assertEqual(self.calls, ['a', 'b', 'a'])
+        cache.close()
+
+
+class SheetCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = SheetCache(os.path.join(self.tempdir, 'sheets'))
+        self.filepath = os.path.join(self.tempdir, 'sample-cust.xls')
+        shutil.copy(os.path.join(TEST_DATA_DIR, 'sample-cust.xls'),
+                    self.filepath)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_cached_rows_match_xlsheet_rows(self):
+        expected = list(XlSheet(self.filepath, 'active').getrows())
+        self.assertEqual(list(self.cache.open(self.filepath, 'active')
+                              .getrows()), expected)
+        self.assertEqual(list(self.cache.open(self.filepath, 'active')
+                              .getrows(start_row=3, columns=[0, 2])),
+                         [[r[0], r[2]] for r in expected[3:]])
+    
+    def test_cached_columns_match_xlsheet_columns(self):
+        expected = XlSheet(self.filepath, 'active').getcolumns(
+            start_row=2, end_row=9
+        )
+        found = self.cache.open(self.filepath, 'active').getcolumns(
+            start_row=2, end_row=9
+        )
+        self.assertEqual([list(c) for c in found],
+                         [list(c) for c in expected])
+    
+    def test_cached_rows_can_be_read_by_index_and_window(self):
+        expected = list(XlSheet(self.filepath, 'active').getrows())
+        xlsheet = self.cache.open(self.filepath, 'active')
+        self.assertEqual(xlsheet[6], expected[6])
+        self.assertEqual(xlsheet[-3:], expected[-3:])
+        self.assertEqual(list(xlsheet.iter_window(1, 10, 4)),
+                         expected[1:10:4])
+        self.assertEqual(xlsheet[8:2:-2], expected[8:2:-2])
+        self.assertRaises(ValueError, xlsheet.iter_window, -1)
+    
+    def test_cached_rows_are_shared_with_getrow(self):
+        expected = list(XlSheet(self.filepath, 'active').getrows())
+        xlsheet = self.cache.open(self.filepath, 'active')
+        self.assertEqual(xlsheet.getrows().next(), expected[0])
+        self.assertEqual(xlsheet.getrow(), expected[1])
+        self.assertEqual(list(xlsheet.getrows()), expected[2:])
+    
+    def test_cached_sheet_decodes_as_xlsheet(self):
+        schema = {0: 'int', 1: 'str', 6: 'float'}
+        expected, found = [], []
+        rows = list(XlSheet(self.filepath, 'active').decode_rows(
+            schema, errors=expected))
+        self.assertEqual(list(self.cache.open(self.filepath, 'active')
+                              .decode_rows(schema, errors=found)), rows)
+        self.assertEqual(found, expected)
+    
+    def test_sheet_is_parsed_once(self):
+        self.cache.open(self.filepath, 'active')
+        self.cache.open(self.filepath, 'active')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+    
+    def test_changed_file_is_parsed_again(self):
+        self.cache.open(self.filepath, 'active')
+        with open(self.filepath, 'ab') as f:
+            f.write(b'\0')
+        self.cache.open(self.filepath, 'active')
+        self.assertEqual(self.cache.misses, 2)
+    
+    def test_unchanged_file_is_not_hashed_again(self):
+        from . import cache
+        digests = []
+        def file_digest(filepath):
+            digests.append(filepath)
+            return original(filepath)
+        original, cache.file_digest = cache.file_digest, file_digest
+        try:
+            self.cache.open(self.filepath, 'active')
+            self.cache.open(self.filepath, 'active')
+        finally:
+            cache.file_digest = original
+        self.assertEqual(len(digests), 1)
+        self.assertEqual(self.cache.hits, 1)
+    
+    def test_touched_file_is_hashed_but_not_parsed_again(self):
+        self.cache.open(self.filepath, 'active')
+        stat = os.stat(self.filepath)
+        os.utime(self.filepath, (stat.st_atime, stat.st_mtime + 10))
+        self.cache.open(self.filepath, 'active')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+    
+    def test_on_demand_sheet_is_released_when_rows_are_used_up(self):
+        xlsheet = self.cache.open(self.filepath, 'active', on_demand=True)
+        list(xlsheet.decode_rows({0: 'int'}))
+        self.assertTrue(xlsheet.released)
+        xlsheet = self.cache.open(self.filepath, 'active', on_demand=True)
+        list(xlsheet.getrows())
+        self.assertTrue(xlsheet.released)
+    
+    def test_released_sheet_cannot_be_read(self):
+        xlsheet = self.cache.open(self.filepath, 'active')
+        xlsheet.release()
+        self.assertTrue(xlsheet.released)
+        with self.assertRaises(ValueError):
+            xlsheet.getcolumns()
+    
+    def test_raises_error_for_invalid_sheetname(self):
+        with self.assertRaises(ValueError):
+            self.cache.open(self.filepath, 'bad-sheet-name')
 
 
 class IntrospectingFile(unittest.TestCase):
@@ -0,0 +1,504 @@
+"""
+Defines a streaming reader for .xlsx worksheets.
+
+Rows are parsed from the sheet XML as they are read, so the memory used by a
+sheet does not grow with its row count; only the shared strings of the
+workbook are held, packed in a single string.
+"""
+import io
+import os
+import re
+import shutil
+import tempfile
+import xlrd
+import zipfile
+
+from array import array
+from xml.sax.saxutils import escape
+
+from .data import _StreamedSheet
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+_REL_NS = ('{http://schemas.openxmlformats.org/officeDocument/2006/'
+           'relationships}')
+_PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# number formats Excel displays as dates or times
+_DATE_FORMAT_IDS = frozenset(
+    list(range(14, 23)) + list(range(27, 37)) + [45, 46, 47] +
+    list(range(50, 59))
+)
+_FORMAT_NOISE = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.|_.|\*.')
+
+# bytes of sheet XML read at a time; rows are parsed a block at a time
+READ_BLOCK_SIZE = 1 << 16
+
+# the root start tag, the namespace prefix and the self-closing slash of an
+# empty sheetData, found ahead of the rows
+_SHEET_DATA = re.compile(
+    br'(<[^?!][^>]*>).*?<((?:[\w.-]+:)?)sheetData\b[^>]*?(/?)>', re.S
+)
+_TAG_NAME = re.compile(br'[^\s/>]+')
+
+_ERROR_CODES = dict((v, k) for k, v in xlrd.error_text_from_code.items())
+
+
+def _is_date_format(code):
+    code = _FORMAT_NOISE.sub('', code).lower()
+    return any(c in code for c in 'dmyhs')
+
+
+# zero based column indexes by column letters, filled in as met
+_COLUMNS = {}
+
+
+def _col_index(letters):
+    colx = _COLUMNS.get(letters)
+    if colx is None:
+        colx = 0
+        for ch in letters:
+            colx = colx * 26 + ord(ch) - 64
+        colx = _COLUMNS[letters] = colx - 1
+    return colx
+
+
+def _split_ref(ref):
+    # 'AB12' -> (11, 27), zero based
+    letters = ref.rstrip('0123456789')
+    return int(ref[len(letters):]) - 1, _col_index(letters)
+
+
+def _ns(tag):
+    return tag[:tag.index('}') + 1] if tag.startswith('{') else ''
+
+
+class _SharedStrings(object):
+    # the shared strings of a workbook joined in a single string, looked up
+    # by offsets, rather than as a list of string objects
+
+    def __init__(self, fileobj=None):
+        self._offsets = array('I', [0])
+        self._text = u''
+        if fileobj is None:
+            return
+
+        buf, total = io.StringIO(), 0
+        context = ElementTree.iterparse(fileobj, events=('start', 'end'))
+        root = si = t = r = None
+        for event, elem in context:
+            if root is None:
+                root, ns = elem, _ns(elem.tag)
+                si, t, r = ns + 'si', ns + 't', ns + 'r'
+            elif event == 'end' and elem.tag == si:
+                # plain text or rich text runs; phonetic runs are left out
+                text = elem.findtext(t)
+                if text is None:
+                    text = u''.join(run.findtext(t) or u''
+                                    for run in elem.iter(r))
+                buf.write(u'' + text)
+                total += len(text)
+                self._offsets.append(total)
+                root.clear()
+        self._text = buf.getvalue()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._text[self._offsets[index]:self._offsets[index + 1]]
+
+
+class XlsxSheet(_StreamedSheet):
+    """Reads a worksheet of an .xlsx workbook, streaming rows off the sheet
+    XML instead of loading the sheet; presents the same reading methods as
+    dant.data.XlSheet, with values and xlrd cell types as xlrd reads them.
+    Each read parses the sheet from the top.
+
+    The sheet size is taken from the dimension element ahead of the rows,
+    where it gives a range, and grows as reads come upon rows or columns
+    past it; reads go on to the end of the sheet data regardless.
+
+    :: source: path to an .xlsx file.
+    :: on_demand: when True, the workbook is closed once the rows generator
+           is used up.
+    :: instrument: optional dant.instrument.Instrument recording the rows and
+           cells read by `getrows` under the 'read' stage.
+    """
+
+    def __init__(self, source, sheet_name, on_demand=False, instrument=None):
+        if not os.path.isfile(source):
+            raise IOError('File not found: %s' % (source,))
+
+        self._zip = zipfile.ZipFile(source)
+        try:
+            paths = self._read_workbook()
+            if sheet_name not in paths:
+                raise ValueError('Sheet not found: %s' % (list(paths),))
+            self._path = paths[sheet_name]
+            self._strings = self._read_shared_strings()
+            self._date_styles = self._read_date_styles()
+            self._nrows, self._ncols = self._read_dimension()
+        except Exception:
+            self._zip.close()
+            raise
+        super(XlsxSheet, self).__init__(on_demand, instrument)
+        self.sheet_name = sheet_name
+
+    def _related(self, rels_path):
+        # {relationship id: (type, target path)} of a .rels part
+        root = ElementTree.fromstring(self._zip.read(rels_path))
+        base = os.path.dirname(os.path.dirname(rels_path))
+        found = {}
+        for rel in root.iter(_PKG_REL_NS + 'Relationship'):
+            target = rel.get('Target')
+            target = (target.lstrip('/') if target.startswith('/') else
+                      os.path.normpath(os.path.join(base, target)))
+            found[rel.get('Id')] = (rel.get('Type'),
+                                    target.replace(os.sep, '/'))
+        return found
+
+    def _read_workbook(self):
+        root = ElementTree.fromstring(self._zip.read('xl/workbook.xml'))
+        ns = _ns(root.tag)
+        pr = root.find(ns + 'workbookPr')
+        self._datemode = int(pr is not None and pr.get('date1904') in (
+            '1', 'true'))
+
+        self._rels = self._related('xl/_rels/workbook.xml.rels')
+        paths = {}
+        for sheet in root.iter(ns + 'sheet'):
+            paths[sheet.get('name')] = self._rels[sheet.get(_REL_NS + 'id')][1]
+        return paths
+
+    def _part(self, rel_type, default):
+        for kind, target in self._rels.values():
+            if kind.endswith('/' + rel_type):
+                return target
+        return default
+
+    def _read_shared_strings(self):
+        path = self._part('sharedStrings', 'xl/sharedStrings.xml')
+        if path not in self._zip.namelist():
+            return _SharedStrings()
+        with self._zip.open(path) as f:
+            return _SharedStrings(f)
+
+    def _read_date_styles(self):
+        # indexes of the cell styles showing numbers as dates
+        path = self._part('styles', 'xl/styles.xml')
+        if path not in self._zip.namelist():
+            return frozenset()
+
+        root = ElementTree.fromstring(self._zip.read(path))
+        ns = _ns(root.tag)
+        custom = dict(
+            (int(f.get('numFmtId')), f.get('formatCode', ''))
+            for f in root.iter(ns + 'numFmt')
+        )
+        xfs = root.find(ns + 'cellXfs')
+        found = set()
+        for i, xf in enumerate(xfs if xfs is not None else []):
+            fmt_id = int(xf.get('numFmtId', 0))
+            if fmt_id in custom:
+                if _is_date_format(custom[fmt_id]):
+                    found.add(i)
+            elif fmt_id in _DATE_FORMAT_IDS:
+                found.add(i)
+        return frozenset(found)
+
+    def _read_dimension(self):
+        # the sheet size from the dimension element ahead of the rows where
+        # it gives a range, otherwise from a pass over the rows; writers
+        # not knowing the size put a lone "A1" there
+        with self._zip.open(self._path) as f:
+            ns = None
+            for _, elem in ElementTree.iterparse(f, events=('start',)):
+                if ns is None:
+                    ns = _ns(elem.tag)
+                elif elem.tag == ns + 'dimension':
+                    ref = elem.get('ref', '').split(':')
+                    if len(ref) == 2 and ref[1][-1:].isdigit():
+                        nrows, ncols = _split_ref(ref[1])
+                        return nrows + 1, ncols + 1
+                    break
+                elif elem.tag == ns + 'sheetData':
+                    break
+
+        nrows = ncols = 0
+        for rowx, values, _ in self._parse(0):
+            nrows, ncols = rowx + 1, max(ncols, len(values))
+        return nrows, ncols
+
+    @property
+    def nrows(self):
+        return self._nrows
+
+    @property
+    def ncols(self):
+        return self._ncols
+
+    @property
+    def datemode(self):
+        return self._datemode
+
+    @property
+    def released(self):
+        return self._zip is None
+
+    def release(self):
+        """Closes the workbook. The sheet can't be read afterwards."""
+        self._close_rows()
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _check_open(self):
+        if self._zip is None:
+            raise ValueError('Sheet already released: %s' % (self.sheet_name,))
+        return self._zip
+
+    def _blocks(self):
+        # yields the root element of each block of whole rows in the sheet
+        # XML; a block is parsed as a document of its own, under a copy of
+        # the root start tag so that namespaces resolve as in the sheet
+        with self._check_open().open(self._path) as f:
+            buf = b''
+            while True:
+                block = f.read(READ_BLOCK_SIZE)
+                buf += block
+                found = _SHEET_DATA.search(buf)
+                if found or not block:
+                    break
+            if not found or found.group(3):     # no rows
+                return
+
+            root, prefix = found.group(1), found.group(2)
+            root_end = b'</' + _TAG_NAME.match(root, 1).group(0) + b'>'
+            row_end, data_end = (b'</' + prefix + b'row>',
+                                 b'</' + prefix + b'sheetData>')
+            buf = buf[found.end():]
+            while True:
+                block = f.read(READ_BLOCK_SIZE)
+                buf += block
+                end = buf.find(data_end)
+                if end < 0 and not block:       # cut short
+                    end = len(buf)
+                cut = end if end >= 0 else buf.rfind(row_end)
+                if cut < 0:
+                    continue
+                if end < 0:
+                    cut += len(row_end)
+                yield ElementTree.fromstring(root + buf[:cut] + root_end)
+                buf = buf[cut:]
+                if end >= 0:
+                    return
+
+    def _parse(self, ncols):
+        # yields (row index, values, xlrd cell types) for the rows in the
+        # sheet XML, rows padded to ncols
+        strings, date_styles = self._strings, self._date_styles
+        ROW = V = IS = T = None
+        rowx = -1
+        for block in self._blocks():
+            if ROW is None:
+                ns = _ns(block.tag)
+                ROW, V, IS, T = ns + 'row', ns + 'v', ns + 'is', ns + 't'
+
+            for row in block.iter(ROW):
+                ref = row.get('r')
+                rowx = int(ref) - 1 if ref else rowx + 1
+                values, ctypes = [u''] * ncols, [xlrd.XL_CELL_EMPTY] * ncols
+                colx = -1
+                for cell in row:
+                    ref = cell.get('r')
+                    colx = (_col_index(ref.rstrip('0123456789')) if ref else
+                            colx + 1)
+                    if colx >= len(values):
+                        grow = colx + 1 - len(values)
+                        values.extend([u''] * grow)
+                        ctypes.extend([xlrd.XL_CELL_EMPTY] * grow)
+
+                    kind, text = cell.get('t'), cell.findtext(V)
+                    if kind == 'inlineStr':
+                        node = cell.find(IS)
+                        values[colx] = u''.join(
+                            t.text or u'' for t in node.iter(T)
+                        ) if node is not None else u''
+                        ctypes[colx] = xlrd.XL_CELL_TEXT
+                    elif text is None:
+                        continue
+                    elif kind is None or kind == 'n':
+                        values[colx] = float(text)
+                        style = cell.get('s')
+                        ctypes[colx] = (
+                            xlrd.XL_CELL_DATE
+                            if style and int(style) in date_styles else
+                            xlrd.XL_CELL_NUMBER
+                        )
+                    elif kind == 's':
+                        values[colx] = strings[int(text)]
+                        ctypes[colx] = xlrd.XL_CELL_TEXT
+                    elif kind == 'b':
+                        values[colx] = int(text)
+                        ctypes[colx] = xlrd.XL_CELL_BOOLEAN
+                    elif kind == 'e':
+                        values[colx] = _ERROR_CODES.get(text, 0x2A)
+                        ctypes[colx] = xlrd.XL_CELL_ERROR
+                    else:       # 'str' formula results and 'd' ISO dates
+                        values[colx] = u'' + text
+                        ctypes[colx] = xlrd.XL_CELL_TEXT
+                yield rowx, values, ctypes
+
+    def _cells(self, start=0, stop=None):
+        # yields (values, cell types) for each row from start up to stop or
+        # the last row, filling in the rows left out of the XML as empty;
+        # rows past the dimension are read all the same and grow the size
+        if stop is not None and start >= stop:
+            return
+        ncols, next_rowx = self.ncols, start
+        for rowx, values, ctypes in self._parse(ncols):
+            self._nrows = max(self._nrows, rowx + 1)
+            self._ncols = max(self._ncols, len(values))
+            if rowx < next_rowx:
+                continue
+            while next_rowx < (rowx if stop is None else min(rowx, stop)):
+                yield [u''] * ncols, [xlrd.XL_CELL_EMPTY] * ncols
+                next_rowx += 1
+            if stop is not None and rowx >= stop:
+                return
+            yield values, ctypes
+            next_rowx += 1
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+        while next_rowx < stop:
+            yield [u''] * ncols, [xlrd.XL_CELL_EMPTY] * ncols
+            next_rowx += 1
+
+
+def _cell_xml(ref, value, strings):
+    if value is None or value == '':
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return '<c r="%s"><v>%r</v></c>' % (ref, value)
+    index = strings.setdefault(value, len(strings))
+    return '<c r="%s" t="s"><v>%s</v></c>' % (ref, index)
+
+
+def _col_letters(colx):
+    letters = ''
+    colx += 1
+    while colx:
+        colx, rem = divmod(colx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def write_xlsx(path, sheets):
+    """Writes rows of numbers and text to an .xlsx workbook, text as shared
+    strings, such as for test and benchmark workbooks larger than .xls sheets
+    can hold.
+
+    :: sheets: list of (sheet name, rows) pairs; rows can be a generator.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        strings, names = {}, []
+        for i, (name, rows) in enumerate(sheets):
+            names.append(name)
+            nrows = ncols = 0
+            rows_part = os.path.join(tempdir, 'rows.xml')
+            with io.open(rows_part, 'w', encoding='utf-8') as f:
+                for rowx, row in enumerate(rows):
+                    f.write(u'<row r="%s">%s</row>' % (rowx + 1, u''.join(
+                        _cell_xml('%s%s' % (_col_letters(colx), rowx + 1),
+                                  value, strings)
+                        for colx, value in enumerate(row)
+                    )))
+                    nrows, ncols = rowx + 1, max(ncols, len(row))
+
+            # the dimension goes ahead of the rows, as Excel writes it
+            part = os.path.join(tempdir, 'sheet%s.xml' % (i + 1))
+            with open(part, 'wb') as f, open(rows_part, 'rb') as rows_file:
+                f.write((
+                    '<?xml version="1.0" encoding="UTF-8"?>\n<worksheet '
+                    'xmlns="http://schemas.openxmlformats.org/spreadsheetml/'
+                    '2006/main"><dimension ref="A1:%s%s"/><sheetData>' % (
+                        _col_letters(max(ncols, 1) - 1), max(nrows, 1))
+                ).encode('utf-8'))
+                shutil.copyfileobj(rows_file, f)
+                f.write(b'</sheetData></worksheet>')
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as book:
+            book.writestr('[Content_Types].xml', _content_types(len(names)))
+            book.writestr('_rels/.rels', _ROOT_RELS)
+            book.writestr('xl/workbook.xml', _WORKBOOK % ''.join(
+                '<sheet name="%s" sheetId="%s" r:id="rId%s"/>' % (
+                    escape(n, {'"': '&quot;'}), i + 1, i + 1)
+                for i, n in enumerate(names)
+            ))
+            book.writestr('xl/_rels/workbook.xml.rels', _RELS % (''.join(
+                '<Relationship Id="rId%s" Type="%s/worksheet" '
+                'Target="worksheets/sheet%s.xml"/>' % (i + 1, _REL_TYPE, i + 1)
+                for i in range(len(names))
+            ) + '<Relationship Id="rIdS" Type="%s/sharedStrings" '
+                'Target="sharedStrings.xml"/>' % _REL_TYPE))
+            for i in range(len(names)):
+                book.write(os.path.join(tempdir, 'sheet%s.xml' % (i + 1)),
+                           'xl/worksheets/sheet%s.xml' % (i + 1))
+
+            ordered = sorted(strings, key=strings.get)
+            book.writestr('xl/sharedStrings.xml', (
+                u'<?xml version="1.0" encoding="UTF-8"?>\n<sst xmlns="http://'
+                u'schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                u'uniqueCount="%s">%s</sst>' % (len(ordered), u''.join(
+                    u'<si><t xml:space="preserve">%s</t></si>' % escape(s)
+                    for s in ordered
+                ))
+            ).encode('utf-8'))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+_REL_TYPE = ('http://schemas.openxmlformats.org/officeDocument/2006/'
+             'relationships')
+
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<Relationships xmlns="http://'
+    'schemas.openxmlformats.org/package/2006/relationships"><Relationship '
+    'Id="rId1" Type="%s/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>' % _REL_TYPE
+)
+
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<Relationships xmlns="http://'
+    'schemas.openxmlformats.org/package/2006/relationships">%s'
+    '</Relationships>'
+)
+
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<workbook xmlns="http://'
+    'schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="%s">'
+    '<sheets>%%s</sheets></workbook>' % _REL_TYPE
+)
+
+
+def _content_types(count):
+    main = 'application/vnd.openxmlformats-officedocument.spreadsheetml'
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<Types xmlns="http://'
+        'schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.'
+        'openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="%s.sheet.main+xml"'
+        '/>%s<Override PartName="/xl/sharedStrings.xml" '
+        'ContentType="%s.sharedStrings+xml"/></Types>' % (main, ''.join(
+            '<Override PartName="/xl/worksheets/sheet%s.xml" '
+            'ContentType="%s.worksheet+xml"/>' % (i + 1, main)
+            for i in range(count)
+        ), main)
+    )
@@ -0,0 +1,200 @@
+"""
+Defines benchmarks for the KEDCO desk scripts on top of the dant suites.
+
+Usage: python -m kedant.bench --sizes 10000,100000,1000000 [--repeat N]
+                              [--output results.jsonl] [--compare base.jsonl]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sqlite3
+import sys
+
+from itertools import chain
+
+from dant.bench import ORBIS_HEADER, SUITES, orbis_rows, run_case
+from dant.bench import run_suites
+from dant.db import BatchInserter, DmlRunner
+from kedant.desk import duplicates as dup
+from kedant.desk import new_customers as nc
+from kedant.desk.dala_customers_renumeration import load_xl2db
+
+
+
+# book numbers account numbers are drawn from
+BENCH_BOOKS = ['32/55/%02d' % i for i in range(100)]
+
+
+def _qorbis_rows(size):
+    # QuadOrbis records, as read by _provider, built from Orbis rows
+    positions = [ORBIS_HEADER.index(c) for c in nc.QORBIS_COLUMNS[1:]]
+    acctnos = chain.from_iterable(
+        nc.generate_acct_number(b)
+        for b in BENCH_BOOKS * (size // (1000 * len(BENCH_BOOKS)) + 1)
+    )
+    rows = []
+    for i, row in enumerate(orbis_rows(size)):
+        record = dict(zip(nc.QORBIS_COLUMNS[1:],
+                          [row[p] for p in positions]))
+        record['Id'] = i + 1
+        record['AcctNo'] = next(acctnos)
+        rows.append(record)
+    return rows
+
+
+def suite_normalizers(ctx):
+    """The new_customers.py normalizers row by row and column-wise."""
+    rows = _qorbis_rows(ctx.size)
+    columns = dict((c, [r[c] for r in rows]) for c in nc.QORBIS_COLUMNS)
+
+    def scalar():
+        for r in rows:
+            name = nc._get_cust_name(r['FirstName'], r['MiddleName'],
+                                     r['LastName'])
+            nc._get_cust_address(r['Building#'], r['Street'],
+                                 r['Settlement'], r['Ward'])
+            nc._get_phone(r['Phone1'], r['Phone2'], r['Mobile'], r['Street'])
+            nc._get_tariff(name, r['CustType'], r['#Rooms'])
+
+    def batch():
+        cleansed = nc.clean_records(columns)
+        nc.TARIFF_CLASSIFIER.classify(cleansed['name'], columns['CustType'],
+                                      columns['#Rooms'])
+
+    # timed from an empty memo cache each run, as a first pass over a
+    # business unit, and from a cache warmed up by such a pass, as reruns
+    def memoized():
+        for r in rows:
+            nc._fetch_tariff(r)
+            nc._fetch_cust_address(r)
+            nc._fetch_phone(r)
+
+    results = [
+        run_case('normalizers.scalar', scalar, ctx.size, ctx.size,
+                 repeat=ctx.repeat),
+        run_case('normalizers.batch', batch, ctx.size, ctx.size,
+                 repeat=ctx.repeat),
+        run_case('normalizers.memoized.cold', memoized, ctx.size, ctx.size,
+                 repeat=ctx.repeat, setup=nc.NORMALIZERS.clear),
+    ]
+    memoized()
+    results.append(run_case('normalizers.memoized.warm', memoized, ctx.size,
+                            ctx.size, repeat=ctx.repeat))
+    nc.NORMALIZERS.clear()
+    return results
+
+
+def suite_acct_numbers(ctx):
+    """generate_acct_number across as many books as the size takes."""
+    books = BENCH_BOOKS * (ctx.size // (1000 * len(BENCH_BOOKS)) + 1)
+    def generate():
+        remaining = ctx.size
+        for book in books:
+            for _ in nc.generate_acct_number(book):
+                remaining -= 1
+                if not remaining:
+                    return
+
+    return [run_case('generate_acct_number', generate, ctx.size, ctx.size,
+                     'numbers', ctx.repeat)]
+
+
+def suite_load_xl2db(ctx):
+    """load_xl2db of the workbook into a SQLite table of Orbis columns."""
+    if not ctx.workbook:
+        return []
+
+    path = os.path.join(ctx.workdir, 'load-bench.sqlite3')
+    text = 'INSERT INTO orbis VALUES (%s)' % (
+        ', '.join('?' * len(ORBIS_HEADER))
+    )
+
+    def setup():
+        if os.path.exists(path):
+            os.remove(path)
+
+    def load():
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE orbis (%s)' % ', '.join(
+            'c%s' % i for i in range(len(ORBIS_HEADER))
+        ))
+        with conn, BatchInserter(conn, text) as inserter:
+            for name in ctx.sheets:
+                load_xl2db(ctx.workbook, name, ORBIS_HEADER[:3],
+                           lambda r: inserter.add(r) if r else None)
+        conn.close()
+
+    return [run_case('load_xl2db.sqlite3', load, ctx.size, ctx.size,
+                     repeat=ctx.repeat, setup=setup)]
+
+
+def suite_customer_dml(ctx, workers=(1, 4)):
+    """The tmp.NewCustomers UPDATE statements of
+    update_customer_info_and_tariff, run by dant.db.DmlRunner rather than the
+    desk runners against a SQLite stand-in.
+    """
+    main_path = os.path.join(ctx.workdir, 'dml-main.sqlite3')
+    tmp_path = os.path.join(ctx.workdir, 'dml-tmp.sqlite3')
+    rows = _qorbis_rows(ctx.size)
+    statements = [(r['Id'], nc._build_dml_for_qorbis_data_having_acctno(r))
+                  for r in rows]
+
+    def connect():
+        conn = sqlite3.connect(main_path, timeout=60)
+        conn.execute("ATTACH DATABASE '%s' AS tmp" % tmp_path)
+        return conn
+
+    def setup():
+        for path in (main_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+        conn = connect()
+        conn.execute('PRAGMA tmp.journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE tmp.NewCustomers (QOrbisId INTEGER PRIMARY KEY, '
+            'Name, AccountNo, Mobile, Tariff, TariffRate, FixedCharge, '
+            'Consumption, ADC)'
+        )
+        conn.executemany(
+            'INSERT INTO tmp.NewCustomers (QOrbisId) VALUES (?)',
+            [(r['Id'],) for r in rows]
+        )
+        conn.commit()
+        conn.close()
+
+    return [
+        run_case('dml_runner.nc_updates.workers-%s' % n,
+                 lambda n=n: DmlRunner(connect, n).run(statements),
+                 ctx.size, ctx.size, 'statements', ctx.repeat, setup)
+        for n in workers
+    ]
+
+
+def suite_duplicates(ctx):
+    """find_duplicate_customers over the QuadOrbis records and a tenth of
+    them as active customers, most having meter numbers of their own which
+    the active customers share with their census records.
+    """
+    rows, rnd = _qorbis_rows(ctx.size), random.Random(2016)
+    for r in rows:
+        r['MeterNo'] = ('%011d' % rnd.randrange(10 ** 10)
+                        if rnd.random() < 0.7 else rnd.choice(('', 'AVR')))
+    active = [dict(acctno=r['AcctNo'], acctname=nc._fetch_cust_name(r),
+                   address='%s %s' % (r['Building#'], r['Street']),
+                   meterno=r['MeterNo'], mobile=r['Mobile'])
+              for r in rows[::10]]
+
+    return [run_case('find_duplicate_customers',
+                     lambda: dup.find_duplicate_customers(rows, active),
+                     ctx.size, len(rows) + len(active), 'customers',
+                     ctx.repeat)]
+
+
+KEDANT_SUITES = SUITES + (suite_normalizers, suite_acct_numbers,
+                          suite_load_xl2db, suite_customer_dml,
+                          suite_duplicates)
+
+
+if __name__ == '__main__':
+    run_suites(KEDANT_SUITES, sys.argv[1:])
@@ -0,0 +1,112 @@
+"""
+Generates customer account numbers and allocates them in blocks across books.
+
+An account number is made of the 6 digits of the book, a 3 digit serial and
+a check digit: the sum of the 9 digits weighted 1 to 9, modulo 10.
+"""
+import sqlite3
+import time
+
+
+# number of account numbers in a book
+BOOK_SIZE = 1000
+
+# weight of the serial digits in the check digit, indexed by serial
+_SERIAL_WEIGHTS = [7 * (s // 100) + 8 * (s // 10 % 10) + 9 * (s % 10)
+                   for s in range(BOOK_SIZE)]
+
+
+def book_digits(book_number):
+    """Returns the 6 digits of a book number such as '32/55/42'."""
+    bookno = book_number.replace('-','').replace('/','')
+    if not bookno or len(bookno) != 6:
+        raise ValueError("book_number cannot be empty or not of 6 digits")
+
+    if not bookno.isdigit():
+        raise ValueError("Invalid book number provided")
+    return bookno
+
+
+def acct_numbers(book_number, start=0, stop=BOOK_SIZE):
+    """Returns the account numbers of a book for serials start to stop - 1."""
+    bookno = book_digits(book_number)
+    weight = sum(i * int(d) for i, d in enumerate(bookno, 1))
+    prefix = "%s/%s/%s/" % (bookno[:2], bookno[2:4], bookno[4:6])
+    return ["%s%03d%d-01" % (prefix, s, (weight + _SERIAL_WEIGHTS[s]) % 10)
+            for s in range(start, stop)]
+
+
+class AcctNumberAllocator(object):
+    """Hands out account numbers in blocks across books taken in order. The
+    serials issued per book are recorded in a SQLite file and reserved within
+    a single transaction so concurrent or repeated runs never issue the same
+    number twice.
+
+    :: path: path to the SQLite file recording the issued numbers.
+    :: books: the book numbers to allocate from, in order.
+    """
+
+    DB_SCRIPT = """
+    CREATE TABLE IF NOT EXISTS acct_books (
+        book          VARCHAR(6) PRIMARY KEY,
+        next_serial   INT
+    );
+    CREATE TABLE IF NOT EXISTS acct_blocks (
+        book          VARCHAR(6),
+        first_serial  INT,
+        last_serial   INT,
+        issued        VARCHAR(20)
+    );
+    """
+
+    def __init__(self, path, books, timeout=30):
+        self.path = path
+        self.books = [book_digits(b) for b in books]
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None)
+        self._conn.executescript(self.DB_SCRIPT)
+
+    def close(self):
+        self._conn.close()
+
+    def next_serial(self, book_number):
+        found = self._conn.execute(
+            "SELECT next_serial FROM acct_books WHERE book = ?",
+            (book_digits(book_number),)
+        ).fetchone()
+        return found[0] if found else 0
+
+    def allocate(self, count):
+        """Returns the next `count` account numbers across the books."""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            blocks, remaining = [], count
+            for book in self.books:
+                if remaining <= 0:
+                    break
+                first = self.next_serial(book)
+                taken = min(BOOK_SIZE - first, remaining)
+                if taken > 0:
+                    blocks.append((book, first, first + taken))
+                    remaining -= taken
+
+            if remaining > 0:
+                raise ValueError(
+                    "Not enough account numbers left in the books: %s short"
+                    % remaining
+                )
+
+            issued = time.strftime('%Y-%m-%d %H:%M:%S')
+            for book, first, stop in blocks:
+                conn.execute("INSERT OR REPLACE INTO acct_books VALUES (?, ?)",
+                             (book, stop))
+                conn.execute("INSERT INTO acct_blocks VALUES (?, ?, ?, ?)",
+                             (book, first, stop - 1, issued))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return [n for book, first, stop in blocks
+                for n in acct_numbers(book, first, stop)]
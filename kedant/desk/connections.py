@@ -0,0 +1,90 @@
+"""
+Database connections shared by the desk scripts.
+
+Connections are opened lazily from a pool configured through the JSON file at
+$KEDANT_CONFIG (defaults to kedant.json at the root of the toolbox), e.g.:
+
+  {"database": {"connection_string": "driver={sql server};...",
+                "pool_size": 4, "health_check": "SELECT 1", "timeout": 60}}
+"""
+import os
+import sys
+import threading
+
+from os import path
+from dant.db import ConnectionPool
+
+
+# settings
+BASE_DIR = path.abspath(path.join(path.dirname(__file__), '..', '..'))
+for f in os.listdir(path.join(BASE_DIR, 'library')):
+    if path.join(BASE_DIR, 'library', f) not in sys.path:
+        sys.path.insert(0, path.join(BASE_DIR, 'library', f))
+
+CONFIG_PATH = os.environ.get(
+    'KEDANT_CONFIG', path.join(BASE_DIR, 'kedant.json')
+)
+
+
+from dolfin import Config, Storage
+
+
+class DeskConfig(Config):
+    """Configuration settings for the desk scripts."""
+    pass
+
+
+def register_defaults(config_type, **defaults):
+    """Registers default settings of a dolfin Config type. Config sets up its
+    defaults through a metaclass python 3 doesn't apply, so these are set up
+    here where missing.
+    """
+    if '_defaults' not in vars(config_type):
+        config_type._defaults = Storage()
+        config_type._func_defaults = Storage()
+    config_type._defaults.update(Storage.make(defaults))
+
+
+register_defaults(DeskConfig, database=dict(
+    connection_string=('driver={sql server};server=.\\sqlexpress;'
+                       'database=kedco;trusted_connection=yes;'),
+    pool_size=4,
+    health_check='SELECT 1',
+    timeout=None
+))
+
+
+_lock = threading.Lock()
+_state = dict(config=None, pool=None)
+
+
+def get_config():
+    if _state['config'] is None:
+        _state['config'] = (DeskConfig(CONFIG_PATH)
+                            if path.isfile(CONFIG_PATH) else DeskConfig())
+    return _state['config']
+
+
+def connect():
+    """Opens a new connection outside the pool; the caller closes it."""
+    import pyodbc
+    return pyodbc.connect(get_config().database.connection_string)
+
+
+def get_pool():
+    with _lock:
+        if _state['pool'] is None:
+            settings = get_config().database
+            _state['pool'] = ConnectionPool(
+                connect, size=settings.pool_size or 4,
+                health_check=settings.health_check,
+                timeout=settings.timeout
+            )
+    return _state['pool']
+
+
+def connection():
+    """Returns a context manager which acquires a pooled connection and gives
+    it back to the pool on exit; uncommitted work is rolled back.
+    """
+    return get_pool().connection()
@@ -5,9 +5,13 @@ Quick and dirty scripts for customer analysis
 """
 import os, sys
 import sqlite3
-import pyodbc
+import time
 
-from dant.data import XlSheet
+from dant.data import DELIMITED_EXTENSIONS, XLSX_EXTENSIONS, open_sheet
+from dant.db import BatchInserter, CheckpointStore, sqlite_fast_load
+from dant.ingest import ParallelLoader, format_stats
+from dant.rows import RowStream
+from kedant.desk.connections import connect, connection
 
 
 # settings
@@ -21,7 +25,30 @@ TEST_DATA_DIR = os.path.join(BASE_DIR, 'test-data')
 # create database (sqlite3)
 DB_PATH = os.path.join(TEST_DATA_DIR, 'cust-db.sqlite3')
 
-def create_db(db_path, force=False):
+# last committed source row per (file, sheet, table) for resuming loads
+CHECKPOINT_PATH = os.path.join(TEST_DATA_DIR, 'load-checkpoints.sqlite3')
+
+# rows sent per executemany call & batches sent between commits
+BATCH_SIZE = 1000
+COMMIT_EVERY = 10
+
+# batches sent between commits by SQLite fast loads
+SQLITE_COMMIT_EVERY = 100
+
+# secondary indexes of cust_active; built once the data is in
+CUST_ACTIVE_INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_cust_active_acctno ON cust_active (acctno);
+CREATE INDEX IF NOT EXISTS ix_cust_active_meterno ON cust_active (meterno);
+CREATE INDEX IF NOT EXISTS ix_cust_active_mobile ON cust_active (mobile);
+"""
+
+# column types decoded by read_xl2rows: the serial number of active
+# customer sheets and the serial number, mobile numbers & remarks of Orbis
+# exports, which xlrd otherwise reads as floats where typed in as numbers
+ACTIVE_SCHEMA = {0: 'int'}
+ORBIS_SCHEMA = {0: 'int', 20: 'str', 21: 'str', 25: 'str'}
+
+def create_db(db_path, force=False, indexes=True):
     if os.path.exists(db_path):
         if not force: return
         else: os.remove(db_path)
@@ -41,140 +68,312 @@ def create_db(db_path, force=False):
     """
     conn = sqlite3.connect(db_path)
     conn.executescript(DB_SCRIPT)
+    if indexes:
+        conn.executescript(CUST_ACTIVE_INDEXES)
+    conn.close()
 
 
-def load_xl2db(xlfilepath, sheetname, header_cols, insfunc, start_row=0):
+def load_xl2db(xlfilepath, sheetname, header_cols, insfunc, start_row=0,
+               rejects=None, instrument=None, sheet_cache=None,
+               schema=ACTIVE_SCHEMA, errors=None):
     """Extracts data from an Excel sheet and loads into a database table.
     
     insfunc: insert function used to load data into database
+    rejects: optional function called as rejects(reason, row) for junk rows
+    instrument: optional dant.instrument.Instrument recording the stages
+    sheet_cache: optional dant.cache.SheetCache the sheet is read through
+    schema: see read_xl2rows
+    errors: optional list bad cells are appended to
+    
+    Returns the list of bad cells found, as dant.data.CellError objects.
     """
-    def is_header(row):
-        hText = ('!!'.join(header_cols)).lower()
-        rText = ('!!'.join([str(r) for r in row[:len(header_cols)]])).lower()
-        return hText == rText
+    errors = [] if errors is None else errors
+    rows = read_xl2rows(
+        xlfilepath, sheetname, header_cols, start_row, rejects, instrument,
+        sheet_cache, schema, errors
+    )
+    if not instrument:
+        for _, row in rows:
+            insfunc(row)
+        return errors
+    
+    for _, row in rows:
+        with instrument.timer('load'):
+            insfunc(row)
+        instrument.count('load', 'rows')
+    return errors
+
+
+def read_xl2rows(xlfilepath, sheetname, header_cols, start_row=0,
+                 rejects=None, instrument=None, sheet_cache=None,
+                 schema=ACTIVE_SCHEMA, errors=None):
+    """Yields (sheet row index, row) pairs for the normalized data rows of an
+    Excel sheet or a .csv/.tsv file, starting after the header or at
+    start_row if further down.
+    
+    Columns in the schema are decoded in bulk to their types; bad cells are
+    read as None and appended to errors as dant.data.CellError objects, or
+    printed once the rows are used up when no errors list is provided. Rows
+    are normalized by norm_row instead without a schema.
     
-    #load sheet & file header
-    sheet = XlSheet(xlfilepath, sheetname)
-    row = sheet.getrow()
-    while not is_header(row):
-        row = sheet.getrow()
+    With an instrument, sheet reads are recorded under the 'read' stage and
+    normalization under the 'normalize' stage. With a sheet cache, the sheet
+    is parsed by xlrd only the first time it is read. Sheets of .xlsx
+    workbooks are streamed rather than loaded and delimited files are parsed
+    in worker processes, neither going through the sheet cache, which reads
+    workbooks with xlrd.
+    """
+    if instrument:
+        def on_reject(reason, row):
+            instrument.count('normalize', 'rejected')
+            if rejects:
+                rejects(reason, row)
     
-    # now perform data load
-    for row in sheet.getrows(start_row=(start_row or 0)):
-        insfunc(norm_row(row))
+    ext = os.path.splitext(xlfilepath)[1].lower()
+    if sheet_cache and ext not in DELIMITED_EXTENSIONS + XLSX_EXTENSIONS:
+        sheet = sheet_cache.open(xlfilepath, sheetname, instrument,
+                                 on_demand=True)
+    else:
+        sheet = open_sheet(xlfilepath, sheetname, on_demand=True,
+                           instrument=instrument)
+    stream = RowStream(header_cols, normalize=None if schema else norm_row,
+                       rejects=on_reject if instrument else rejects)
+    first_row = max(stream.find_header(sheet.getrows()) + 1, start_row or 0)
+    bad_cells = [] if errors is None else errors
+    if schema:
+        rows = sheet.decode_rows(schema, first_row, errors=bad_cells)
+    else:
+        rows = sheet.getrows(start_row=first_row)
+    rows = _read_through(sheet, stream.ifilter(rows, first_row),
+                         bad_cells if errors is None else None)
+    if instrument:
+        rows = instrument.iterate('normalize', rows)
+    return rows
+
+
+def _read_through(sheet, rows, bad_cells=None):
+    # releases the sheet once the rows are used up or dropped, and prints
+    # the bad cells of rows read without an errors list
+    try:
+        for item in rows:
+            yield item
+    finally:
+        sheet.release()
+    if bad_cells:
+        print_bad_cells(bad_cells)
+
+
+def print_bad_cells(errors):
+    """Prints bad cells, as dant.data.CellError objects, a line per cell."""
+    for error in errors:
+        print('Bad cell at row %s, column %s: %r (%s)' % error)
 
 
 def norm_row(row):
-    if row and row[0] != '' and not row[1].startswith('Total'):
-        new_row = [int(row[0])]
-        
-        new_row.extend(
-            [r.strip() for r in row[1:]]
-        )
-        print(new_row)
-        return new_row
-    return None
+    # serial numbers come as floats from sheets and as text from csv files
+    return [int(float(row[0]))] + row[1:]
 
 
-def do4sqlite3(dbpath, xlfilepath, sheetname, header_cols):
+def do4sqlite3(dbpath, xlfilepath, sheetname, header_cols,
+               batch_size=BATCH_SIZE, instrument=None, fast_load=True):
+    """Loads active customers into a new SQLite database. With fast_load,
+    the load runs under sqlite_fast_load and commits less often; indexes
+    are built once the data is in either way. The database is removed if
+    the load fails.
+    """
     # create the database
-    create_db(dbpath, force=True)
+    create_db(dbpath, force=True, indexes=False)
     
     conn = sqlite3.connect(dbpath)
     text = ("INSERT INTO cust_active "
             "(sn, acctno, acctname, address, meterno, tariff, mobile, email) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
     
+    started, errors = time.time(), []
     try:
-        with conn:
-            load_xl2db(
-                xlfilepath, sheetname, header_cols,
-                lambda r: conn.execute(text, r) if r else None
-            )
+        with conn, BatchInserter(
+                conn, text, batch_size,
+                SQLITE_COMMIT_EVERY if fast_load else COMMIT_EVERY,
+                instrument=instrument) as inserter:
+            def load():
+                load_xl2db(
+                    xlfilepath, sheetname, header_cols,
+                    lambda r: inserter.add(r) if r else None,
+                    instrument=instrument, errors=errors
+                )
+                inserter.flush()
+                conn.executescript(CUST_ACTIVE_INDEXES)
+            
+            if fast_load:
+                with sqlite_fast_load(conn):
+                    load()
+            else:
+                load()
+        
+        seconds = time.time() - started
+        print('Loaded %s rows in %.2fs (%.0f rows/s), %s bad cells' % (
+            inserter.rows_sent, seconds,
+            (inserter.rows_sent / seconds) if seconds else 0, len(errors)
+        ))
     except Exception as ex:
         print('Error encountered: %s' % ex)
+        # a partial cust_active would pass for a complete one later on
+        conn.close()
+        os.remove(dbpath)
     finally:
         conn.close()
+        print_bad_cells(errors)
         print('Done!')
 
 
-def do4books(xlfilepath, sheetname, header_cols, table):
-    # connect to database
-    conn = pyodbc.connect('driver={sql server};server=.\sqlexpress;'
-                          'database=kedco;trusted_connection=yes;')
+def do4books(xlfilepath, sheetname, header_cols, table,
+             batch_size=BATCH_SIZE, instrument=None):
     text = "INSERT INTO %s (book) VALUES (?)" % (table,)
     try:
-        with conn:
-            load_xl2db(
+        with connection() as conn, BatchInserter(
+                conn, text, batch_size, COMMIT_EVERY,
+                instrument=instrument) as inserter:
+            print_bad_cells(load_xl2db(
                 xlfilepath, sheetname, header_cols,
-                lambda r: conn.execute(text, r[1:]) if r else None
-            )
+                lambda r: inserter.add(r[1:]) if r else None,
+                instrument=instrument
+            ))
     except Exception as ex:
         print('Error encountered: %s' % ex)
     finally:
-        conn.close()
         print('Done!')
 
 
-def do4mssql(xlfilepath, sheetname, header_cols, table, isactive, bUnit):
-    # connect to database
-    conn = pyodbc.connect('driver={sql server};server=.\sqlexpress;'
-                          'database=kedco;trusted_connection=yes;')
+def do4mssql(xlfilepath, sheetname, header_cols, table, isactive, bUnit,
+             batch_size=BATCH_SIZE, instrument=None):
     text = "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, %s, '%s')" % (
                 table, (1 if isactive else 0), bUnit
            )
     try:
-        with conn:
-            load_xl2db(
+        with connection() as conn, BatchInserter(
+                conn, text, batch_size, COMMIT_EVERY,
+                instrument=instrument) as inserter:
+            print_bad_cells(load_xl2db(
                 xlfilepath, sheetname, header_cols,
-                lambda r: conn.execute(text, r) if r else None
-            )
+                lambda r: inserter.add(r) if r else None,
+                instrument=instrument
+            ))
     except Exception as ex:
         print('Error encountered: %s' % ex)
     finally:
-        conn.close()
         print('Done!')
 
 
-def do4mssql_orbis(xlfilepath, sheetname, header_cols, table, start_row=0):
-    def filter_row_cols(row):
-        if not row: return
-        new_row = row[:32] + [row[46]] + [row[49]]
-        new_row[25] = new_row[25][:25]
-        
-        # handle combined phone numbers
-        mobiles = new_row[20]
-        if mobiles.find(',') != -1:
-            mobile_list = [m.strip() for m in mobiles.split(',')]
-            new_row[20] = mobile_list[0]
-            new_row[21] = mobile_list[1]
-        
-        conn.execute(text, new_row)
+def filter_orbis_row(row):
+    """Returns the values of an Orbis export row loaded into the Orbis table,
+    as read with ORBIS_SCHEMA.
+    """
+    # the columns of ORBIS_SCHEMA come decoded
+    new_row = row[:32] + [row[46]] + [row[49]]
+    new_row[25] = new_row[25][:25]
+    
+    # handle combined phone numbers
+    mobiles = new_row[20]
+    if mobiles.find(',') != -1:
+        mobile_list = [m.strip() for m in mobiles.split(',')]
+        new_row[20] = mobile_list[0]
+        new_row[21] = mobile_list[1]
+    return new_row
+
+
+def do4mssql_orbis(xlfilepath, sheetname, header_cols, table, start_row=0,
+                   batch_size=BATCH_SIZE, checkpoint_path=CHECKPOINT_PATH,
+                   instrument=None, sheet_cache=None):
+    """Loads an Orbis export, resuming after the last committed row of a
+    previous run over the same file, sheet and table. The checkpoint is
+    cleared once the whole export is loaded.
+    """
+    # resume after last committed row
+    checkpoints = CheckpointStore(checkpoint_path)
+    last_row = checkpoints.get(xlfilepath, sheetname, table)
+    if last_row is not None:
+        start_row = max(start_row or 0, last_row + 1)
+        print('Resuming from row %s' % start_row)
     
-    # connect to database
-    conn = pyodbc.connect('driver={sql server}; server=.\sqlexpress;'
-                          'database=kedco; trusted_connection=yes;')
     text = (("INSERT INTO %s VALUES "
              "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,"
              " ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,"
              " ?,?,?,?)") % table)
+    save_checkpoint = lambda row: checkpoints.set(
+        xlfilepath, sheetname, table, row
+    )
+    errors = []
     try:
-        with conn:
-            load_xl2db(
-                xlfilepath, sheetname, header_cols,
-                filter_row_cols, start_row=start_row
+        with connection() as conn, BatchInserter(
+                conn, text, batch_size, COMMIT_EVERY,
+                on_commit=save_checkpoint,
+                instrument=instrument) as inserter:
+            rows = read_xl2rows(
+                xlfilepath, sheetname, header_cols, start_row=start_row,
+                instrument=instrument, sheet_cache=sheet_cache,
+                schema=ORBIS_SCHEMA, errors=errors
             )
+            for index, row in rows:
+                inserter.add(filter_orbis_row(row), index)
     except Exception as ex:
-        conn.commit()
+        # rows sent since the last checkpoint are rolled back on leaving the
+        # `with` block and are loaded again on the next run
         print('Error encountered: %s' % ex)
+        last_row = checkpoints.get(xlfilepath, sheetname, table)
+        if last_row is None:
+            print('No rows committed; the next run starts from row %s' %
+                  (start_row or 0))
+        else:
+            print('Rows up to %s committed; the next run resumes from row %s'
+                  % (last_row, last_row + 1))
         sys.exit()
+    else:
+        # a full load leaves nothing to resume
+        checkpoints.clear(xlfilepath, sheetname, table)
     finally:
-        conn.close()
+        checkpoints.close()
+        print_bad_cells(errors)
         print('Done!')
 
 
+def _read_job(job, emit):
+    return load_xl2db(
+        job.xlfilepath, job.sheetname, job.header_cols,
+        lambda r: emit(r) if r else None
+    )
+
+
+def _read_orbis_job(job, emit):
+    errors = []
+    rows = read_xl2rows(job.xlfilepath, job.sheetname, job.header_cols,
+                        schema=ORBIS_SCHEMA, errors=errors)
+    for _, row in rows:
+        emit(filter_orbis_row(row))
+    return errors
+
+
+def do4mssql_parallel(jobs, processes=None, writers=2, orbis=False):
+    """Loads several sheets into SQL Server, parsing the workbooks in a pool
+    of worker processes.
+    
+    jobs: list of (xlfilepath, sheetname, header_cols, table[, columns])
+        entries; columns names the table columns the rows go into, for
+        tables having more columns than the sheets
+    orbis: whether the sheets are Orbis exports, whose rows are filtered as
+        by do4mssql_orbis
+    """
+    loader = ParallelLoader(
+        _read_orbis_job if orbis else _read_job, connect,
+        processes=processes, writers=writers, batch_size=BATCH_SIZE,
+        commit_every=COMMIT_EVERY
+    )
+    stats = loader.run(jobs)
+    print(format_stats(stats))
+    return stats
+
+
 if __name__ == '__main__':
-    BASE_DIR = "C:\Users\Klone\Documents\WorkDocuments\KEDCO\Dala Customers"
+    BASE_DIR = r"C:\Users\Klone\Documents\WorkDocuments\KEDCO\Dala Customers"
     
     # load active customers
     for x in ("NEW_BOOKS_FOR_DALA_ACCTS.xls",):
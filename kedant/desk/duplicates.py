@@ -0,0 +1,216 @@
+"""
+Finds likely duplicate customers across the QuadOrbis census (tmp.QuadOrbis)
+and the active customers (cust_active), such as a household given two
+account numbers, by comparing their cleansed names, addresses, phone and
+meter numbers.
+"""
+from __future__ import print_function
+
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from dant.data import string_types
+from dant.dedupe import DuplicateFinder, Field
+from kedant.desk import new_customers as nc
+from kedant.desk.connections import connection
+
+
+
+# settings
+BASE_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..','..')
+)
+
+# database cust_active is loaded into by dala_customers_renumeration
+ACTIVE_DB_PATH = os.path.join(BASE_DIR, 'test-data', 'cust-db.sqlite3')
+
+# tmp.QuadOrbis column of meter numbers, as named in Orbis exports; it is
+# only read where the table has it, else census customers go without
+QORBIS_METERNO_COLUMN = 'MeterNo'
+
+# tmp.QuadOrbis & cust_active columns customers are read from
+QORBIS_DUPLICATE_COLUMNS = nc.QORBIS_COLUMNS
+ACTIVE_DUPLICATE_COLUMNS = ('acctno', 'acctname', 'address', 'meterno',
+                            'mobile')
+
+# fields customers are compared on, with their weights
+CUSTOMER_FIELDS = (
+    Field('name', 4, False),
+    Field('address', 3, False),
+    Field('house', 2, True),
+    Field('phone', 2, True),
+    Field('meterno', 2, True),
+)
+
+# kinds of the blocking keys of customers, as built by customer_keys
+BLOCKING_KEYS = ('phone', 'meterno', 'name', 'address')
+
+# lowest score of customers taken as duplicates
+DUPLICATE_THRESHOLD = 0.85
+
+_ADDRESS_SUFFIX = ', Kano, Kano State'
+_NON_DIGITS = re.compile(r'\D+')
+_NON_ALNUM = re.compile(r'[^0-9A-Z]+')
+
+
+def _text(value):
+    # cells read from sheets can be empty or numbers
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return value if isinstance(value, string_types) else str(value)
+
+
+def _address(address):
+    address = address[:-len(_ADDRESS_SUFFIX)] if address.endswith(
+        _ADDRESS_SUFFIX) else address
+    return address.strip().lower()
+
+
+def _phone(phone):
+    # the last 10 digits, alike for 0803..., 803... & +234803... numbers
+    digits = _NON_DIGITS.sub('', phone)
+    return digits[-10:] if len(digits) >= 9 else ''
+
+
+def _meterno(meterno):
+    return _NON_ALNUM.sub('', meterno.upper())
+
+
+def _customer(name, address, phone, meterno):
+    # neighbours share all of an address but the house number, the first
+    # word of it having digits
+    address = _address(address)
+    house = [t for t in address.split() if any(c.isdigit() for c in t)]
+    return dict(
+        name = name.lower(),
+        address = address,
+        house = house[0] if house else '',
+        phone = _phone(phone),
+        meterno = _meterno(meterno),
+    )
+
+
+def qorbis_customer(row):
+    """Returns the fields compared for duplicates of a tmp.QuadOrbis row;
+    rows without a QORBIS_METERNO_COLUMN go without a meter number.
+    """
+    return _customer(
+        nc._fetch_cust_name(row), nc._fetch_cust_address(row),
+        nc._fetch_phone(row),
+        nc.cached_metern_number(_text(row.get(QORBIS_METERNO_COLUMN)))
+    )
+
+
+def active_customer(row):
+    """Returns the fields compared for duplicates of a cust_active row."""
+    return _customer(
+        nc.cached_cust_name(_text(row['acctname']), '', ''),
+        nc.cached_cust_address('', _text(row['address']), '', ''),
+        nc.cached_phone(_text(row['mobile']), '', '', ''),
+        nc.cached_metern_number(_text(row['meterno']))
+    )
+
+
+def _token_key(tokens, size=None):
+    # the distinct words, or their prefixes of size letters, sorted so that
+    # word order, and word endings with a size, don't tell records apart
+    return ' '.join(sorted(set(t[:size] for t in tokens)))
+
+
+def customer_keys(customer):
+    """Returns the blocking keys of a customer, one for each of BLOCKING_KEYS:
+    the phone and meter numbers, names of two words or more, by the first 4
+    letters of their words as these are often spelt with other endings, and
+    addresses having a house number.
+    """
+    name, address = customer['name'].split(), customer['address'].split()
+    return (
+        customer['phone'] or None,
+        customer['meterno'] or None,
+        _token_key(name, 4) if len(name) > 1 else None,
+        _token_key(address)
+            if any(t.isdigit() for t in address) and len(address) > 1
+            else None,
+    )
+
+
+def find_duplicate_customers(qorbis_rows, active_rows,
+                             threshold=DUPLICATE_THRESHOLD):
+    """Returns the clusters of likely duplicate customers among tmp.QuadOrbis
+    and cust_active rows, such as those streamed by new_customers._provider.
+    Customers are identified by ('qorbis', Id) and ('active', acctno) pairs;
+    clusters can also hold duplicates within either source.
+    """
+    finder = DuplicateFinder(CUSTOMER_FIELDS, len(BLOCKING_KEYS), threshold)
+    for source, rows, customer, key in (
+            ('qorbis', qorbis_rows, qorbis_customer, 'Id'),
+            ('active', active_rows, active_customer, 'acctno')):
+        for row in rows:
+            values = customer(row)
+            finder.add((source, row[key]), values, customer_keys(values))
+    return finder.find()
+
+
+def table_columns(conn, table):
+    """Returns the names of the columns of a table."""
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT * FROM %s WHERE 1 = 0' % (table,))
+        return [d[0] for d in cur.description]
+    finally:
+        cur.close()
+
+
+def write_duplicates(clusters, outpath):
+    """Writes clusters of duplicate customers to a CSV file, a line for each
+    customer of a cluster.
+    """
+    with open(outpath, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Cluster', 'Score', 'Source', 'Id'])
+        for number, cluster in enumerate(clusters, 1):
+            for source, recid in cluster.ids:
+                writer.writerow([number, '%.3f' % cluster.score, source,
+                                 recid])
+
+
+def report_duplicate_customers(outpath, active_db_path=ACTIVE_DB_PATH):
+    """Finds the likely duplicate customers across tmp.QuadOrbis and the
+    cust_active table of a SQLite database and writes them to a CSV file.
+    """
+    started = time.time()
+    active_conn = sqlite3.connect(active_db_path)
+    try:
+        with connection() as conn:
+            columns = QORBIS_DUPLICATE_COLUMNS
+            if QORBIS_METERNO_COLUMN in table_columns(conn, 'tmp.QuadOrbis'):
+                columns += (QORBIS_METERNO_COLUMN,)
+            else:
+                print('tmp.QuadOrbis has no %s column; census customers are '
+                      'compared without meter numbers' % (
+                          QORBIS_METERNO_COLUMN,))
+            clusters = find_duplicate_customers(
+                nc._provider(conn, 'tmp.QuadOrbis', columns),
+                nc._provider(active_conn, 'cust_active',
+                             ACTIVE_DUPLICATE_COLUMNS)
+            )
+    finally:
+        active_conn.close()
+
+    write_duplicates(clusters, outpath)
+    print('Clusters: %s | Customers: %s | Seconds: %.1f' % (
+        len(clusters), sum(len(c.ids) for c in clusters),
+        time.time() - started
+    ))
+    return clusters
+
+
+if __name__ == '__main__':
+    report_duplicate_customers(sys.argv[1] if len(sys.argv) > 1 else
+                               os.path.join(BASE_DIR, 'duplicates.csv'))
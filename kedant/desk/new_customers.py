@@ -7,8 +7,11 @@ from __future__ import division
 
 
 import os
+import re
 import sys
-import pyodbc
+import json
+
+from bisect import bisect_left
 
 from os import path
 
@@ -27,25 +30,82 @@ for f in os.listdir(path.join(BASE_DIR, 'library')):
 # for records not having number of rooms, we assume a default of 4
 DEFAULT_ROOM_COUNT = 4
 
-# invalid cell values
-BAD_CELL_VALUES = (
-    '.','-','--','_','-`','=','-=','=-','=', '&', '0','-0','0-'
+# staging table for set-based updates of tmp.NewCustomers; its columns are
+# copied from tmp.NewCustomers so values fit wherever they fit the table
+NEWCUST_STAGING_DDL = """
+IF OBJECT_ID('tempdb..#NewCustomersUpdate') IS NOT NULL
+    DROP TABLE #NewCustomersUpdate;
+
+SELECT QOrbisId, Name, AccountNo, Mobile, Tariff, TariffRate, FixedCharge
+     , Consumption, ADC
+INTO #NewCustomersUpdate
+FROM tmp.NewCustomers
+WHERE 1 = 0;
+
+CREATE CLUSTERED INDEX IX_NewCustomersUpdate
+    ON #NewCustomersUpdate (QOrbisId);
+"""
+
+NEWCUST_STAGING_INSERT = (
+    "INSERT INTO #NewCustomersUpdate VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
 )
 
-# connection string
-CONN_Q1 = pyodbc.connect('driver={sql server};server=.\sqlexpress;'
-                      'database=kedco;trusted_connection=yes;')
+NEWCUST_STAGING_UPDATE = """
+UPDATE nc SET
+    Name = s.Name
+  , AccountNo = s.AccountNo
+  , Mobile = s.Mobile
+  , Tariff = s.Tariff
+  , TariffRate = s.TariffRate
+  , FixedCharge = s.FixedCharge
+  , Consumption = s.Consumption
+  , ADC = s.ADC
+FROM tmp.NewCustomers nc
+    INNER JOIN #NewCustomersUpdate s ON (nc.QOrbisId = s.QOrbisId);
+"""
 
-CONN_Q2 = pyodbc.connect('driver={sql server};server=.\sqlexpress;'
-                      'database=kedco;trusted_connection=yes;')
+# tmp.QuadOrbis & tmp.Books columns read by the scripts
+QORBIS_COLUMNS = (
+    'Id', 'FirstName', 'MiddleName', 'LastName', 'Building#', 'Street',
+    'Settlement', 'Ward', 'Phone1', 'Phone2', 'Mobile', 'CustType', '#Rooms'
+)
+BOOKS_COLUMNS = ('Book',)
+
+# tmp.QuadOrbis columns of few distinct values, dictionary-encoded when a
+# business unit is held in memory by load_qorbis_store
+QORBIS_ENCODED_COLUMNS = ('Settlement', 'Ward', 'CustType', '#Rooms')
+
+# tmp.QuadOrbis columns the tmp.NewCustomers values are built from; the
+# account number handed out by the run is tracked too, since customers added
+# or removed ahead of others in Id order shift the numbers of those others
+QORBIS_TRACKED_COLUMNS = (
+    'FirstName', 'MiddleName', 'LastName', 'Building#', 'Street',
+    'Settlement', 'Ward', 'Phone1', 'Phone2', 'Mobile', 'CustType', '#Rooms',
+    'AcctNo'
+)
 
-CONN_D = pyodbc.connect('driver={sql server};server=.\sqlexpress;'
-                      'database=kedco;trusted_connection=yes;')
+# content hashes of customers written by incremental renumeration runs; bump
+# the version when the rules building tmp.NewCustomers values change
+CHANGES_PATH = path.join(BASE_DIR, 'test-data', 'renumeration-hashes.sqlite3')
+RENUMERATION_RULES_VERSION = 3
+
+# number of normalized values held in memory by NORMALIZERS
+NORMALIZERS_CACHE_SIZE = 200000
+
+# invalid cell values
+BAD_CELL_VALUES = (
+    '.','-','--','_','-`','=','-=','=-','=', '&', '0','-0','0-'
+)
 
 #+=============================================================================
 
 
 from dolfin import Storage as _
+from dant.cache import MemoCache
+from dant.db import BatchInserter, ChangeTracker, DmlRunner, fetch_rows
+from dant.records import RecordStore
+from kedant.desk.accounts import acct_numbers, book_digits
+from kedant.desk.connections import connect, connection
 
 
 # Tariff Table
@@ -73,22 +133,22 @@ Tariff = _({    # Tariffs dict
     t.code: t for t in Tariffs 
 })
 
+## MYTO 2014 rules as applied by _get_tariff; see TariffClassifier
+TariffRules = (
+    _(cust_type='residential', max_rooms=2, tariff='R1'),
+    _(cust_type='residential', tariff='R2'),
+    _(cust_type='commercial', tariff='C1'),
+    _(cust_type='industrial', tariff='D1'),
+    _(cust_type='government', name_match=True, tariff='A1'),
+    _(cust_type='government', tariff='C1'),
+)
+
 
 def generate_acct_number(book_number, start=0):
-    bookno = book_number.replace('-','').replace('/','')
-    if not bookno or len(bookno) != 6:
-        raise ValueError("book_number cannot be empty or not of 6 digits")
-    
-    if not bookno.isdigit():
-        raise ValueError("Invalid book number provided")
-    
+    bookno = book_digits(book_number)
     start = 0 if None else (999 if start > 999 else start)
-    for i in range(start, 1000):
-        acctno = "{}{:0>3}".format(bookno, i)
-        acctno = "%s%s" % (acctno, get_acct_number_seal(acctno))
-        yield "{}/{}/{}/{}-01".format(
-            acctno[:2], acctno[2:4], acctno[4:6], acctno[6:10]
-        )
+    for acctno in acct_numbers(bookno, start):
+        yield acctno
 
 
 def get_acct_number_seal(acct_number):
@@ -230,13 +290,13 @@ def _get_metern_number(meterno):
 
 
 def _fetch_cust_name(row):
-    return _get_cust_name(
+    return cached_cust_name(
         row['FirstName'], row['MiddleName'], row['LastName']
     )
 
 
 def _fetch_cust_address(row):
-    return _get_cust_address(
+    return cached_cust_address(
         row['Building#'], row['Street'], row['Settlement'], row['Ward']
     )
 
@@ -245,22 +305,27 @@ def _fetch_room_count(row):
     return _get_room_count(row['#Rooms'])
 
 
-def _fetch_tariff(row):
-    return _get_tariff(
-        _fetch_cust_name(row), row['CustType'], row['#Rooms']
+def _fetch_tariff(row, name=None):
+    return TARIFF_CLASSIFIER.get(
+        _fetch_cust_name(row) if name is None else name,
+        row['CustType'], row['#Rooms']
     )
 
 
 def _fetch_phone(row):
-    return _get_phone(
+    return cached_phone(
         row['Phone1'], row['Phone2'], row['Mobile'], row['Street']
     )
 
 
-def _provider(conn, table, columns=None, extra_clause=None, count=None):
+def _provider(conn, table, columns=None, extra_clause=None, count=None,
+              arraysize=1000, instrument=None):
+    """Streams the rows of a table, fetching arraysize rows at a time, as
+    Row objects read like dicts keyed by column name.
+    """
     # build query text
     text = 'SELECT %s FROM %s' % (
-        '*' if not columns else ', '.join(columns),
+        '*' if not columns else ', '.join(['[%s]' % c for c in columns]),
         table
     )
     
@@ -270,18 +335,27 @@ def _provider(conn, table, columns=None, extra_clause=None, count=None):
     def read_rows():
         # execute query
         cur = conn.cursor()
+        cur.arraysize = arraysize
         cur.execute(text)
-        
-        lg_desc = cur.description
-        fields = [f[0] for f in lg_desc]
-        
-        records = cur.fetchmany(count) if count else cur.fetchall()
-        for r in records:
-            yield dict(zip(fields, r))
+        try:
+            for row in fetch_rows(cur, arraysize, count, instrument):
+                yield row
+        finally:
+            cur.close()
     
     return read_rows()
 
 
+def load_qorbis_store(rows, columns=QORBIS_COLUMNS + ('AcctNo',)):
+    """Returns the QuadOrbis rows, such as those streamed by _provider, held
+    in a compact RecordStore for cross-checks over a whole business unit. The
+    records work with the _fetch_* helpers as the rows do.
+    """
+    store = RecordStore(columns, encoded=QORBIS_ENCODED_COLUMNS, ints=('Id',))
+    store.extend(rows)
+    return store
+
+
 def _acctno_provider(bk_provider):
     class Acct: 
         index, gen = (1000, None)
@@ -299,21 +373,289 @@ def _acctno_provider(bk_provider):
 
 
 #+=============================================================================
-#| scripts functions 
+#| batch cleansing: whole columns at a time with the rules of the _get_*
+#| functions above; each distinct raw value is normalized only once per call
 #+=============================================================================
 
+_BAD_CELL_SET = frozenset(BAD_CELL_VALUES)
 
-def sample_qorbis_table():
-    for r in _provider(CONN_Q1, 'tmp.quadorbis'):
-        print('%s >>> %s >>> %s >>> %s' % (
-            _fetch_cust_name(r).title(),
-            _fetch_cust_address(r).title(),
-            _fetch_phone(r),
-            _fetch_tariff(r).values()
+# any text float() accepts is made of these characters only
+_MAYBE_NUMBER = re.compile(r'^[\s\d._+\-eEiInNfFaAtTyY]*$', re.UNICODE)
+_NAME_JUNK = re.compile(r'[=/]')
+_ADDRESS_JUNK = re.compile(r'[/;"\-]')
+_PHONE_JUNK = re.compile(r'[.\-]')
+
+
+def _is_number(value):
+    if not _MAYBE_NUMBER.match(value):
+        return False
+    try: float(value); return True
+    except: return False
+
+
+def _map_distinct(func, values):
+    cache = {}
+    result = []
+    for value in values:
+        try:
+            norm = cache[value]
+        except KeyError:
+            norm = cache[value] = func(value)
+        result.append(norm)
+    return result
+
+
+def _norm_name_part(name_):
+    name = name_.strip().lower()
+    if (name in _BAD_CELL_SET or '&' in name or 'other' in name or
+            _is_number(name)):
+        return ""
+    return _NAME_JUNK.sub('', name_).strip()
+
+
+def _norm_address_part(value_):
+    if value_.strip().lower() in _BAD_CELL_SET:
+        return ''
+    return _ADDRESS_JUNK.sub('', value_).strip()
+
+
+def _norm_address_part2(value_):
+    value = _norm_address_part(value_)
+    return '' if _is_number(value) else value
+
+
+def _norm_phone(phone):
+    phone = _PHONE_JUNK.sub('', phone)
+    if phone and not phone.isdigit() and phone[0] != "+":
+        return ""
+    
+    while phone[:2] == '00':
+        phone = phone[1:]
+    
+    if phone[:3] in ('070','080','081'):
+        return (phone if len(phone) == 11 else
+                    phone[:11] if len(phone) > 11 else "")
+    
+    if phone and phone[0] == "+":
+        return phone[:15]
+    
+    if len(phone) > 11:
+        return phone[:11]
+    
+    return ("" if len(phone) < 9 else phone)
+
+
+def _norm_meter_number(meterno):
+    meterno = meterno.strip()
+    if meterno in _BAD_CELL_SET or meterno.isalpha():
+        return ""
+    
+    m = meterno.replace('-','').replace('/','')
+    if m.isalpha() and 'A' in m and 'V' in m:
+        return ""
+    return meterno
+
+
+# memoized normalizers; open a store with NORMALIZERS.open(path) to persist
+# results across runs. Bump the version of a normalizer when its rules change.
+# Values are memoized field by field, since the same streets, settlements and
+# wards keep turning up next to new house and phone numbers
+NORMALIZERS = MemoCache(maxsize=NORMALIZERS_CACHE_SIZE)
+cached_name_part = NORMALIZERS.memoize('name_part', 1, _norm_name_part)
+cached_address_part = NORMALIZERS.memoize('address_part', 1,
+                                          _norm_address_part)
+cached_address_part2 = NORMALIZERS.memoize('address_part2', 1,
+                                           _norm_address_part2)
+cached_phone_part = NORMALIZERS.memoize('phone_part', 1, _norm_phone)
+cached_metern_number = NORMALIZERS.memoize('metern_number', 1,
+                                           _get_metern_number)
+
+
+def cached_cust_name(fname, mname, lname):
+    """Memoized form of _get_cust_name."""
+    return " ".join([p for p in (cached_name_part(fname),
+                                 cached_name_part(mname),
+                                 cached_name_part(lname)) if p]).strip()
+
+
+def cached_cust_address(build_num, street, settlement, ward):
+    """Memoized form of _get_cust_address."""
+    parts = (cached_address_part(build_num), cached_address_part2(street),
+             cached_address_part2(settlement), cached_address_part2(ward))
+    return "%s, Kano, Kano State" % ' '.join([p for p in parts if p])
+
+
+def cached_phone(phone1, phone2, mobile, street):
+    """Memoized form of _get_phone."""
+    return (cached_phone_part(phone1) or cached_phone_part(phone2) or
+            cached_phone_part(mobile) or cached_phone_part(street))
+
+
+def clean_names(fnames, mnames, lnames):
+    """Batch form of _get_cust_name over columns of name parts."""
+    parts = [_map_distinct(_norm_name_part, c)
+             for c in (fnames, mnames, lnames)]
+    return [" ".join([p for p in names if p]).strip()
+            for names in zip(*parts)]
+
+
+def clean_addresses(build_nums, streets, settlements, wards):
+    """Batch form of _get_cust_address over columns of address parts."""
+    parts = [_map_distinct(_norm_address_part, build_nums)] + [
+        _map_distinct(_norm_address_part2, c)
+        for c in (streets, settlements, wards)
+    ]
+    return ["%s, Kano, Kano State" % ' '.join([p for p in values if p])
+            for values in zip(*parts)]
+
+
+def clean_phones(phones1, phones2, mobiles, streets):
+    """Batch form of _get_phone over columns of phone sources."""
+    columns = [_map_distinct(_norm_phone, c)
+               for c in (phones1, phones2, mobiles, streets)]
+    return [p1 or p2 or m or st for p1, p2, m, st in zip(*columns)]
+
+
+def clean_meter_numbers(meternos):
+    """Batch form of _get_metern_number over a column of meter numbers."""
+    return _map_distinct(_norm_meter_number, meternos)
+
+
+def clean_room_counts(room_counts):
+    """Batch form of _get_room_count over a column of room counts."""
+    return _map_distinct(_get_room_count, room_counts)
+
+
+def clean_records(columns):
+    """Cleanses QuadOrbis records held column-wise, e.g. a dict of lists or
+    arrays or a pandas DataFrame, and returns a dict of cleansed columns.
+    """
+    return dict(
+        name = clean_names(
+            columns['FirstName'], columns['MiddleName'], columns['LastName']
+        ),
+        address = clean_addresses(
+            columns['Building#'], columns['Street'], columns['Settlement'],
+            columns['Ward']
+        ),
+        phone = clean_phones(
+            columns['Phone1'], columns['Phone2'], columns['Mobile'],
+            columns['Street']
+        ),
+        rooms = clean_room_counts(columns['#Rooms']),
+    )
+
+
+class TariffClassifier(object):
+    """Classifies customers into tariffs using a lookup table compiled from
+    tariff rules and keyed on the lowercased customer type, the room count
+    bucket and whether the name contains the name keyword.
+    
+    Rules are tried in order and the first rule matching gives the tariff. A
+    rule matches on its cust_type, its max_rooms if any and its name_match if
+    any. Customer types without rules get the default tariff.
+    
+    Tariff tables such as a new MYTO revision are loaded with `from_file`.
+    """
+    
+    def __init__(self, tariffs, rules, default, name_keyword='school'):
+        self.tariffs = dict((t.code, t) for t in tariffs)
+        self.default = self.tariffs[default]
+        self.name_keyword = name_keyword.lower()
+        self._bounds = sorted(set(
+            r['max_rooms'] for r in rules if r.get('max_rooms') is not None
         ))
+        self._table = self._compile(rules)
+    
+    @classmethod
+    def from_file(cls, filepath):
+        """Loads a tariff table from a JSON file of the form:
+        
+          {"tariffs": [{"code": "R1", "fixed_charge": 0, "rate": 4.0}, ...],
+           "rules": [{"cust_type": "residential", "max_rooms": 2,
+                      "tariff": "R1"}, ...],
+           "default": "R2", "name_keyword": "school"}
+        """
+        with open(filepath) as f:
+            data = json.load(f)
+        
+        tariffs = [_mkt(t['code'], t['fixed_charge'], t['rate'])
+                   for t in data['tariffs']]
+        return cls(tariffs, [_(r) for r in data['rules']], data['default'],
+                   data.get('name_keyword', 'school'))
+    
+    def _compile(self, rules):
+        # one representative room count per bucket
+        rooms_list = self._bounds + [
+            (self._bounds[-1] + 1) if self._bounds else DEFAULT_ROOM_COUNT
+        ]
+        table = {}
+        for cust_type in set(r['cust_type'].lower() for r in rules):
+            for bucket, rooms in enumerate(rooms_list):
+                for name_match in (False, True):
+                    table[(cust_type, bucket, name_match)] = self._apply(
+                        rules, cust_type, rooms, name_match
+                    )
+        return table
+    
+    def _apply(self, rules, cust_type, rooms, name_match):
+        for rule in rules:
+            if rule['cust_type'].lower() != cust_type:
+                continue
+            if rule.get('max_rooms') is not None and rooms > rule['max_rooms']:
+                continue
+            if (rule.get('name_match') is not None and
+                    rule['name_match'] != name_match):
+                continue
+            return self.tariffs[rule['tariff']]
+        return None
+    
+    def get(self, name, cust_type, room_count):
+        """Returns the tariff for a customer; same as _get_tariff."""
+        key = (cust_type.lower(),
+               bisect_left(self._bounds, _get_room_count(room_count)),
+               self.name_keyword in name.lower())
+        return self._table.get(key, self.default)
+    
+    def classify(self, names, cust_types, room_counts):
+        """Returns the tariffs for columns of names, customer types and room
+        counts.
+        """
+        table, default, bounds = self._table, self.default, self._bounds
+        keyword = self.name_keyword
+        buckets = _map_distinct(
+            lambda r: bisect_left(bounds, _get_room_count(r)), room_counts
+        )
+        types = _map_distinct(lambda t: t.lower(), cust_types)
+        matches = _map_distinct(lambda n: keyword in n.lower(), names)
+        return [table.get(key, default)
+                for key in zip(types, buckets, matches)]
+
+
+TARIFF_CLASSIFIER = TariffClassifier(Tariffs, TariffRules, 'R2')
+
+
+#+=============================================================================
+#| scripts functions 
+#+=============================================================================
 
 
-def dml_runner(dml_provider):
+def sample_qorbis_table():
+    with connection() as conn:
+        for r in _provider(conn, 'tmp.quadorbis', QORBIS_COLUMNS):
+            print('%s >>> %s >>> %s >>> %s' % (
+                _fetch_cust_name(r).title(),
+                _fetch_cust_address(r).title(),
+                _fetch_phone(r),
+                _fetch_tariff(r).values()
+            ))
+
+
+def dml_runner(dml_provider, instrument=None):
+    """Runs the dml of a dml provider one statement at a time; with an
+    instrument, statements are recorded under the 'dml' stage and commits
+    under the 'commit' stage.
+    """
     if not dml_provider:
         raise ValueError('dml_provider must be provided')
     
@@ -321,27 +663,37 @@ def dml_runner(dml_provider):
     results = _(failed=0, passed=0, errors=[])
     print('')
     
-    ln_count = 0
-    cur = CONN_D.cursor()
-    for dml in dml_provider():
-        try:
-            cur.execute(dml)
-            results.passed += 1
-            print('.', sep='', end='')
-        except Exception as ex:
-            results.failed += 1
-            results.errors.append([ex, dml])
-            print('F', sep='', end='')
+    with connection() as conn:
+        ln_count = 0
+        cur = conn.cursor()
+        commit = _committer(conn, instrument)
         
-        ln_count += 1
-        if ln_count % 100 == 0:
-            print('')
-        if ln_count % 1000 == 0:
-            print('{0} {1}'.format(ln_count, "*" * 80))
-            CONN_D.commit()
-            print(' '.join([x.strip() for x in dml.split('\n')]))
-    
-    CONN_D.commit()
+        for dml in dml_provider():
+            try:
+                if instrument:
+                    instrument.count('dml', 'statements')
+                    with instrument.timer('dml'):
+                        cur.execute(dml)
+                else:
+                    cur.execute(dml)
+                results.passed += 1
+                print('.', sep='', end='')
+            except Exception as ex:
+                results.failed += 1
+                results.errors.append([ex, dml])
+                if instrument:
+                    instrument.count('dml', 'failed')
+                print('F', sep='', end='')
+            
+            ln_count += 1
+            if ln_count % 100 == 0:
+                print('')
+            if ln_count % 1000 == 0:
+                print('{0} {1}'.format(ln_count, "*" * 80))
+                commit()
+                print(' '.join([x.strip() for x in dml.split('\n')]))
+        
+        commit()
     
     print("\nCount: %s | Passed: %s | Failed: %s" % (
         results.passed + results.failed, 
@@ -354,14 +706,61 @@ def dml_runner(dml_provider):
             print(str(entry[0]))
             print(entry[1])
             print("-" * 10 + "\n")
+    return results
+
+
+def _committer(conn, instrument=None):
+    # the commit of a connection; with an instrument, commits are recorded
+    # under the 'commit' stage
+    if not instrument:
+        return conn.commit
+    
+    def commit():
+        with instrument.timer('commit'):
+            conn.commit()
+        instrument.count('commit', 'commits')
+    return commit
+
+
+def parallel_dml_runner(dml_provider, workers=4, commit_every=1000):
+    """Runs the (key, dml) pairs of a keyed dml provider over several
+    connections; dml for the same key always runs on the same connection.
+    """
+    if not dml_provider:
+        raise ValueError('dml_provider must be provided')
+    
+    print('')
+    runner = DmlRunner(connect, workers, commit_every,
+                       on_progress=lambda count: print('.', sep='', end=''))
+    results = runner.run(dml_provider())
+    
+    print("\nCount: %s | Passed: %s | Failed: %s" % (
+        results.passed + results.failed,
+        results.passed, results.failed
+    ))
+    
+    if results.errors:
+        print("*" * 80)
+        for error in results.errors:
+            print('[worker %s, key %s] %s' % (
+                error.worker, error.key, error.error
+            ))
+            print(error.statement)
+            print("-" * 10 + "\n")
+        if results.failed > len(results.errors):
+            print('... %s more' % (results.failed - len(results.errors)))
+    return results
 
 
-def dml_provider_builder(row_provider, dml_builder):
+def dml_provider_builder(row_provider, dml_builder, key=None):
+    """Returns a dml provider for the rows; with key set, it yields
+    (key(row), dml) pairs as expected by parallel_dml_runner.
+    """
     def dml_generator():
         for row in row_provider:
             try:
                 dml = dml_builder(row)
-                yield dml
+                yield dml if key is None else (key(row), dml)
             except Exception as ex:
                 print(ex)
                 raise ex
@@ -371,32 +770,47 @@ def dml_provider_builder(row_provider, dml_builder):
 #+============================================================================+
 
 
-def _extract_all_qorbis_data_with_acctno_added():
-    # providers
-    bk_prov = _provider(CONN_Q1, 'tmp.Books', extra_clause=' ORDER BY book')
-    cs_prov = _provider(CONN_Q2, 'tmp.QuadOrbis',
-                        extra_clause=' WHERE (Id in (SELECT QOrbisId'
-                                    +'               FROM tmp.newcustomers))'
-                                    +' ORDER BY id')
-    
-    # acct# provider
-    get_acctno = _acctno_provider(bk_prov)
-    
-    for cs_row in cs_prov:
-        acctno = get_acctno()
-        cs_row["AcctNo"] = acctno
-        yield cs_row
+def _extract_all_qorbis_data_with_acctno_added(instrument=None):
+    with connection() as conn_q1, connection() as conn_q2:
+        # providers
+        bk_prov = _provider(conn_q1, 'tmp.Books', BOOKS_COLUMNS,
+                            extra_clause=' ORDER BY book',
+                            instrument=instrument)
+        cs_prov = _provider(conn_q2, 'tmp.QuadOrbis', QORBIS_COLUMNS,
+                            extra_clause=' WHERE (Id in (SELECT QOrbisId'
+                                        +'           FROM tmp.newcustomers))'
+                                        +' ORDER BY id',
+                            instrument=instrument)
+        
+        # acct# provider
+        get_acctno = _acctno_provider(bk_prov)
+        
+        for cs_row in cs_prov:
+            acctno = get_acctno()
+            cs_row["AcctNo"] = acctno
+            yield cs_row
 
 
-def _build_dml_for_qorbis_data_having_acctno(row):
+def _build_values_for_qorbis_data_having_acctno(row):
     name = _fetch_cust_name(row)
-    tariff = _get_tariff(name, row['CustType'], row['#Rooms'])
+    tariff = _fetch_tariff(row, name)
     consumption = _fetch_room_count(row) * 25
     adc = consumption / 30
     
-    idx = name.find("'")
-    if idx != -1:
-        name = name.replace("'", "''")
+    return (row["Id"],
+            name,
+            row["AcctNo"],
+            _fetch_phone(row),
+            tariff.code if tariff else None,
+            tariff.rate if tariff else None,
+            tariff.fixed_charge if tariff else None,
+            consumption,
+            adc)
+
+
+def _build_dml_for_qorbis_data_having_acctno(row):
+    values = list(_build_values_for_qorbis_data_having_acctno(row))
+    values[1] = values[1].replace("'", "''")
     
     return """
     UPDATE tmp.NewCustomers SET
@@ -409,84 +823,95 @@ def _build_dml_for_qorbis_data_having_acctno(row):
       , Consumption = '{7}'
       , ADC = '{8}'
     WHERE (QOrbisId = '{0}');
-    """.format(row["Id"], 
-               name, 
-               row["AcctNo"],
-               _fetch_phone(row), 
-               tariff.code if tariff else None,
-               tariff.rate if tariff else None,
-               tariff.fixed_charge if tariff else None,
-               consumption,
-               adc)
+    """.format(*values)
 
 
 def _extract_specific_qorbis_data_with_acctno_added(ids):
     # providers
     acctgen = generate_acct_number('32/55/42', start=74)
-    cs_prov = _provider(CONN_Q2, 'tmp.QuadOrbis',
-                        extra_clause=' WHERE Id in (%s) ORDER BY Id' % (
-                            ', '.join(ids)
-                        ))
-    
-    for cs_row in cs_prov:
-        acctno = acctgen.next()
-        cs_row["AcctNo"] = acctno 
-        yield cs_row
+    with connection() as conn:
+        cs_prov = _provider(conn, 'tmp.QuadOrbis', QORBIS_COLUMNS,
+                            extra_clause=' WHERE Id in (%s) ORDER BY Id' % (
+                                ', '.join(ids)
+                            ))
+        
+        for cs_row in cs_prov:
+            acctno = acctgen.next()
+            cs_row["AcctNo"] = acctno 
+            yield cs_row
 
 
-def update_customer_info_and_tariff():
-    # providers
-    bk_prov = _provider(CONN_Q1, 'tmp.Books', extra_clause=' ORDER BY book')
-    cs_prov = _provider(CONN_Q2, 'tmp.QuadOrbis',
-                        extra_clause=' WHERE (Id in (SELECT QOrbisId'
-                                    +'               FROM tmp.newcustomers))'
-                                    +' ORDER BY id')
+def bulk_update_new_customers(values_provider, batch_size=1000):
+    """Writes computed customer values into a staging table using batched
+    parameterized inserts and applies them to tmp.NewCustomers with a single
+    joined UPDATE. Returns the number of customers updated.
     
-    def dml_generator():
-        def build_dml(customer, acctno):
-            name = _fetch_cust_name(customer)
-            tariff = _get_tariff(name, customer['CustType'], customer['#Rooms'])
-            consumption = _fetch_room_count(customer) * 25
-            adc = consumption / 30
-            
-            idx = name.find("'")
-            if idx != -1:
-                name = name.replace("'", "''")
-            
-            return """
-            UPDATE tmp.NewCustomers SET
-                Name = '{1}'
-              , AccountNo = '{2}'
-              , Mobile = '{3}'
-              , Tariff = '{4}'
-              , TariffRate = '{5}'
-              , FixedCharge = '{6}'
-              , Consumption = '{7}'
-              , ADC = '{8}'
-            WHERE (QOrbisId = '{0}');
-            """.format(customer["Id"], 
-                       name, 
-                       acctno, 
-                       _fetch_phone(customer), 
-                       tariff.code if tariff else None,
-                       tariff.rate if tariff else None,
-                       tariff.fixed_charge if tariff else None,
-                       consumption,
-                       adc)
-        
-        # get book for use in generating acct#
-        get_acctno = _acctno_provider(bk_prov)
+    values_provider: iterable of tuples in the column order of the staging
+        table, as built by _build_values_for_qorbis_data_having_acctno
+    """
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(NEWCUST_STAGING_DDL)
+        with BatchInserter(conn, NEWCUST_STAGING_INSERT, batch_size) as ins:
+            for values in values_provider:
+                ins.add(values)
         
-        for customer in cs_prov:
-            acctno = get_acctno()
-            try:
-                dml = build_dml(customer, acctno)
-                yield dml
-            except Exception as ex:
-                print(ex)
-                raise ex
+        cur.execute(NEWCUST_STAGING_UPDATE)
+        count = cur.rowcount
+        cur.execute("DROP TABLE #NewCustomersUpdate")
+        conn.commit()
+    return count
+
+
+def _tracked_values_for_qorbis_data_having_acctno(row):
+    return [row[c] for c in QORBIS_TRACKED_COLUMNS]
+
+
+def update_customer_info_and_tariff(set_based=False, incremental=False,
+                                    workers=None, instrument=None):
+    """Updates tmp.NewCustomers from tmp.QuadOrbis. With incremental set,
+    only customers new or changed since the last incremental run are written.
+    With workers set, the updates run concurrently over that many connections.
+    """
+    rows = _extract_all_qorbis_data_with_acctno_added(instrument)
+    tracker = None
+    if incremental:
+        tracker = ChangeTracker(CHANGES_PATH, 'tmp.NewCustomers',
+                                RENUMERATION_RULES_VERSION)
+        rows = tracker.filter(rows, lambda r: r['Id'],
+                              _tracked_values_for_qorbis_data_having_acctno)
     
-    dml_runner(dml_generator)
+    try:
+        if set_based:
+            count = bulk_update_new_customers(
+                _build_values_for_qorbis_data_having_acctno(row)
+                for row in rows
+            )
+            print('Updated: %s' % count)
+            failed = 0
+        elif workers:
+            failed = parallel_dml_runner(dml_provider_builder(
+                row_provider = rows,
+                dml_builder = _build_dml_for_qorbis_data_having_acctno,
+                key = lambda r: r['Id']
+            ), workers).failed
+        else:
+            failed = dml_runner(dml_provider_builder(
+                row_provider = rows,
+                dml_builder = _build_dml_for_qorbis_data_having_acctno
+            ), instrument).failed
+        
+        if tracker:
+            if not failed:
+                tracker.save()
+            print('Changed: %s | Skipped: %s' % (
+                tracker.changed, tracker.skipped
+            ))
+    finally:
+        if tracker:
+            tracker.close()
+    if instrument:
+        print(instrument.summary())
     print('Hurray! Done')
 
 
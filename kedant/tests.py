@@ -0,0 +1,458 @@
+"""
+Defines unit tests for the KEDCO data analysis toolbox.
+"""
+import os
+import json
+import importlib
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from xlrd import open_workbook
+from dant.cache import SheetCache
+from dant.data import XlSheet
+from dant.db import ChangeTracker, CheckpointStore, ConnectionPool
+from dant.xlsx import write_xlsx
+from kedant.desk import connections
+from kedant.desk import dala_customers_renumeration as dala
+from kedant.desk import duplicates as dup
+from kedant.desk import new_customers as nc
+from kedant.desk.accounts import AcctNumberAllocator, acct_numbers
+
+
+
+
+TEST_DATA_DIR = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        '..', 'test-data'
+    )
+)
+
+
+# raw values known to trip the cleansing rules
+EDGE_VALUES = list(nc.BAD_CELL_VALUES) + [
+    '', ' ', 'ALH. MUSA', 'Musa & Sons', 'OTHERS', 'others/', '12', ' 3.5 ',
+    '1e5', 'nan', ' Inf ', '-infinity', '+7', '.5', '5.', '1-2', 'A=B/C',
+    'NO. 12', '"Gwale"', 'k/waika;', '-`', '0803-123-4567', '08031234567',
+    '080312345678', '0080312345678', '00080.3123.4567', '+2348031234567890',
+    '2348031234567', '12345678', '123456789', 'n/a', 'AVR', 'A/V', 'A-V-R',
+    'AV1', '0000000092', 'MTR-12/3', u'\u0661\u0662', u'caf\xe9',
+]
+
+
+def _fuzz_values(count, seed=2016):
+    rnd = random.Random(seed)
+    alphabet = '0123456789.-+/=;"&` eEnaifAVothersOTHERSK'
+    return [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 14)))
+            for _ in range(count)]
+
+
+def _sample_values():
+    # text cells of the sample customer sheet plus edge & fuzzed values
+    xlsheet = XlSheet(open_workbook(
+        os.path.join(TEST_DATA_DIR, 'sample-cust.xls')), 'active'
+    )
+    cells = [v for row in xlsheet.getrows() for v in row
+             if isinstance(v, type(u''))]
+    return cells + EDGE_VALUES + _fuzz_values(2000)
+
+
+class DeskImportTest(unittest.TestCase):
+    
+    MODULES = ('kedant.bench', 'kedant.desk.connections',
+               'kedant.desk.dala_customers_renumeration',
+               'kedant.desk.duplicates', 'kedant.desk.new_customers')
+    
+    def test_desk_modules_import(self):
+        for name in self.MODULES:
+            self.assertIsNotNone(importlib.import_module(name), name)
+    
+    def test_desk_config_has_defaults(self):
+        config = connections.DeskConfig()
+        self.assertEqual(config.database.pool_size, 4)
+        self.assertEqual(config.database.health_check, 'SELECT 1')
+
+
+class BatchCleansingTest(unittest.TestCase):
+    """Regression harness checking the batch cleansing functions return the
+    same results as the scalar _get_* functions.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(BatchCleansingTest, cls).setUpClass()
+        values = _sample_values()
+        rnd = random.Random(7)
+        cls._columns = [values] + [
+            rnd.sample(values, len(values)) for _ in range(3)
+        ]
+
+    def _rows(self, arity):
+        return list(zip(*self._columns[:arity]))
+
+    def test_clean_names_matches_scalar(self):
+        expected = [nc._get_cust_name(*r) for r in self._rows(3)]
+        self.assertEqual(nc.clean_names(*self._columns[:3]), expected)
+
+    def test_clean_addresses_matches_scalar(self):
+        expected = [nc._get_cust_address(*r) for r in self._rows(4)]
+        self.assertEqual(nc.clean_addresses(*self._columns), expected)
+
+    def test_clean_phones_matches_scalar(self):
+        expected = [nc._get_phone(*r) for r in self._rows(4)]
+        self.assertEqual(nc.clean_phones(*self._columns), expected)
+
+    def test_clean_meter_numbers_matches_scalar(self):
+        expected = [nc._get_metern_number(v) for v in self._columns[0]]
+        self.assertEqual(nc.clean_meter_numbers(self._columns[0]), expected)
+
+    def test_clean_room_counts_matches_scalar(self):
+        values = self._columns[0] + [None, 0, 2, -3, 4.7, 2.0, True]
+        expected = [nc._get_room_count(v) for v in values]
+        self.assertEqual(nc.clean_room_counts(values), expected)
+
+    def test_memoized_normalizers_match_scalar(self):
+        for args in self._rows(3):
+            self.assertEqual(nc.cached_cust_name(*args),
+                             nc._get_cust_name(*args), args)
+        for args in self._rows(4):
+            self.assertEqual(nc.cached_cust_address(*args),
+                             nc._get_cust_address(*args), args)
+            self.assertEqual(nc.cached_phone(*args), nc._get_phone(*args),
+                             args)
+    
+    def test_memoized_normalizers_reuse_fields(self):
+        before = nc.NORMALIZERS.stats()['address_part2']['hits']
+        for number in range(10):
+            nc.cached_cust_address(str(number), 'Gwale Road', 'Dala', 'Gwale')
+        hits = nc.NORMALIZERS.stats()['address_part2']['hits'] - before
+        self.assertTrue(hits >= 27, hits)
+    
+    def test_rerun_writes_customers_renumbered_by_an_inserted_one(self):
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'hashes.sqlite3')
+        
+        def run(ids):
+            # numbers are handed out in Id order, as by a renumeration run
+            numbers = nc.generate_acct_number('32/55/42', start=0)
+            rows = []
+            for id in ids:
+                row = dict((c, '') for c in nc.QORBIS_COLUMNS)
+                row.update(Id=id, FirstName='C%s' % id, AcctNo=next(numbers))
+                rows.append(row)
+            tracker = ChangeTracker(path, 'tmp.NewCustomers',
+                                    nc.RENUMERATION_RULES_VERSION)
+            try:
+                written = dict((r['Id'], r['AcctNo']) for r in tracker.filter(
+                    rows, lambda r: r['Id'],
+                    nc._tracked_values_for_qorbis_data_having_acctno
+                ))
+                tracker.save()
+            finally:
+                tracker.close()
+            return written
+        
+        try:
+            numbers = run([10, 20, 30])
+            written = run([10, 15, 20, 30])
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(sorted(written), [15, 20, 30])
+        numbers.update(written)
+        self.assertEqual(len(set(numbers.values())), 4)
+    
+    def test_clean_records_cleanses_columns(self):
+        columns = {
+            'FirstName': ['MUSA', '='], 'MiddleName': ['', 'ALI'],
+            'LastName': ['BELLO', '12'], 'Building#': ['12', '-'],
+            'Street': ['Gwale', '3'], 'Settlement': ['', ''],
+            'Ward': ['Dala', 'Dala'], 'Phone1': ['', '0803-123-4567'],
+            'Phone2': ['', ''], 'Mobile': ['08031234567', ''],
+            '#Rooms': ['2', None],
+        }
+        result = nc.clean_records(columns)
+        self.assertEqual(result['name'], ['MUSA BELLO', 'ALI'])
+        self.assertEqual(result['address'], [
+            '12 Gwale Dala, Kano, Kano State', 'Dala, Kano, Kano State'
+        ])
+        self.assertEqual(result['phone'], ['08031234567', '08031234567'])
+        self.assertEqual(result['rooms'], [2, 4])
+    
+    def test_fetch_helpers_work_on_store_records(self):
+        values = _sample_values()
+        rows = [
+            dict(zip(nc.QORBIS_COLUMNS,
+                     [i] + values[i:i + len(nc.QORBIS_COLUMNS) - 1]))
+            for i in range(0, len(values) - len(nc.QORBIS_COLUMNS))
+        ]
+        store = nc.load_qorbis_store(rows)
+        self.assertEqual(len(store), len(rows))
+        for row, record in zip(rows, store):
+            for fetch in (nc._fetch_cust_name, nc._fetch_cust_address,
+                          nc._fetch_phone, nc._fetch_room_count,
+                          nc._fetch_tariff):
+                self.assertEqual(fetch(record), fetch(row), row)
+        
+        store[0]['AcctNo'] = '32/55/42/0741-01'
+        self.assertEqual(store[0]['AcctNo'], '32/55/42/0741-01')
+
+
+
+class TariffClassifierTest(unittest.TestCase):
+    
+    NAMES = ['Gov. Sec. School', 'SCHOOLS BOARD', 'Hospital', '', 'musa']
+    CUST_TYPES = ['Residential', 'COMMERCIAL', 'industrial', 'Government',
+                  'Others', '', ' residential']
+    ROOM_COUNTS = [None, '', 0, 1, 2, 3, '2', '3', 'x', -1, -3, 10, 2.5]
+    
+    def _combinations(self):
+        return [(n, t, r) for n in self.NAMES for t in self.CUST_TYPES
+                for r in self.ROOM_COUNTS]
+    
+    def test_get_matches_scalar(self):
+        for args in self._combinations():
+            self.assertIs(nc.TARIFF_CLASSIFIER.get(*args),
+                          nc._get_tariff(*args), args)
+    
+    def test_classify_matches_scalar(self):
+        combos = self._combinations()
+        expected = [nc._get_tariff(*args) for args in combos]
+        self.assertEqual(nc.TARIFF_CLASSIFIER.classify(*zip(*combos)),
+                         expected)
+    
+    def test_can_load_tariff_table_from_file(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tempdir, 'myto.json')
+            with open(filepath, 'w') as f:
+                json.dump({
+                    'tariffs': [
+                        {'code': 'R1', 'fixed_charge': 0, 'rate': 5.0},
+                        {'code': 'R2', 'fixed_charge': 700, 'rate': 20.0},
+                        {'code': 'R3', 'fixed_charge': 900, 'rate': 30.0},
+                    ],
+                    'rules': [
+                        {'cust_type': 'residential', 'max_rooms': 2,
+                         'tariff': 'R1'},
+                        {'cust_type': 'residential', 'max_rooms': 6,
+                         'tariff': 'R2'},
+                        {'cust_type': 'residential', 'tariff': 'R3'},
+                    ],
+                    'default': 'R2',
+                }, f)
+            classifier = nc.TariffClassifier.from_file(filepath)
+        finally:
+            shutil.rmtree(tempdir)
+        
+        codes = [t.code for t in classifier.classify(
+            ['a'] * 5, ['residential'] * 4 + ['commercial'], [1, 5, 6, 7, 1]
+        )]
+        self.assertEqual(codes, ['R1', 'R2', 'R2', 'R3', 'R2'])
+        self.assertEqual(classifier.get('a', 'Residential', 9).rate, 30.0)
+
+
+
+class AcctNumberTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tempdir, 'acctno.sqlite3')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_acct_numbers_carry_valid_seal(self):
+        for acctno in acct_numbers('32/55/42'):
+            digits = acctno.replace('/', '').replace('-', '')[:10]
+            self.assertEqual(digits[9], nc.get_acct_number_seal(digits[:9]))
+    
+    def test_generate_acct_number_starts_at_serial(self):
+        numbers = list(nc.generate_acct_number('32/55/42', start=74))
+        self.assertEqual(len(numbers), 926)
+        self.assertEqual(numbers[0], '32/55/42/0746-01')
+    
+    def test_generate_acct_number_rejects_bad_book(self):
+        with self.assertRaises(ValueError):
+            list(nc.generate_acct_number('32/55/4x'))
+    
+    def test_allocates_blocks_across_books(self):
+        allocator = AcctNumberAllocator(self.dbpath, ['32/55/42', '32/55/43'])
+        first = allocator.allocate(998)
+        second = allocator.allocate(5)
+        self.assertEqual(first, acct_numbers('32/55/42', 0, 998))
+        self.assertEqual(second, acct_numbers('32/55/42', 998) +
+                                 acct_numbers('32/55/43', 0, 3))
+        self.assertEqual(allocator.next_serial('32/55/43'), 3)
+    
+    def test_issued_numbers_persist_across_allocators(self):
+        books = ['32/55/42']
+        first = AcctNumberAllocator(self.dbpath, books).allocate(10)
+        other = AcctNumberAllocator(self.dbpath, books)
+        second = other.allocate(10)
+        self.assertFalse(set(first) & set(second))
+    
+    def test_raises_error_when_books_run_out(self):
+        allocator = AcctNumberAllocator(self.dbpath, ['32/55/42'])
+        allocator.allocate(990)
+        with self.assertRaises(ValueError):
+            allocator.allocate(20)
+        self.assertEqual(allocator.next_serial('32/55/42'), 990)
+
+
+
+class DuplicateCustomersTest(unittest.TestCase):
+    
+    def _qorbis_row(self, id, first, last, building, phone, meterno=''):
+        return dict(zip(nc.QORBIS_COLUMNS, [
+            id, first, '', last, building, 'Gwale Road', '', 'Dala', phone,
+            '', '', 'Residential', '2'
+        ]), MeterNo=meterno)
+    
+    def test_customer_keys(self):
+        keys = dup.customer_keys(dup.qorbis_customer(
+            self._qorbis_row(1, 'Muhammad', 'Bello', '12', '0803-123-4567')
+        ))
+        self.assertEqual(keys, (
+            '8031234567', None, 'bell muha', '12 dala gwale road'
+        ))
+        keys = dup.customer_keys(dup.active_customer({
+            'acctno': '32/55/42/0741-01', 'acctname': 'MUSA', 'address': '=',
+            'meterno': 'mtr-12/3', 'mobile': 8031234567.0,
+        }))
+        self.assertEqual(keys, ('8031234567', 'MTR123', None, None))
+    
+    def test_census_rows_may_go_without_meter_numbers(self):
+        row = self._qorbis_row(1, 'Muhammad', 'Bello', '12', '')
+        del row['MeterNo']
+        self.assertEqual(dup.qorbis_customer(row)['meterno'], '')
+        
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE QuadOrbis (Id INT, MeterNo VARCHAR(20))')
+        self.assertEqual(dup.table_columns(conn, 'QuadOrbis'),
+                         ['Id', 'MeterNo'])
+        conn.close()
+    
+    def test_finds_duplicates_across_census_and_active_customers(self):
+        qorbis = [
+            self._qorbis_row(1, 'Muhammad', 'Bello', '12', '08031234567'),
+            self._qorbis_row(2, 'Sani', 'Kano', '40', '08039999999'),
+            self._qorbis_row(3, 'Sani', 'Kano', '7', '', 'M-100'),
+        ]
+        active = [{
+            'acctno': '32/55/42/0741-01', 'acctname': 'MUHAMMED BELLO',
+            'address': '12 Gwale Road Dala', 'meterno': '',
+            'mobile': '+2348031234567',
+        }, {
+            'acctno': '32/55/42/0750-01', 'acctname': 'ALI GARBA',
+            'address': '7 Gwale Road Dala', 'meterno': 'M100', 'mobile': '',
+        }]
+        clusters = dup.find_duplicate_customers(qorbis, active)
+        self.assertEqual(sorted(c.ids for c in clusters), [
+            [('qorbis', 1), ('active', '32/55/42/0741-01')],
+        ])
+        
+        tempdir = tempfile.mkdtemp()
+        try:
+            outpath = os.path.join(tempdir, 'duplicates.csv')
+            dup.write_duplicates(clusters, outpath)
+            with open(outpath) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class LoadXl2dbTest(unittest.TestCase):
+    
+    def test_returns_bad_cells_by_default(self):
+        rows = []
+        errors = dala.load_xl2db(
+            os.path.join(TEST_DATA_DIR, 'sample-cust.xls'), 'active',
+            ['S/N', 'Account No'], rows.append, schema={0: 'int', 1: 'int'}
+        )
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([(e.row, e.col) for e in errors],
+                         [(i, 1) for i in range(6, 11)])
+        self.assertTrue(all(r[1] is None for r in rows))
+    
+    def test_xlsx_workbooks_skip_the_sheet_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            xlsheet = XlSheet(os.path.join(TEST_DATA_DIR, 'sample-cust.xls'),
+                              'active')
+            xlfilepath = os.path.join(tempdir, 'sample-cust.xlsx')
+            write_xlsx(xlfilepath, [('active', list(xlsheet))])
+            cache = SheetCache(os.path.join(tempdir, 'sheets'))
+            rows = list(dala.read_xl2rows(xlfilepath, 'active',
+                                          ['S/N', 'Account No'],
+                                          sheet_cache=cache))
+            self.assertEqual([r[0] for _, r in rows], [1, 2, 3, 4, 5])
+            self.assertEqual((cache.hits, cache.misses), (0, 0))
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def test_failed_sqlite_load_leaves_no_database(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tempdir, 'cust-db.sqlite3')
+            dala.do4sqlite3(dbpath, os.path.join(
+                TEST_DATA_DIR, 'sample-cust.xls'), 'no-such-sheet', ['S/N'])
+            self.assertFalse(os.path.exists(dbpath))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class OrbisLoadTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.xlfilepath = os.path.join(self.tempdir, 'orbis.xlsx')
+        header = ['Id'] + ['C%s' % j for j in range(1, 50)]
+        write_xlsx(self.xlfilepath, [('orbis', [header] + [
+            [i] + ['v'] * 49 for i in range(1, 26)
+        ])])
+        self.checkpoint_path = os.path.join(self.tempdir, 'cp.sqlite3')
+        self.dbpath = os.path.join(self.tempdir, 'orbis.sqlite3')
+        self.pool = connections._state['pool']
+        connections._state['pool'] = ConnectionPool(
+            lambda: sqlite3.connect(self.dbpath)
+        )
+    
+    def tearDown(self):
+        connections._state['pool'].close()
+        connections._state['pool'] = self.pool
+        shutil.rmtree(self.tempdir)
+    
+    def _load(self, check='1'):
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute('CREATE TABLE Orbis (c0 INTEGER CHECK (%s), %s)' % (
+            check, ', '.join('c%s' % j for j in range(1, 34))))
+        conn.close()
+        dala.do4mssql_orbis(self.xlfilepath, 'orbis', ['Id', 'C1'], 'Orbis',
+                            batch_size=1,
+                            checkpoint_path=self.checkpoint_path)
+    
+    def _checkpoint(self):
+        checkpoints = CheckpointStore(self.checkpoint_path)
+        try:
+            return checkpoints.get(self.xlfilepath, 'orbis', 'Orbis')
+        finally:
+            checkpoints.close()
+    
+    def test_full_load_clears_the_checkpoint(self):
+        self._load()
+        conn = sqlite3.connect(self.dbpath)
+        count = conn.execute('SELECT COUNT(*) FROM Orbis').fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 25)
+        self.assertIsNone(self._checkpoint())
+    
+    def test_failed_load_keeps_the_last_committed_row(self):
+        self.assertRaises(SystemExit, self._load, 'c0 < 23')
+        self.assertEqual(self._checkpoint(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()